@@ -0,0 +1,79 @@
+"""
+The single "is this an unanswerable reply?" test, compiled once from utils.UNANSWERABLE_REPLIES and utils.UNANSWERABLE_REPLIES_EXACT.
+
+A reply (lower-cased and stripped) is unanswerable if it equals one of the exact replies (optionally followed by a "."),
+or contains one of the replies. The exact replies are hashed into a set and the contained replies are compiled into a
+single regex alternation, and the vectorized API matches every distinct reply only once.
+"""
+import re
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from utils import UNANSWERABLE_REPLIES, UNANSWERABLE_REPLIES_EXACT
+
+
+class AbstentionMatcher:
+    def __init__(self, replies=UNANSWERABLE_REPLIES, exact_replies=UNANSWERABLE_REPLIES_EXACT, cache_size=2**16):
+        self.exact_replies = frozenset(exact_replies) | frozenset(f"{reply}." for reply in exact_replies)
+        # longest first, so the alternation doesn't stop at a reply that is a prefix of another one
+        self.pattern = re.compile("|".join(re.escape(reply) for reply in sorted(set(replies), key=len, reverse=True)))
+        self._cached_match = lru_cache(maxsize=cache_size)(self._match)
+
+    @staticmethod
+    def normalize(reply):
+        return str(reply).lower().strip()
+
+    def _match(self, reply):
+        reply = self.normalize(reply)
+        return reply in self.exact_replies or self.pattern.search(reply) is not None
+
+    def __call__(self, reply):
+        """Whether a single reply is unanswerable."""
+        try:
+            return self._cached_match(reply)
+        except TypeError: # unhashable reply
+            return self._match(reply)
+
+    def match(self, replies):
+        """
+        Whether each of the replies is unanswerable.
+        replies: a list (or any iterable), a numpy array (of any shape) or a pandas Series
+        returns: a boolean numpy array (of the same shape), or a boolean pandas Series (with the same index) for a Series
+        """
+        if isinstance(replies, pd.Series):
+            return pd.Series(self.match(replies.to_numpy(dtype=object)), index=replies.index)
+        if isinstance(replies, np.ndarray):
+            if replies.dtype.kind in "US":
+                unique_replies, inverse = np.unique(replies, return_inverse=True)
+                return np.array([self._match(reply) for reply in unique_replies], dtype=bool)[inverse.reshape(-1)].reshape(replies.shape)
+            return self.match(replies.reshape(-1).tolist()).reshape(replies.shape)
+        replies = replies if isinstance(replies, list) else list(replies)
+        matches = {reply: self._match(reply) for reply in set(replies)}
+        return np.fromiter((matches[reply] for reply in replies), dtype=bool, count=len(replies))
+
+    def match_any(self, replies_per_instance):
+        """
+        Whether any of each instance's replies (e.g., its beams' outputs) is unanswerable.
+        replies_per_instance: a list of lists of replies (not necessarily of the same length), or an (instances, replies) array
+        returns: a boolean numpy array with an element per instance
+        """
+        if isinstance(replies_per_instance, np.ndarray):
+            return self.match(replies_per_instance).reshape(len(replies_per_instance), -1).any(axis=1)
+        lengths = np.array([len(replies) for replies in replies_per_instance], dtype=np.int64)
+        matches = self.match([reply for replies in replies_per_instance for reply in replies])
+        # number of matches up to the start of each instance's replies
+        matches_cumsum = np.concatenate(([0], np.cumsum(matches)))
+        ends = np.cumsum(lengths)
+        return matches_cumsum[ends] > matches_cumsum[ends - lengths]
+
+
+ABSTENTION_MATCHER = AbstentionMatcher()
+
+def is_unanswerable(reply):
+    return ABSTENTION_MATCHER(reply)
+
+def are_unanswerable(replies):
+    return ABSTENTION_MATCHER.match(replies)
+
+def any_unanswerable(replies_per_instance):
+    return ABSTENTION_MATCHER.match_any(replies_per_instance)
@@ -0,0 +1,483 @@
+"""
+Columnar, memory-mapped storage of the generation artifacts.
+
+A columnar artifact is a directory named like the original pt file, with the ".cols" suffix
+(e.g., "un-answerable_squad_test.cols"), holding:
+    meta.json                                   - the layout (number of instances, text columns, tensor fields)
+    text/<column>.json                          - the text/ids sidecar table, one json list per column
+                                                  (the generated outputs of prompt type P are saved under "P.outputs", and the
+                                                  beams' sequence scores, if saved, under "P.sequences_scores")
+    tensors/<prompt_type>/<field>.values.npy    - the rows of all the (instance, beam) segments of the field, concatenated
+                                                  (generation steps after the EOS are dropped)
+    tensors/<prompt_type>/<field>.offsets.npy   - the start row of every (instance, beam) segment (plus the total number of rows)
+                                                  (the fields with a single row per instance, like layers_first_tkn_embedding -
+                                                  the first generated token's state at every captured layer, have a single
+                                                  (layers, d) row per instance)
+The float tensors are saved in float16 by default. They can also be saved in float32, in bfloat16 (as the upper 16 bits of the float32),
+or in int8 with a per-row scale (<field>.scales.npy), and the values can be compressed in blocks of rows (<field>.values.zlib,
+with the byte offsets of the blocks in <field>.blocks.npy) - such tensors are decoded lazily, only for the rows that are read.
+"""
+import os
+import json
+import shutil
+import time
+import resource
+import inspect
+import logging
+import zlib
+from contextlib import contextmanager
+import numpy as np
+import torch
+
+# Set the logging level to INFO
+logging.basicConfig(level=logging.INFO)
+
+COLUMNAR_SUFFIX = ".cols"
+OUTPUTS_SUFFIX = ".outputs"
+SCORES_FIELD = "sequences_scores"
+FORMAT_VERSION = 1
+OUTPUT_FORMATS = ["pt", "columnar"]
+TENSOR_FIELDS = ["all_outputs_ids", "full_logits", "last_hidden_embedding", "first_hidden_embedding", "layers_first_tkn_embedding"]
+SINGLE_ROW_FIELDS = ["first_hidden_embedding", "layers_first_tkn_embedding"] # a single row per instance (not per generation step)
+EOS_ID = 1 # the first position whose id is 1 marks the end of the generation (EOS in Flan models, padding in OPT-IML)
+STORAGE_DTYPES = ["float16", "bfloat16", "int8", "float32"]
+STORAGE_RAW_DTYPES = {"float16": np.float16, "bfloat16": np.uint16, "int8": np.int8, "float32": np.float32}
+COMPRESSIONS = ["zlib"]
+COMPRESSION_BLOCK_ROWS = 256
+
+
+def get_artifact_path(pt_path, output_format):
+    if output_format == "pt":
+        return pt_path
+    elif output_format == "columnar":
+        return f"{get_artifact_stem(pt_path)}{COLUMNAR_SUFFIX}"
+    else:
+        raise Exception(f"unrecognized output format: {output_format} (only one of {OUTPUT_FORMATS})")
+
+def get_artifact_stem(name):
+    for suffix in [".pt", COLUMNAR_SUFFIX]:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def is_artifact(name):
+    return name.endswith(".pt") or name.endswith(COLUMNAR_SUFFIX)
+
+def _select_artifacts(files, dirs):
+    columnar_dirs = sorted(d for d in dirs if d.endswith(COLUMNAR_SUFFIX))
+    # a pt file that was already converted is skipped
+    pt_files = [name for name in sorted(files) if name.endswith(".pt") and not get_artifact_path(name, "columnar") in columnar_dirs]
+    return pt_files + columnar_dirs
+
+def list_artifacts(indir):
+    """Return the names of the pt files and columnar artifacts directly under indir."""
+    names = os.listdir(indir)
+    files = [name for name in names if os.path.isfile(os.path.join(indir, name))]
+    dirs = [name for name in names if os.path.isdir(os.path.join(indir, name))]
+    return _select_artifacts(files, dirs)
+
+def walk_artifacts(indir):
+    """Like os.walk, but yields (subdir, artifact_name) for every pt file and columnar artifact under indir."""
+    for subdir, dirs, files in os.walk(indir):
+        artifact_names = _select_artifacts(files, dirs)
+        # don't descend into the columnar artifacts themselves
+        dirs[:] = [d for d in dirs if not d.endswith(COLUMNAR_SUFFIX)]
+        for name in artifact_names:
+            yield subdir, name
+
+def save_responses(responses, pt_path, output_format="pt", storage_dtype="float16", compression=None):
+    """Save the responses of a generation run either as a single pt file, or as a columnar artifact next to where the pt file would have been (see save_columnar for storage_dtype and compression)."""
+    outpath = get_artifact_path(pt_path, output_format)
+    if output_format == "pt":
+        torch.save(responses, outpath)
+    else:
+        save_columnar(responses, outpath, storage_dtype=storage_dtype, compression=compression)
+    return outpath
+
+def _to_numpy(tensor):
+    tensor = tensor.detach().to("cpu")
+    if tensor.dtype == torch.bfloat16: # numpy has no bfloat16
+        tensor = tensor.float()
+    return tensor.numpy()
+
+def _get_eos_filter_index(ids, n_steps):
+    # Get the first index where value is 1 (if no 1 then no "padding" and so can take all steps)
+    matches = np.flatnonzero(ids == EOS_ID)
+    return min(int(matches[0]), n_steps) if len(matches) else n_steps
+
+def _get_beams(instance, field):
+    """Return the field of the instance as a list with one numpy array per beam (steps x dim for the generation-steps fields)."""
+    value = instance[field]
+    if field == "all_outputs_ids":
+        ids = _to_numpy(value)
+        return [ids[beam_i] for beam_i in range(ids.shape[0])]
+    if field == "first_hidden_embedding": # a single (input-averaged) vector per instance
+        value = _to_numpy(value)
+        return [value.reshape(1, -1) if value.ndim == 1 else value.mean(axis=0, keepdims=True)]
+    if field == "layers_first_tkn_embedding": # a single (layers, d) block per instance (of the first beam)
+        return [_to_numpy(value)[None]]
+    if torch.is_tensor(value): # a single steps x dim matrix
+        value = [value]
+    if len(value) == 0:
+        return []
+    if value[0].dim() == 1: # a list of the generation steps of a single beam (few-shot format)
+        return [_to_numpy(torch.stack(value))]
+    return [_to_numpy(beam) for beam in value]
+
+def _get_segments(instances, field):
+    """Return a list with all the (instance, beam) segments of the field, and the number of beams per instance."""
+    segments, beams_per_instance = [], None
+    for instance in instances:
+        beams = _get_beams(instance, field)
+        if field == "all_outputs_ids":
+            beams = [ids[:_get_eos_filter_index(ids, len(ids)-1)+1] for ids in beams]
+        elif not field in SINGLE_ROW_FIELDS and "all_outputs_ids" in instance.keys():
+            all_ids = _get_beams(instance, "all_outputs_ids")
+            beams = [beam[:_get_eos_filter_index(all_ids[beam_i], len(beam))] if beam_i < len(all_ids) else beam for beam_i, beam in enumerate(beams)]
+        if beams_per_instance is None:
+            beams_per_instance = len(beams)
+        elif beams_per_instance != len(beams):
+            raise Exception(f"all instances must have the same number of beams in {field} (got {beams_per_instance} and {len(beams)})")
+        segments.extend(beams)
+    return segments, beams_per_instance
+
+def encode_rows(rows, storage_dtype):
+    """Encode float rows to the storage dtype. Returns the encoded rows and their per-row scales (only for int8, otherwise None)."""
+    rows = np.ascontiguousarray(rows, dtype=np.float32)
+    if storage_dtype in ["float16", "float32"]:
+        return rows.astype(storage_dtype), None
+    elif storage_dtype == "bfloat16": # round to nearest even, and keep the upper 16 bits
+        bits = rows.view(np.uint32).astype(np.uint64)
+        return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16), None
+    elif storage_dtype == "int8":
+        flat_rows = rows.reshape(len(rows), int(np.prod(rows.shape[1:])))
+        scales = np.where(np.isfinite(flat_rows), np.abs(flat_rows), 0).max(axis=1, initial=0) / 127
+        scales[scales == 0] = 1.0
+        quantized = np.nan_to_num(flat_rows / scales[:, None], nan=0.0, posinf=127, neginf=-127)
+        return np.clip(np.rint(quantized), -127, 127).astype(np.int8).reshape(rows.shape), scales.astype(np.float32)
+    else:
+        raise Exception(f"unrecognized storage dtype: {storage_dtype} (only one of {STORAGE_DTYPES})")
+
+def decode_rows(encoded, storage_dtype, scales=None):
+    """Decode rows saved in the storage dtype (see encode_rows)."""
+    if storage_dtype == "bfloat16":
+        return (np.asarray(encoded).astype(np.uint32) << 16).view(np.float32)
+    elif storage_dtype == "int8":
+        return np.asarray(encoded).astype(np.float32) * np.asarray(scales).reshape((-1,) + (1,) * (np.ndim(encoded)-1))
+    return encoded
+
+def get_fields_storage_dtype(hidden_states_storage_dtype, logits_storage_dtype):
+    return {"last_hidden_embedding": hidden_states_storage_dtype,
+            "first_hidden_embedding": hidden_states_storage_dtype,
+            "layers_first_tkn_embedding": hidden_states_storage_dtype,
+            "full_logits": logits_storage_dtype}
+
+def _get_storage_dtype(storage_dtype, field):
+    # storage_dtype is either a single dtype, or a dict of the dtype of each field
+    return storage_dtype.get(field, "float16") if isinstance(storage_dtype, dict) else storage_dtype
+
+def _compress_values(values_path, compressed_path, blocks_path):
+    values = np.load(values_path, mmap_mode="r")
+    block_offsets = [0]
+    with open(compressed_path, 'wb') as f1:
+        for block_start in range(0, len(values), COMPRESSION_BLOCK_ROWS):
+            compressed_block = zlib.compress(np.ascontiguousarray(values[block_start:block_start+COMPRESSION_BLOCK_ROWS]).tobytes(), 1)
+            f1.write(compressed_block)
+            block_offsets.append(block_offsets[-1] + len(compressed_block))
+    np.save(blocks_path, np.array(block_offsets, dtype=np.int64))
+    del values
+    os.remove(values_path)
+
+def _write_segments(segments, outdir, field, storage_dtype, compression):
+    lengths = np.array([len(segment) for segment in segments], dtype=np.int64)
+    offsets = np.zeros(len(segments)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    shape = (int(offsets[-1]),) + segments[0].shape[1:]
+    is_ids = field == "all_outputs_ids"
+    if not is_ids and not storage_dtype in STORAGE_DTYPES:
+        raise Exception(f"unrecognized storage dtype: {storage_dtype} (only one of {STORAGE_DTYPES})")
+    dtype = np.dtype(np.int32) if is_ids else np.dtype(STORAGE_RAW_DTYPES[storage_dtype])
+    values_path = os.path.join(outdir, f"{field}.values.npy")
+    if shape[0] == 0: # can't memory-map an empty file
+        np.save(values_path, np.zeros(shape, dtype=dtype))
+        compression = None
+    else:
+        values = np.lib.format.open_memmap(values_path, mode="w+", dtype=dtype, shape=shape)
+        scales = np.ones(shape[0], dtype=np.float32)
+        for i, segment in enumerate(segments):
+            if is_ids:
+                values[offsets[i]:offsets[i+1]] = segment
+            else:
+                values[offsets[i]:offsets[i+1]], segment_scales = encode_rows(segment, storage_dtype)
+                if segment_scales is not None:
+                    scales[offsets[i]:offsets[i+1]] = segment_scales
+        values.flush()
+        del values
+        if storage_dtype == "int8" and not is_ids:
+            np.save(os.path.join(outdir, f"{field}.scales.npy"), scales)
+        if compression == "zlib":
+            _compress_values(values_path, os.path.join(outdir, f"{field}.values.zlib"), os.path.join(outdir, f"{field}.blocks.npy"))
+        elif compression is not None:
+            raise Exception(f"unrecognized compression: {compression} (only one of {COMPRESSIONS})")
+    np.save(os.path.join(outdir, f"{field}.offsets.npy"), offsets)
+    return {"dtype": dtype.name,
+            "storage_dtype": "int32" if is_ids else storage_dtype,
+            "compression": compression,
+            "row_shape": list(shape[1:]),
+            "n_rows": shape[0]}
+
+def _write_prompt_type_tensors(instances, outdir, storage_dtype, compression):
+    fields_meta = dict()
+    for field in TENSOR_FIELDS:
+        if not field in instances[0].keys():
+            continue
+        segments, beams_per_instance = _get_segments(instances, field)
+        if not segments:
+            continue
+        os.makedirs(outdir, exist_ok=True)
+        fields_meta[field] = _write_segments(segments, outdir, field, _get_storage_dtype(storage_dtype, field), compression)
+        fields_meta[field]["beams_per_instance"] = beams_per_instance
+    return fields_meta
+
+def _write_text_column(outdir, column, values):
+    with open(os.path.join(outdir, "text", f"{column}.json"), 'w') as f1:
+        f1.write(json.dumps(values))
+
+def save_columnar(responses, outpath, storage_dtype="float16", compression=None):
+    """
+    Save the responses (a dict of columns, where the prompt types' columns hold a dict per instance) as a columnar artifact.
+    storage_dtype: the dtype of the float tensors - any one of STORAGE_DTYPES, or a dict with the dtype of each field (the rest are saved in float16)
+    compression: None, or "zlib" to compress the tensors in blocks of COMPRESSION_BLOCK_ROWS rows
+    """
+    # write to a temporary directory first, so a crashed run never leaves a partial artifact behind
+    tmp_outpath = f"{outpath}.tmp"
+    if os.path.exists(tmp_outpath):
+        shutil.rmtree(tmp_outpath)
+    os.makedirs(os.path.join(tmp_outpath, "text"))
+
+    meta = {"format_version": FORMAT_VERSION,
+            "n_instances": len(responses["ids"]),
+            "text_columns": [],
+            "prompt_types": {}}
+    for key, value in responses.items():
+        if len(value) > 0 and isinstance(value[0], dict):
+            _write_text_column(tmp_outpath, f"{key}{OUTPUTS_SUFFIX}", [elem["outputs"] for elem in value])
+            meta["text_columns"].append(f"{key}{OUTPUTS_SUFFIX}")
+            meta["prompt_types"][key] = _write_prompt_type_tensors(value, os.path.join(tmp_outpath, "tensors", key), storage_dtype, compression)
+            if SCORES_FIELD in value[0].keys():
+                _write_text_column(tmp_outpath, f"{key}.{SCORES_FIELD}", [[float(score) for score in elem[SCORES_FIELD]] for elem in value])
+                meta.setdefault("scored_prompt_types", []).append(key)
+        else:
+            _write_text_column(tmp_outpath, key, list(value))
+            meta["text_columns"].append(key)
+
+    with open(os.path.join(tmp_outpath, "meta.json"), 'w') as f1:
+        f1.write(json.dumps(meta, indent=2))
+    if os.path.exists(outpath):
+        shutil.rmtree(outpath)
+    os.rename(tmp_outpath, outpath)
+
+
+class RaggedArray:
+    """The rows of all the (instance, beam) segments of a tensor field, with the offsets of each segment."""
+    def __init__(self, values, offsets, beams_per_instance):
+        self.values = values
+        self.offsets = offsets
+        self.beams_per_instance = beams_per_instance
+
+    def __len__(self):
+        return (len(self.offsets)-1) // self.beams_per_instance
+
+    def segment(self, instance_i, beam_i=0):
+        segment_i = instance_i*self.beams_per_instance + beam_i
+        return self.values[self.offsets[segment_i]:self.offsets[segment_i+1]]
+
+    def lengths(self, beam_i=0):
+        return np.diff(self.offsets)[beam_i::self.beams_per_instance]
+
+    def head(self, num_instances):
+        return RaggedArray(self.values, self.offsets[:num_instances*self.beams_per_instance+1], self.beams_per_instance)
+
+    def slice(self, start, end):
+        """The instances in [start, end) (their offsets still point into the same values, so nothing is read)."""
+        return RaggedArray(self.values, self.offsets[start*self.beams_per_instance:end*self.beams_per_instance+1], self.beams_per_instance)
+
+
+class EncodedValues:
+    """The rows of a tensor field saved in bfloat16/int8 and/or in compressed blocks, decoded lazily (to float32) only for the rows that are read."""
+    def __init__(self, field_path, field_meta):
+        self.storage_dtype = field_meta["storage_dtype"]
+        self.shape = tuple([field_meta["n_rows"]] + field_meta["row_shape"])
+        self.dtype = np.dtype(np.int32) if self.storage_dtype == "int32" else np.dtype(np.float32)
+        self._raw_dtype = np.dtype(field_meta["dtype"])
+        self._scales = np.load(f"{field_path}.scales.npy", mmap_mode="r") if self.storage_dtype == "int8" else None
+        if field_meta["compression"] == "zlib":
+            self._raw = None
+            self._compressed = np.memmap(f"{field_path}.values.zlib", dtype=np.uint8, mode="r")
+            self._block_offsets = np.load(f"{field_path}.blocks.npy")
+        else:
+            self._raw = np.load(f"{field_path}.values.npy", mmap_mode="r")
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _get_block(self, block_i):
+        compressed_block = self._compressed[self._block_offsets[block_i]:self._block_offsets[block_i+1]]
+        return np.frombuffer(zlib.decompress(compressed_block.tobytes()), dtype=self._raw_dtype).reshape((-1,) + self.shape[1:])
+
+    def _get_raw_rows(self, rows):
+        if self._raw is not None:
+            return self._raw[rows]
+        raw_rows = np.empty((len(rows),) + self.shape[1:], dtype=self._raw_dtype)
+        blocks = rows // COMPRESSION_BLOCK_ROWS
+        for block_i in np.unique(blocks): # decompress each required block once
+            is_in_block = blocks == block_i
+            raw_rows[is_in_block] = self._get_block(block_i)[rows[is_in_block] - block_i*COMPRESSION_BLOCK_ROWS]
+        return raw_rows
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self[np.array([index])][0]
+        rows = np.arange(*index.indices(len(self))) if isinstance(index, slice) else np.asarray(index)
+        return decode_rows(self._get_raw_rows(rows), self.storage_dtype, None if self._scales is None else self._scales[rows])
+
+    def __array__(self, dtype=None):
+        values = self[0:len(self)]
+        return values if dtype is None else values.astype(dtype)
+
+
+class ColumnarArtifact:
+    """Read access to a columnar artifact - every column is only read when requested, and tensors are memory-mapped."""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r') as f1:
+            self.meta = json.loads(f1.read())
+
+    @property
+    def n_instances(self):
+        return self.meta["n_instances"]
+
+    @property
+    def prompt_types(self):
+        return list(self.meta["prompt_types"].keys())
+
+    @property
+    def text_columns(self):
+        return [column for column in self.meta["text_columns"] if not column.endswith(OUTPUTS_SUFFIX)]
+
+    def fields(self, prompt_type):
+        return list(self.meta["prompt_types"][prompt_type].keys())
+
+    def text(self, column):
+        with open(os.path.join(self.path, "text", f"{column}.json"), 'r') as f1:
+            return json.loads(f1.read())
+
+    def outputs(self, prompt_type):
+        return self.text(f"{prompt_type}{OUTPUTS_SUFFIX}")
+
+    def sequences_scores(self, prompt_type):
+        """The sequence score of each beam of each instance (None if they weren't saved)."""
+        if not prompt_type in self.meta.get("scored_prompt_types", []):
+            return None
+        return self.text(f"{prompt_type}.{SCORES_FIELD}")
+
+    def ragged(self, prompt_type, field):
+        field_meta = self.meta["prompt_types"][prompt_type][field]
+        field_path = os.path.join(self.path, "tensors", prompt_type, field)
+        storage_dtype = field_meta.get("storage_dtype", field_meta["dtype"])
+        if field_meta.get("compression") is not None or storage_dtype in ["bfloat16", "int8"]:
+            values = EncodedValues(field_path, dict(field_meta, storage_dtype=storage_dtype))
+        else:
+            mmap_mode = "r" if field_meta["n_rows"] > 0 else None # can't memory-map an empty file
+            values = np.load(f"{field_path}.values.npy", mmap_mode=mmap_mode)
+        offsets = np.load(f"{field_path}.offsets.npy")
+        return RaggedArray(values, offsets, field_meta["beams_per_instance"])
+
+
+def _get_peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # ru_maxrss is in KiB
+
+@contextmanager
+def log_load_stats(description):
+    start_time = time.time()
+    start_peak_rss = _get_peak_rss_mb()
+    yield
+    peak_rss = _get_peak_rss_mb()
+    logging.info(f"loaded {description} in {time.time()-start_time:.2f}s (peak RSS: {peak_rss:.0f}MiB, +{peak_rss-start_peak_rss:.0f}MiB during load)")
+
+def _ragged_to_instance_values(ragged, field, num_instances):
+    """Convert a ragged field back to the per-instance structure of the pt files."""
+    instance_values = []
+    for instance_i in range(min(len(ragged), num_instances)):
+        beams = [torch.from_numpy(np.array(ragged.segment(instance_i, beam_i))) for beam_i in range(ragged.beams_per_instance)]
+        if field in SINGLE_ROW_FIELDS:
+            instance_values.append(beams[0][0])
+        elif field == "all_outputs_ids":
+            instance_values.append(torch.nn.utils.rnn.pad_sequence(beams, batch_first=True, padding_value=0))
+        else:
+            instance_values.append(beams)
+    return instance_values
+
+def _torch_load_cpu(path):
+    # newer torch versions can memory-map the pt file, so tensors that are not selected are never read
+    if "mmap" in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location="cpu", mmap=True)
+    return torch.load(path, map_location="cpu")
+
+def _load_pt_responses(path, prompt_types, fields, text_columns, num_instances):
+    responses = _torch_load_cpu(path)
+    selected = dict()
+    for key, value in responses.items():
+        is_prompt_type = len(value) > 0 and isinstance(value[0], dict)
+        if is_prompt_type and (prompt_types is None or key in prompt_types):
+            selected[key] = [{name:elem[name] for name in ["outputs"] + list(fields) if name in elem.keys()} for elem in value[:num_instances]]
+        elif not is_prompt_type and (text_columns is None or key in text_columns):
+            selected[key] = value[:num_instances]
+    return selected
+
+def _load_columnar_responses(path, prompt_types, fields, text_columns, num_instances):
+    artifact = ColumnarArtifact(path)
+    num_instances = artifact.n_instances if num_instances is None else num_instances
+    responses = dict()
+    for column in artifact.meta["text_columns"]: # keep the original order of the columns
+        if not column.endswith(OUTPUTS_SUFFIX):
+            if text_columns is None or column in text_columns:
+                responses[column] = artifact.text(column)[:num_instances]
+            continue
+        prompt_type = column[:-len(OUTPUTS_SUFFIX)]
+        if prompt_types is not None and not prompt_type in prompt_types:
+            continue
+        instances = [{"outputs":outputs} for outputs in artifact.outputs(prompt_type)[:num_instances]]
+        if SCORES_FIELD in fields and artifact.sequences_scores(prompt_type) is not None:
+            for instance, scores in zip(instances, artifact.sequences_scores(prompt_type)):
+                instance[SCORES_FIELD] = scores
+        for field in fields:
+            if field == SCORES_FIELD or not field in artifact.fields(prompt_type):
+                continue
+            for instance, value in zip(instances, _ragged_to_instance_values(artifact.ragged(prompt_type, field), field, num_instances)):
+                instance[field] = value
+        responses[prompt_type] = instances
+    return responses
+
+def load_responses(path, prompt_types=None, fields=(), text_columns=None, num_instances=None):
+    """
+    Load an artifact (pt file or columnar) into the responses dict structure of the pt files, on the CPU, materializing only what was requested.
+    path: path to the pt file or columnar artifact
+    prompt_types: which prompt types to load (None - all of them)
+    fields: which tensor fields to load for each instance of the prompt types (e.g., "last_hidden_embedding"), besides the "outputs"
+            (and SCORES_FIELD for the beams' sequence scores)
+    text_columns: which of the other columns to load (e.g., "ids"; None - all of them)
+    num_instances: load only the first num_instances instances (None - all of them)
+    """
+    with log_load_stats(f"{path} (prompt types: {'all' if prompt_types is None else prompt_types}, fields: {list(fields)})"):
+        if path.endswith(COLUMNAR_SUFFIX):
+            return _load_columnar_responses(path, prompt_types, fields, text_columns, num_instances)
+        return _load_pt_responses(path, prompt_types, fields, text_columns, num_instances)
+
+def get_artifact_fields(path):
+    """The tensor fields of each generated prompt type of an artifact ({prompt_type: [fields]}), from the meta of a columnar artifact (or the first instance of a pt file)."""
+    if path.endswith(COLUMNAR_SUFFIX):
+        artifact = ColumnarArtifact(path)
+        return {prompt_type: artifact.fields(prompt_type) for prompt_type in artifact.prompt_types}
+    responses = _torch_load_cpu(path)
+    return {key: [field for field in TENSOR_FIELDS if field in value[0].keys()] for key, value in responses.items() if len(value) > 0 and isinstance(value[0], dict)}
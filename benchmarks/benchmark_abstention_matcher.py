@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import time
+import os
+import argparse
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils import UNANSWERABLE_REPLIES, UNANSWERABLE_REPLIES_EXACT
+from abstention_matcher import AbstentionMatcher
+
+SEED = 42
+
+def legacy_check(response):
+    """The nested any() previously copied across the post-processing, evaluation and plotting scripts (the baseline)."""
+    value = str(response).lower().strip()
+    return any(elem1==value for elem1 in UNANSWERABLE_REPLIES_EXACT) or any(f"{elem1}."==value for elem1 in UNANSWERABLE_REPLIES_EXACT) or any(elem2 in value.lower() for elem2 in UNANSWERABLE_REPLIES)
+
+def get_synthetic_beams(n_instances, k_beams, n_distinct_answers, unanswerable_ratio):
+    """Beam outputs drawn from a pool of answers and (differently cased/punctuated) unanswerable replies."""
+    rng = np.random.default_rng(SEED)
+    answers = [f"the answer is entity {i} of the passage" for i in range(n_distinct_answers)]
+    unanswerable = [variant for reply in UNANSWERABLE_REPLIES + UNANSWERABLE_REPLIES_EXACT for variant in [reply, reply.capitalize(), f"{reply}.", f" {reply.upper()} ", f"I think it is {reply}"]]
+    is_unanswerable = rng.random(n_instances * k_beams) < unanswerable_ratio
+    answer_indices = rng.integers(0, len(answers), size=n_instances * k_beams)
+    unanswerable_indices = rng.integers(0, len(unanswerable), size=n_instances * k_beams)
+    flat = [unanswerable[j] if u else answers[i] for u, i, j in zip(is_unanswerable, answer_indices, unanswerable_indices)]
+    return [flat[i*k_beams:(i+1)*k_beams] for i in range(n_instances)]
+
+def timed(func, *args):
+    start_time = time.time()
+    result = func(*args)
+    return result, time.time() - start_time
+
+def main(args):
+    beams = get_synthetic_beams(args.n_instances, args.k_beams, args.n_distinct_answers, args.unanswerable_ratio)
+    flat = [reply for replies in beams for reply in replies]
+    matcher = AbstentionMatcher()
+    print(f"{len(flat)} beam outputs ({args.n_instances} instances x {args.k_beams} beams, {args.n_distinct_answers} distinct answers)")
+
+    legacy_result, legacy_time = timed(lambda: np.array([legacy_check(reply) for reply in flat]))
+    single_result, single_time = timed(lambda: np.array([matcher(reply) for reply in flat]))
+    list_result, list_time = timed(matcher.match, flat)
+    array_result, array_time = timed(matcher.match, np.array(flat))
+    series = pd.Series(flat)
+    series_result, series_time = timed(matcher.match, series)
+    assert (legacy_result == single_result).all() and (legacy_result == list_result).all() and (legacy_result == array_result).all() and (legacy_result == series_result.to_numpy()).all()
+
+    legacy_any, legacy_any_time = timed(lambda: np.array([any(legacy_check(reply) for reply in replies) for replies in beams]))
+    any_result, any_time = timed(matcher.match_any, beams)
+    assert (legacy_any == any_result).all()
+
+    print(f"{'legacy any()':>22}: {legacy_time:.3f}s ({len(flat)/legacy_time/1e6:.2f}M outputs/sec)")
+    for name, curr_time in [("matcher (per reply)", single_time), ("matcher (list)", list_time), ("matcher (array)", array_time), ("matcher (Series)", series_time)]:
+        print(f"{name:>22}: {curr_time:.3f}s ({len(flat)/curr_time/1e6:.2f}M outputs/sec, {legacy_time/curr_time:.1f}x)")
+    print(f"{'beam relaxation':>22}: legacy {legacy_any_time:.3f}s | matcher {any_time:.3f}s ({legacy_any_time/any_time:.1f}x)")
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="benchmark the compiled abstention matcher against the nested any() checks.")
+    argparser.add_argument("--n-instances", type=int, default=500000, help="number of synthetic instances.")
+    argparser.add_argument("--k-beams", type=int, default=5, help="number of beam outputs per instance.")
+    argparser.add_argument("--n-distinct-answers", type=int, default=100000, help="number of distinct (answerable) replies.")
+    argparser.add_argument("--unanswerable-ratio", type=float, default=0.3, help="fraction of unanswerable replies.")
+    args = argparser.parse_args()
+    main(args)
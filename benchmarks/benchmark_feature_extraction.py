@@ -0,0 +1,87 @@
+import numpy as np
+import torch
+import time
+import os
+import shutil
+import tempfile
+import argparse
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from artifact_utils import save_columnar, ColumnarArtifact
+from feature_extraction import AGGREGATION_TYPES, extract_features, extract_ragged_features
+
+SEED = 42
+
+def adapt_hidden_embeddings(instance, embedding_type):
+    """The per-instance loop previously copied across the probing, erasure and plotting scripts (the baseline)."""
+    # if the embeddings of all the generation steps were saved in a single matrix, rather than in a list, separate them
+    if len(instance[embedding_type][-1].shape) == 2:
+        instance[embedding_type] = [instance[embedding_type][0][i,:] for i in range(instance[embedding_type][0].shape[0])]
+    # Compare all elements to 1
+    matches = instance['all_outputs_ids'][0,:].eq(1)
+    # Find the first non-zero element in matches
+    indices = matches.nonzero(as_tuple=True)
+    # Get the first index where value is 1 (if no 1 then no "padding" and so can take all embeddings)
+    filter_index = indices[0][0].item() if indices[0].numel() != 0 else len(instance[embedding_type])
+    return instance[embedding_type][:filter_index]
+
+def loop_features(instances, aggregation_type):
+    if aggregation_type == "average":
+        return np.stack([torch.stack(adapt_hidden_embeddings(elem, "last_hidden_embedding")).mean(dim=0).cpu().numpy() for elem in instances])
+    elif aggregation_type == "union":
+        return np.stack([emb.cpu().numpy() for elem in instances for emb in adapt_hidden_embeddings(elem, "last_hidden_embedding")])
+    else:
+        return np.stack([adapt_hidden_embeddings(elem, "last_hidden_embedding")[0].cpu().numpy() for elem in instances])
+
+def get_synthetic_instances(n_instances, hidden_dim, max_steps, k_beams):
+    """Instances in the zero-shot pt structure: k beams of steps x dim hidden states, and the (T5-like) output ids with an EOS (1) and padding (0)."""
+    rng = np.random.default_rng(SEED)
+    instances = []
+    for _ in range(n_instances):
+        n_steps = max_steps
+        ids = torch.from_numpy(rng.integers(2, 32000, size=(k_beams, n_steps+1)))
+        ids[:, 0] = 0
+        for beam_i in range(k_beams):
+            eos_index = int(rng.integers(1, n_steps+1))
+            ids[beam_i, eos_index] = 1
+            ids[beam_i, eos_index+1:] = 0
+        instances.append({"outputs": ["" for _ in range(k_beams)],
+                          "all_outputs_ids": ids,
+                          "last_hidden_embedding": [torch.from_numpy(rng.standard_normal((n_steps, hidden_dim), dtype=np.float32)) for _ in range(k_beams)]})
+    return instances
+
+def timed(func, *args):
+    start_time = time.time()
+    result = func(*args)
+    return result, time.time() - start_time
+
+def main(args):
+    instances = get_synthetic_instances(args.n_instances, args.hidden_dim, args.max_steps, args.k_beams)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        artifact_path = os.path.join(tmp_dir, "un-answerable_squad_test.cols")
+        save_columnar({"ids": list(range(args.n_instances)), "Regular-Prompt": instances}, artifact_path)
+        ragged = ColumnarArtifact(artifact_path).ragged("Regular-Prompt", "last_hidden_embedding")
+
+        print(f"{args.n_instances} instances, {args.k_beams} beams, up to {args.max_steps} steps, hidden dim {args.hidden_dim}")
+        for aggregation_type in AGGREGATION_TYPES:
+            # the baseline mutates the instances (splitting the steps), so work on shallow copies
+            loop_result, loop_time = timed(loop_features, [dict(elem) for elem in instances], aggregation_type)
+            (padded_result, _), padded_time = timed(extract_features, instances, "last_hidden_embedding", aggregation_type)
+            (ragged_result, _), ragged_time = timed(extract_ragged_features, ragged, aggregation_type)
+
+            assert np.allclose(loop_result, padded_result, atol=1e-5)
+            # the columnar artifact is saved in float16
+            assert np.allclose(loop_result, ragged_result, atol=1e-2, rtol=1e-2)
+            print(f"{aggregation_type:>15}: {len(loop_result)} rows | loop: {loop_time:.3f}s | padded: {padded_time:.3f}s ({loop_time/padded_time:.1f}x) | ragged: {ragged_time:.3f}s ({loop_time/ragged_time:.1f}x)")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="benchmark the vectorized hidden-state feature extraction against the per-instance loops.")
+    argparser.add_argument("--n-instances", type=int, default=2000, help="number of synthetic instances.")
+    argparser.add_argument("--hidden-dim", type=int, default=1024, help="hidden dimension.")
+    argparser.add_argument("--max-steps", type=int, default=20, help="number of generation steps (before the EOS truncation).")
+    argparser.add_argument("--k-beams", type=int, default=1, help="number of beams.")
+    args = argparser.parse_args()
+    main(args)
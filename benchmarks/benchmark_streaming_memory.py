@@ -0,0 +1,56 @@
+import numpy as np
+import time
+import os
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from artifact_utils import STORAGE_DTYPES, COMPRESSIONS, save_columnar, _get_peak_rss_mb
+from feature_extraction import AGGREGATION_TYPES, iter_features
+from benchmark_feature_extraction import get_synthetic_instances
+
+
+def write_artifact(artifact_path, args):
+    """Write the synthetic artifact (in a child process, so the instances don't count towards the peak RSS of the streaming)."""
+    instances = get_synthetic_instances(args.n_instances, args.hidden_dim, args.max_steps, args.k_beams)
+    save_columnar({"ids": list(range(args.n_instances)), "Regular-Prompt": instances}, artifact_path, storage_dtype=args.storage_dtype, compression=args.compression)
+
+def main(args):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        artifact_path = os.path.join(tmp_dir, "un-answerable_squad_test.cols")
+        writer = multiprocessing.Process(target=write_artifact, args=(artifact_path, args))
+        writer.start()
+        writer.join()
+        field_mb = args.n_instances * args.k_beams * args.max_steps * args.hidden_dim * 4 / 2**20
+        print(f"{args.n_instances} instances, {args.k_beams} beams, up to {args.max_steps} steps, hidden dim {args.hidden_dim} ({args.storage_dtype}, compression: {args.compression}) - the decoded field is {field_mb:.0f}MiB")
+
+        for aggregation_type in args.aggregation_types:
+            start_time, start_peak_rss = time.time(), _get_peak_rss_mb()
+            peak_rss, n_rows = [], 0
+            for features, _ in iter_features(artifact_path, "Regular-Prompt", "last_hidden_embedding", aggregation_type, chunk_instances=args.chunk_instances):
+                n_rows += len(features)
+                peak_rss.append(_get_peak_rss_mb())
+            # the peak RSS should stop growing after the first chunks (if a chunk read the rest of the field, it would grow by up to the field's size)
+            growth = peak_rss[-1] - peak_rss[min(1, len(peak_rss)-1)]
+            print(f"{aggregation_type:>15}: {n_rows} rows in {len(peak_rss)} chunks, {time.time() - start_time:.2f}s | peak RSS: {start_peak_rss:.0f}MiB before, {peak_rss[0]:.0f}MiB after the first chunk, {peak_rss[-1]:.0f}MiB after the last (+{growth:.0f}MiB)")
+            if growth > args.max_growth_fraction * field_mb:
+                raise Exception(f"{aggregation_type}: the peak RSS grew by {growth:.0f}MiB across the chunks (more than {args.max_growth_fraction} of the decoded field)")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="check that streaming the features of a (compressed) columnar artifact keeps a flat peak RSS across the chunks.")
+    argparser.add_argument("--n-instances", type=int, default=4000, help="number of synthetic instances.")
+    argparser.add_argument("--hidden-dim", type=int, default=1024, help="dimension of the hidden states.")
+    argparser.add_argument("--max-steps", type=int, default=20, help="number of generation steps of each beam.")
+    argparser.add_argument("--k-beams", type=int, default=1, help="number of beams.")
+    argparser.add_argument("--storage-dtype", type=str, default="int8", choices=STORAGE_DTYPES, help="dtype to store the hidden states in.")
+    argparser.add_argument("--compression", type=str, default="zlib", choices=COMPRESSIONS, help="compression of the stored tensors.")
+    argparser.add_argument("--chunk-instances", type=int, default=64, help="number of instances of each chunk.")
+    argparser.add_argument("--aggregation-types", nargs='+', type=str, default=AGGREGATION_TYPES, help="the aggregations to stream.")
+    argparser.add_argument("--max-growth-fraction", type=float, default=0.25, help="the largest allowed growth of the peak RSS after the first chunk (relative to the size of the decoded field).")
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,58 @@
+import numpy as np
+import os
+import argparse
+import torch
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from leace import LeaceStatistics, fit_leace
+
+SEED = 42
+
+def get_synthetic_data(n_rows, dim, scale, concept_strength):
+    """Correlated features (of norm ~scale) whose mean is shifted along a random direction for the answerable rows (label 1)."""
+    rng = np.random.default_rng(SEED)
+    y = (rng.random(n_rows) < 0.5).astype(np.float64)
+    mixing = rng.standard_normal((dim, dim)) / np.sqrt(dim)
+    direction = rng.standard_normal(dim)
+    X = (rng.standard_normal((n_rows, dim)) @ mixing + concept_strength * y[:, None] * direction / np.linalg.norm(direction)) * scale
+    return X.astype(np.float32), y
+
+def get_artifacts_data(indir, prompt_type, dataset, num_instances, aggregation_type):
+    from train_concept_eraser import iter_data
+    chunks = list(iter_data(indir, prompt_type, dataset, num_instances, aggregation_type, chunk_instances=256))
+    return np.concatenate([X for X, _ in chunks]).astype(np.float32), np.concatenate([y for _, y in chunks])
+
+def compare(name, X, y, tol):
+    from concept_erasure import ConceptEraser # the estimator of the former eraser.pkl files (see subspace_erasure.yml)
+    stats = LeaceStatistics()
+    stats.update(X, y)
+    erased = fit_leace(stats)(torch.from_numpy(X)).numpy()
+    reference = ConceptEraser.fit(torch.from_numpy(X), torch.from_numpy(y).float())(torch.from_numpy(X)).numpy()
+    max_diff = np.abs(erased - reference).max()
+    relative_diff = max_diff / np.abs(reference).max()
+    # the concept is erased if the class means of the erased features are the same
+    mean_gap = np.linalg.norm(erased[y > 0].mean(axis=0) - erased[y == 0].mean(axis=0))
+    print(f"{name}: max abs diff: {max_diff:.3g} (relative: {relative_diff:.3g}), class mean gap after erasure: {mean_gap:.3g}")
+    if relative_diff > tol:
+        raise Exception(f"{name}: the erased features differ from concept_erasure's by {relative_diff:.3g} (relative) > {tol}")
+
+def main(args):
+    if args.indir is not None:
+        compare(f"{args.indir} ({args.dataset}, {args.prompt_type})", *get_artifacts_data(args.indir, args.prompt_type, args.dataset, args.num_instances, args.aggregation_type), args.tol)
+        return
+    # small and large features (the absolute svd_tol), and a concept that dominates the covariance (the trace constraint)
+    for scale, concept_strength in [(1.0, 1.0), (0.01, 1.0), (1.0, 20.0), (30.0, 5.0)]:
+        compare(f"synthetic (n={args.n_rows}, d={args.dim}, scale={scale}, concept strength={concept_strength})", *get_synthetic_data(args.n_rows, args.dim, scale, concept_strength), args.tol)
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="check that the erasers fitted by leace.py from the streamed statistics erase the features like concept_erasure's ConceptEraser.fit (the former eraser.pkl).")
+    argparser.add_argument("--n-rows", type=int, default=2000, help="number of synthetic rows.")
+    argparser.add_argument("--dim", type=int, default=64, help="dimension of the synthetic features.")
+    argparser.add_argument("--tol", type=float, default=1e-3, help="the largest allowed difference of the erased features (relative to their largest absolute value).")
+    argparser.add_argument("-i", "--indir", type=str, default=None, help="check on the features of the artifacts in this dir instead (like train_concept_eraser.py).")
+    argparser.add_argument("--dataset", type=str, default="squad", help="(--indir) the dataset.")
+    argparser.add_argument("--prompt-type", type=str, default="Regular-Prompt", help="(--indir) the prompt type.")
+    argparser.add_argument("--num-instances", type=int, default=1000, help="(--indir) number of instances of each artifact.")
+    argparser.add_argument("--aggregation-type", type=str, default="only_first", help="(--indir) the aggregation of the hidden states.")
+    args = argparser.parse_args()
+    main(args)
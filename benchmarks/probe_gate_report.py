@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+import os
+import json
+import argparse
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from artifact_utils import list_artifacts, load_responses, _get_eos_filter_index
+from abstention_matcher import are_unanswerable
+from run_manifest import get_run_config, get_run_subdirs
+from probe_gate import PROBE_GATE_SUFFIX, get_probe_gate_path
+
+DATASETS = ["squad", "NQ", "musique"]
+
+
+def get_decoding_steps(instances):
+    """The number of decoding steps of each instance (of its longest beam, up to the EOS), or None if the ids weren't saved."""
+    if not instances or not "all_outputs_ids" in instances[0].keys():
+        return None
+    return np.array([max(_get_eos_filter_index(ids.numpy(), len(ids)) for ids in instance["all_outputs_ids"]) for instance in instances])
+
+def get_abstentions(instances):
+    return are_unanswerable(np.array([instance["outputs"][0] for instance in instances], dtype=object))
+
+def get_unanswerability_metrics(unanswerable_abstentions, answerable_abstentions):
+    """The F1 of the un-answerable class, the accuracy, and the rate of the (false) abstentions on the answerable instances."""
+    tp, fp = unanswerable_abstentions.sum(), answerable_abstentions.sum()
+    fn = len(unanswerable_abstentions) - tp
+    return {"unanswerable F1": round(100 * 2 * tp / max(2 * tp + fp + fn, 1), 1),
+            "accuracy": round(100 * (tp + len(answerable_abstentions) - fp) / (len(unanswerable_abstentions) + len(answerable_abstentions)), 1),
+            "answerable abstentions": round(100 * fp / len(answerable_abstentions), 1)}
+
+def get_artifact_pair(subdir, dataset):
+    """The un-answerable and the answerable artifacts of the dataset in the subdir."""
+    pair = dict()
+    for file_name in list_artifacts(subdir):
+        if dataset in file_name:
+            pair["un-answerable" if "un-answerable" in file_name else "answerable"] = file_name
+    return pair
+
+def get_generation_time(subdir, files):
+    """The wall-clock time of generating the artifacts (of all their prompt types), as recorded in the run manifest, or None if it wasn't recorded."""
+    times = [(get_run_config(os.path.join(subdir, file_name)) or dict()).get("generation_time") for file_name in files.values()]
+    return None if any(generation_time is None for generation_time in times) else round(sum(times), 1)
+
+def compare_subdir(gated_subdir, reference_subdir, dataset):
+    gated_files, reference_files = get_artifact_pair(gated_subdir, dataset), get_artifact_pair(reference_subdir, dataset)
+    if len(gated_files) < 2 or len(reference_files) < 2:
+        return []
+    gate_summaries = dict()
+    for data_type, file_name in gated_files.items():
+        if not os.path.exists(get_probe_gate_path(os.path.join(gated_subdir, file_name))):
+            return []
+        with open(get_probe_gate_path(os.path.join(gated_subdir, file_name)), 'r') as f1:
+            gate_summaries[data_type] = json.loads(f1.read())
+
+    rows = []
+    for prompt_type in gate_summaries["un-answerable"]["prompt_types"].keys():
+        gated_responses = {data_type: load_responses(os.path.join(gated_subdir, file_name), prompt_types=[prompt_type], fields=("all_outputs_ids",), text_columns=[])[prompt_type] for data_type, file_name in gated_files.items()}
+        reference_responses = {data_type: load_responses(os.path.join(reference_subdir, file_name), prompt_types=[prompt_type], fields=("all_outputs_ids",), text_columns=[])[prompt_type] for data_type, file_name in reference_files.items()}
+        row = {"subdir": gated_subdir, "dataset": dataset, "prompt type": prompt_type, "threshold": gate_summaries["un-answerable"]["threshold"]}
+
+        # compute: the decoding steps of the reference, against a single (gating) step per instance and the decoding of the rest
+        gated = {data_type: np.array(summary["prompt_types"][prompt_type]["gated"]) for data_type, summary in gate_summaries.items()}
+        row["gated (%)"] = round(100 * sum(curr_gated.sum() for curr_gated in gated.values()) / sum(len(curr_gated) for curr_gated in gated.values()), 1)
+        row["gated un-answerable (%)"] = round(100 * gated["un-answerable"].mean(), 1)
+        row["gated answerable (%)"] = round(100 * gated["answerable"].mean(), 1)
+        reference_steps = [get_decoding_steps(reference_responses[data_type]) for data_type in gated.keys()]
+        gated_steps = [get_decoding_steps(gated_responses[data_type]) for data_type in gated.keys()]
+        if not any(steps is None for steps in reference_steps + gated_steps):
+            row["decoding steps (reference)"] = int(sum(steps.sum() for steps in reference_steps))
+            row["decoding steps (gated)"] = int(sum(len(steps) + steps[~curr_gated].sum() for steps, curr_gated in zip(gated_steps, gated.values())))
+            row["decoding steps saved (%)"] = round(100 * (1 - row["decoding steps (gated)"] / row["decoding steps (reference)"]), 1)
+        # the prompts' prefill (the encoder pass of the encoder-decoder models) - once per instance in the reference, and in
+        # the gated run also again for the kept instances unless their encoder outputs were reused (summaries without the count didn't reuse them)
+        row["prefilled prompts (reference)"] = int(sum(len(curr_gated) for curr_gated in gated.values()))
+        row["prefilled prompts (gated)"] = int(sum(summary["prompt_types"][prompt_type].get("prefill_passes", len(curr_gated) + (~curr_gated).sum()) for summary, curr_gated in zip(gate_summaries.values(), gated.values())))
+        row["time (gated, s)"] = round(sum(summary["prompt_types"][prompt_type]["gate_time"] + summary["prompt_types"][prompt_type]["decoding_time"] for summary in gate_summaries.values()), 1)
+        # the wall-clock time of the whole artifacts (all their prompt types), as recorded in the run manifests
+        reference_time, gated_time = get_generation_time(reference_subdir, reference_files), get_generation_time(gated_subdir, gated_files)
+        if reference_time is not None and gated_time is not None:
+            row["artifacts time (reference, s)"], row["artifacts time (gated, s)"] = reference_time, gated_time
+            row["artifacts time saved (%)"] = round(100 * (1 - gated_time / reference_time), 1) if reference_time > 0 else None
+
+        # the metrics of the reference and of the gated run (and the agreement of the replies that were decoded in both)
+        reference_abstentions = {data_type: get_abstentions(instances) for data_type, instances in reference_responses.items()}
+        gated_abstentions = {data_type: get_abstentions(instances) for data_type, instances in gated_responses.items()}
+        reference_metrics = get_unanswerability_metrics(reference_abstentions["un-answerable"], reference_abstentions["answerable"])
+        gated_metrics = get_unanswerability_metrics(gated_abstentions["un-answerable"], gated_abstentions["answerable"])
+        for metric in reference_metrics.keys():
+            row[f"{metric} (reference)"] = reference_metrics[metric]
+            row[f"{metric} (gated)"] = gated_metrics[metric]
+            row[f"{metric} (delta)"] = round(gated_metrics[metric] - reference_metrics[metric], 1)
+        kept_agreement = [gated_instance["outputs"][0] == reference_instance["outputs"][0] for data_type in gated.keys() for gated_instance, reference_instance, is_gated in zip(gated_responses[data_type], reference_responses[data_type], gated[data_type]) if not is_gated]
+        row["agreement of the decoded replies (%)"] = round(100 * float(np.mean(kept_agreement)), 1) if kept_agreement else None
+        rows.append(row)
+    return rows
+
+def main(args):
+    rows = []
+    for gated_subdir in get_run_subdirs(args.gated_indir):
+        reference_subdir = os.path.join(args.reference_indir, os.path.relpath(gated_subdir, args.gated_indir))
+        if not os.path.isdir(reference_subdir):
+            print(f"no reference for {gated_subdir} (expected {reference_subdir}). skipping...")
+            continue
+        for dataset in DATASETS:
+            rows.extend(compare_subdir(gated_subdir, reference_subdir, dataset))
+    if not rows:
+        raise Exception(f"no probe-gated artifacts (with a {PROBE_GATE_SUFFIX} summary) with a reference were found in {args.gated_indir}")
+
+    results_df = pd.DataFrame(rows).set_index(["subdir", "dataset", "prompt type"])
+    print(f"Probe gate ({args.gated_indir}) against full decoding ({args.reference_indir}):")
+    print(results_df.T.to_string())
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+        results_df.to_csv(os.path.join(args.outdir, "probe_gate_report.csv"))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="report the compute saved by --probe-gate of zero_shot_prompting.py, and the change in the unanswerability metrics, against a run with the same arguments but without the gate.")
+    argparser.add_argument('--gated-indir', type=str, required=True, help='outdir of the run with --probe-gate.')
+    argparser.add_argument('--reference-indir', type=str, required=True, help='outdir of the run without it (with the same arguments otherwise).')
+    argparser.add_argument('-o', '--outdir', type=str, default=None, help='path to outdir (to also save the report as a csv)')
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import os
+import argparse
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from projection import PROJECTION_METHODS, fit_pca_projection, get_random_projection, project
+from train_linear_classifiers import SEED, get_data
+
+def main(args):
+    # the reference features are the full-width ones in the artifacts (so run it on artifacts saved without --projection)
+    unanswerable_instances, answerable_instances = get_data(indir=args.indir,
+                                                            prompt_type=args.prompt_type,
+                                                            embedding_type=args.embedding_type,
+                                                            dataset=args.dataset,
+                                                            num_instances=args.num_instances,
+                                                            aggregation_type=args.aggregation_type)
+    X = np.concatenate((unanswerable_instances, answerable_instances)).astype(np.float32)
+    y = np.concatenate((np.zeros(len(unanswerable_instances)), np.ones(len(answerable_instances))))
+    train_indices, test_indices = train_test_split(np.arange(len(y)), test_size=0.2, random_state=SEED)
+    # the PCA is fitted on a calibration subset of the train rows only
+    rng = np.random.default_rng(SEED)
+    calibration_indices = rng.choice(train_indices, min(args.n_calibration_rows, len(train_indices)), replace=False)
+
+    results = []
+    for method, k in [("full", X.shape[1])] + [(method, k) for method in args.methods for k in sorted(args.k_values) if k < X.shape[1]]:
+        if method == "full":
+            projected = X
+        else:
+            projection = fit_pca_projection(X[calibration_indices], k, SEED) if method == "pca" else get_random_projection(X.shape[1], k, SEED)
+            projected = project(X, projection)
+
+        clf = LogisticRegression(random_state=SEED, C=args.C, penalty='l2', solver='liblinear', max_iter=1000)
+        clf.fit(projected[train_indices], y[train_indices])
+        predictions = clf.predict(projected[test_indices])
+        results.append({"method": method,
+                        "k": k,
+                        "bytes per row (float16)": 2 * k,
+                        "probe accuracy": round(100 * float((predictions == y[test_indices]).mean()), 2)})
+
+    results_df = pd.DataFrame(results).set_index(["method", "k"])
+    print(f"Probe accuracy vs. k of {args.embedding_type} ({args.dataset}, {args.prompt_type}, {args.aggregation_type}, {len(X)} rows of dim {X.shape[1]}):")
+    print(results_df.to_string())
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+        results_df.to_csv(os.path.join(args.outdir, f"{args.dataset}_{args.prompt_type}_{args.embedding_type}_projection_report.csv"))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="report the probe accuracy when the hidden states are projected to k dimensions (see projection.py).")
+    argparser.add_argument('-i', '--indir', type=str, required=True, help='path to data')
+    argparser.add_argument('-o', '--outdir', type=str, default=None, help='path to outdir (to also save the report as a csv)')
+    argparser.add_argument('--dataset', type=str, default="squad", help='prompt type to classify ("squad", "NQ", "musique")')
+    argparser.add_argument('--prompt-type', type=str, default="Regular-Prompt", help='prompt type to classify ("Regular-Prompt", "Hint-Prompt", "CoT-Prompt", "Answerability")')
+    argparser.add_argument('--num-instances', type=int, default=None, help='number of instances to use (will take the same amount from the answerable and the un-answerable). If None - will take all.')
+    argparser.add_argument('--aggregation-type', type=str, default="only_first_tkn", help='how to aggregate all the hidden layers of all the generated tokens of a single instance ("average", "union" or "only_first_tkn").')
+    argparser.add_argument('--embedding-type', type=str, default="last_hidden_embedding", help='which layer to take: any one of "last_hidden_embedding" and "first_hidden_embedding"')
+    argparser.add_argument('--methods', nargs='+', type=str, default=PROJECTION_METHODS, choices=PROJECTION_METHODS, help='the projections to compare.')
+    argparser.add_argument('--k-values', nargs='+', type=int, default=[64, 128, 256, 512, 1024], help='the dimensions to project to.')
+    argparser.add_argument('--n-calibration-rows', type=int, default=50000, help='the size of the calibration subset (of the train rows) that the PCA is fitted on.')
+    argparser.add_argument('--C', type=float, default=1.0, help='inverse regularization strength of the probe.')
+    args = argparser.parse_args()
+    main(args)
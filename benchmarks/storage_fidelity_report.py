@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import os
+import zlib
+import argparse
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from artifact_utils import STORAGE_DTYPES, encode_rows, decode_rows
+from train_linear_classifiers import SEED, get_data
+
+def main(args):
+    # the reference features are the ones in the artifacts (so run it on pt files saved from the original float32/float16 model outputs)
+    unanswerable_instances, answerable_instances = get_data(indir=args.indir,
+                                                            prompt_type=args.prompt_type,
+                                                            embedding_type=args.embedding_type,
+                                                            dataset=args.dataset,
+                                                            num_instances=args.num_instances,
+                                                            aggregation_type=args.aggregation_type)
+    X = np.concatenate((unanswerable_instances, answerable_instances)).astype(np.float32)
+    y = np.concatenate((np.zeros(len(unanswerable_instances)), np.ones(len(answerable_instances))))
+    train_indices, test_indices = train_test_split(np.arange(len(y)), test_size=0.2, random_state=SEED)
+
+    results, reference_predictions = [], None
+    for storage_dtype in ["float32"] + [dtype for dtype in STORAGE_DTYPES if dtype != "float32"]:
+        encoded, scales = encode_rows(X, storage_dtype)
+        decoded = np.asarray(decode_rows(encoded, storage_dtype, scales), dtype=np.float32)
+
+        clf = LogisticRegression(random_state=SEED, C=args.C, penalty='l2', solver='liblinear', max_iter=1000)
+        clf.fit(decoded[train_indices], y[train_indices])
+        predictions = clf.predict(decoded[test_indices])
+        if reference_predictions is None:
+            reference_predictions = predictions
+
+        stored_bytes = encoded.nbytes + (0 if scales is None else scales.nbytes)
+        compressed_bytes = len(zlib.compress(encoded.tobytes(), 1)) + (0 if scales is None else scales.nbytes)
+        results.append({"storage dtype": storage_dtype,
+                         "bytes per row": stored_bytes / len(X),
+                         "bytes per row (zlib)": compressed_bytes / len(X),
+                         "max abs error": float(np.abs(decoded - X).max()),
+                         "probe accuracy": round(100 * float((predictions == y[test_indices]).mean()), 2),
+                         "agreement with float32 probe": round(100 * float((predictions == reference_predictions).mean()), 2)})
+
+    results_df = pd.DataFrame(results).set_index("storage dtype")
+    print(f"Storage fidelity of {args.embedding_type} ({args.dataset}, {args.prompt_type}, {args.aggregation_type}, {len(X)} rows of dim {X.shape[1]}):")
+    print(results_df.to_string())
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+        results_df.to_csv(os.path.join(args.outdir, f"{args.dataset}_{args.prompt_type}_{args.embedding_type}_storage_fidelity.csv"))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="report the probe accuracy when the hidden states are stored in each of the storage dtypes.")
+    argparser.add_argument('-i', '--indir', type=str, required=True, help='path to data')
+    argparser.add_argument('-o', '--outdir', type=str, default=None, help='path to outdir (to also save the report as a csv)')
+    argparser.add_argument('--dataset', type=str, default="squad", help='prompt type to classify ("squad", "NQ", "musique")')
+    argparser.add_argument('--prompt-type', type=str, default="Regular-Prompt", help='prompt type to classify ("Regular-Prompt", "Hint-Prompt", "CoT-Prompt", "Answerability")')
+    argparser.add_argument('--num-instances', type=int, default=None, help='number of instances to use (will take the same amount from the answerable and the un-answerable). If None - will take all.')
+    argparser.add_argument('--aggregation-type', type=str, default="only_first_tkn", help='how to aggregate all the hidden layers of all the generated tokens of a single instance ("average", "union" or "only_first_tkn").')
+    argparser.add_argument('--embedding-type', type=str, default="last_hidden_embedding", help='which layer to take: any one of "last_hidden_embedding" and "first_hidden_embedding"')
+    argparser.add_argument('--C', type=float, default=1.0, help='inverse regularization strength of the probe.')
+    args = argparser.parse_args()
+    main(args)
@@ -5,27 +5,20 @@ import os
 import pickle
 import argparse
 from sklearn.metrics import classification_report
-import torch
 from datetime import datetime
 from pathlib import Path
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from artifact_utils import list_artifacts
+from feature_cache import DEFAULT_CACHE_MAX_GB, load_cached_features
+from run_manifest import get_run_config, get_run_subdirs
 
 SEED = 42
 
-def adapt_hidden_embeddings(instance):
-    # if the embeddings of all the generation steps were saved in a single matrix, rather than in a list, separate them
-    if len(instance['last_hidden_embedding'][-1].shape) == 2:
-        instance['last_hidden_embedding'] = [instance['last_hidden_embedding'][0][i,:] for i in range(instance['last_hidden_embedding'][0].shape[0])]
-    # removing the paddings
-    # Compare all elements to 1
-    matches = instance['all_outputs_ids'][0,:].eq(1)
-    # Find the first non-zero element in matches
-    indices = matches.nonzero(as_tuple=True)
-    # Get the first index where value is 1 (if no 1 then no "padding" and so can take all embeddings)
-    filter_index = indices[0][0].item() if indices[0].numel() != 0 else len(instance['last_hidden_embedding'])
-    filtered_hidden_embedding = instance['last_hidden_embedding'][:filter_index]
-    return filtered_hidden_embedding
-
 def get_model_name(indir):
+    run_config = get_run_config(indir) # recorded by the generation scripts (None for runs without a run manifest)
+    if run_config is not None and run_config.get("model") is not None:
+        return run_config["model"]
     if "Flan-T5-xxl" in indir:
         return "Flan-T5-xxl"
     elif "Flan-UL2" in indir:
@@ -36,6 +29,9 @@ def get_model_name(indir):
         raise Exception("paths of embeddings must have one of \"Flan-T5-xxl\", \"Flan-UL2\", or \"OPT-IML\".")
 
 def get_curr_variant(indir):
+    run_config = get_run_config(indir)
+    if run_config is not None and run_config.get("variant") is not None:
+        return run_config["variant"]
     if "variant1" in indir:
         return "variant1"
     elif "variant2" in indir:
@@ -45,35 +41,23 @@ def get_curr_variant(indir):
     else:
         raise Exception("paths of embeddings must have one of \"variant1\", \"variant2\", or \"variant3\".")
 
-def get_data(indir, prompt_type, dataset, aggregation_type, embedding_type):
-    data = dict()
-    for file_name in os.listdir(indir):
-        if not dataset in file_name or not file_name.endswith(".pt"):
+def get_data(indir, prompt_type, dataset, aggregation_type, embedding_type, feature_cache_dir=None, feature_cache_max_gb=DEFAULT_CACHE_MAX_GB):
+    data, row_ids = dict(), dict()
+    for file_name in list_artifacts(indir):
+        if not dataset in file_name:
             continue
-        curr_data = torch.load(os.path.join(indir, file_name), map_location="cpu")
         data_type = "un-answerable" if "un-answerable" in file_name else "answerable"
-        data[data_type] = curr_data
+        data[data_type], row_to_instance, ids, _ = load_cached_features(os.path.join(indir, file_name), 
+                                                                        prompt_type=prompt_type, 
+                                                                        embedding_type=embedding_type, 
+                                                                        aggregation_type=aggregation_type, 
+                                                                        cache_dir=feature_cache_dir, 
+                                                                        max_size_gb=feature_cache_max_gb)
+        row_ids[data_type] = [ids[i] for i in row_to_instance]
 
     if not "un-answerable" in data.keys() or not "answerable" in data.keys(): # didn't find the dataset's "answerable" or "un-answerable" tensors
         return None, None, None, None
-    
-    if embedding_type == "first_hidden_embedding":
-        unanswerable_instances = [elem[embedding_type].cpu().numpy() for elem in data["un-answerable"][prompt_type]]
-        answerable_instances = [elem[embedding_type].cpu().numpy() for elem in data["answerable"][prompt_type]]
-    elif aggregation_type == "average":
-        unanswerable_instances = [torch.stack(adapt_hidden_embeddings(elem)).mean(dim=0).cpu().numpy() for elem in data["un-answerable"][prompt_type]]
-        answerable_instances = [torch.stack(adapt_hidden_embeddings(elem)).mean(dim=0).cpu().numpy() for elem in data["answerable"][prompt_type]]
-    elif aggregation_type == "union":
-        unanswerable_instances = [emb.cpu().numpy() for elem in data["un-answerable"][prompt_type] for emb in adapt_hidden_embeddings(elem)]
-        answerable_instances = [emb.cpu().numpy() for elem in data["answerable"][prompt_type] for emb in adapt_hidden_embeddings(elem)]
-    elif aggregation_type == "only_first_tkn":
-        unanswerable_instances = [adapt_hidden_embeddings(elem)[0].cpu().numpy() for elem in data["un-answerable"][prompt_type]]
-        answerable_instances = [adapt_hidden_embeddings(elem)[0].cpu().numpy() for elem in data["answerable"][prompt_type]]
-    else:
-        raise Exception("--aggregation-type did not receive a valid option. Only one of 'average', 'union' or 'only_first_tkn'")
-    unanswerable_ids = data['un-answerable']['ids']
-    answerable_ids = data['answerable']['ids']
-    return unanswerable_instances, answerable_instances, unanswerable_ids, answerable_ids
+    return data["un-answerable"], data["answerable"], row_ids["un-answerable"], row_ids["answerable"]
 
 def main(args):
     label_dict = {0:"unanswerable", 1: "answerable"}
@@ -89,10 +73,10 @@ def main(args):
         datasets = ["musique", "squad", "NQ"]
 
     for indir in tqdm(args.indirs):
-        for subdir, dirs, files in os.walk(indir):
+        for subdir in get_run_subdirs(indir):
             for dataset in datasets:
-                unanswerable_instances, answerable_instances, unanswerable_ids, answerable_ids = get_data(subdir, prompt_type, dataset, aggregation_type=args.aggregation_type, embedding_type=args.embedding_type)
-                if unanswerable_instances == None: # didn't find any of the dataset's "answerable" or "un-answerable" tensors (no dataset in this folder)
+                unanswerable_instances, answerable_instances, unanswerable_ids, answerable_ids = get_data(subdir, prompt_type, dataset, aggregation_type=args.aggregation_type, embedding_type=args.embedding_type, feature_cache_dir=args.feature_cache_dir, feature_cache_max_gb=args.feature_cache_max_gb)
+                if unanswerable_instances is None: # didn't find any of the dataset's "answerable" or "un-answerable" tensors (no dataset in this folder)
                     continue                
 
                 # Combine the instances and create corresponding labels
@@ -144,6 +128,8 @@ if __name__ == '__main__':
     argparser.add_argument('--prompt-type', type=str, default="Regular-Prompt", help='prompt type to classify ("Regular-Prompt", "Hint-Prompt", "CoT-Prompt", "Answerability")')
     argparser.add_argument('--aggregation-type', type=str, default="only_first_tkn", help='how to aggregate all the hidden layers of all the generated tokens of a single instance (choose from "average" to average them, "union" to treat each of them as an instance, and "only_first_tkn" to only take the first token\'s hidden layers).')
     argparser.add_argument('--embedding-type', type=str, default="last_hidden_embedding", help='which layer to take: any one of "last_hidden_embedding" and "first_hidden_embedding"')
+    argparser.add_argument('--feature-cache-dir', type=str, default=None, help='dir of the feature cache (keyed by the artifacts\' content hash), shared with the other probing, erasure and plotting scripts. If None - no caching.')
+    argparser.add_argument('--feature-cache-max-gb', type=float, default=DEFAULT_CACHE_MAX_GB, help='size cap of the feature cache (least recently used entries are evicted).')
     args = argparser.parse_args()
     main(args)
 
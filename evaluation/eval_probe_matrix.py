@@ -0,0 +1,123 @@
+import numpy as np
+from tqdm import tqdm
+import os
+import pickle
+import argparse
+from glob import glob
+import sys
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from artifact_utils import list_artifacts
+from feature_cache import DEFAULT_CACHE_MAX_GB, load_cached_features
+from run_manifest import get_run_subdirs
+from evaluation_utils import get_run_config
+from results_store import RESULTS_DB, ResultsStore, get_probe_heat_map
+
+DATASETS = ["squad", "NQ", "musique"]
+
+
+def get_classifier_config(classifier_path):
+    """The training configuration of a classifier saved by train_linear_classifiers.py or train_probe_batch.py (from its path: <dataset>/<embedding_type>/<prompt_type>/<aggregation_type>/<model>_<N>N/best_model.pkl)."""
+    parts = os.path.normpath(classifier_path).split(os.sep)
+    if len(parts) < 6 or not parts[-6] in DATASETS:
+        return None
+    return {"train_dataset": parts[-6],
+            "embedding_type": parts[-5],
+            "prompt_type": parts[-4],
+            "aggregation_type": parts[-3],
+            "train_model": parts[-2].rsplit("_", 1)[0]}
+
+def load_classifiers(classifier_paths):
+    """
+    Load every classifier once, and group them by their features (prompt type, embedding type, aggregation type, dimension).
+    returns: group -> (the (d, P) coefficients, the (P,) intercepts, the configurations of the P classifiers)
+    """
+    groups = dict()
+    for classifier_path in classifier_paths:
+        config = get_classifier_config(classifier_path)
+        if config is None:
+            print(f"skipping {classifier_path} (not in the layout of train_linear_classifiers.py)")
+            continue
+        with open(classifier_path, "rb") as file:
+            clf = pickle.load(file)
+        if list(clf.classes_) != [0, 1]:
+            raise Exception(f"{classifier_path}: only binary classifiers of 0 (unanswerable) and 1 (answerable) are supported (got {clf.classes_})")
+        group = (config["prompt_type"], config["embedding_type"], config["aggregation_type"], clf.coef_.shape[1])
+        groups.setdefault(group, []).append((clf.coef_[0], float(clf.intercept_[0]), dict(config, classifier=classifier_path)))
+    return {group: (np.stack([coef for coef, _, _ in members], axis=1), np.array([intercept for _, intercept, _ in members]), [config for _, _, config in members]) for group, members in groups.items()}
+
+def get_test_data(subdir, dataset, prompt_type, embedding_type, aggregation_type, feature_cache_dir=None, feature_cache_max_gb=DEFAULT_CACHE_MAX_GB):
+    """The features and labels (0 - un-answerable, 1 - answerable) of the dataset's test instances in the subdir (None if either of the data types is missing)."""
+    data = dict()
+    for file_name in list_artifacts(subdir):
+        if not dataset in file_name:
+            continue
+        data_type = "un-answerable" if "un-answerable" in file_name else "answerable"
+        try:
+            data[data_type], _, _, _ = load_cached_features(os.path.join(subdir, file_name),
+                                                            prompt_type=prompt_type,
+                                                            embedding_type=embedding_type,
+                                                            aggregation_type=aggregation_type,
+                                                            cache_dir=feature_cache_dir,
+                                                            max_size_gb=feature_cache_max_gb)
+        except KeyError: # the prompt type (or the embedding type) wasn't saved in this run
+            return None, None
+    if not "un-answerable" in data.keys() or not "answerable" in data.keys():
+        return None, None
+    X = np.concatenate((data["un-answerable"], data["answerable"]))
+    y = np.concatenate((np.zeros(len(data["un-answerable"]), dtype=bool), np.ones(len(data["answerable"]), dtype=bool)))
+    return X, y
+
+def score_classifiers(X, y, coefs, intercepts):
+    """The accuracy and the F1 of each label of every classifier (with a single matmul for all of them)."""
+    preds = (X @ coefs + intercepts) > 0 # (N, P) - True for answerable
+    tp = (preds & y[:, None]).sum(axis=0) # answerable as answerable
+    tn = (~preds & ~y[:, None]).sum(axis=0) # un-answerable as un-answerable
+    fp = (preds & ~y[:, None]).sum(axis=0)
+    fn = (~preds & y[:, None]).sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        answerable_F1 = np.nan_to_num(2 * tp / (2 * tp + fp + fn))
+        unanswerable_F1 = np.nan_to_num(2 * tn / (2 * tn + fn + fp))
+    return {"accuracy": (tp + tn) / len(y), "unanswerable_F1": unanswerable_F1, "answerable_F1": answerable_F1, "support": np.full(coefs.shape[1], len(y))}
+
+def main(args):
+    outdir_path = args.outdir if args.outdir else "evaluation_results"
+    classifier_paths = sorted(path for classifier_dir in args.classifier_dirs for path in ([classifier_dir] if classifier_dir.endswith(".pkl") else glob(os.path.join(classifier_dir, "**", "best_model.pkl"), recursive=True)))
+    groups = load_classifiers(classifier_paths)
+    print(f"loaded {sum(len(configs) for _, _, configs in groups.values())} classifiers in {len(groups)} feature groups")
+
+    store = ResultsStore(os.path.join(outdir_path, RESULTS_DB))
+    n_scores = 0
+    for indir in args.indirs:
+        for subdir in tqdm(get_run_subdirs(indir)):
+            for dataset in DATASETS:
+                test_data = dict() # the features of each test set are extracted once per (prompt type, embedding type, aggregation type), and cached across runs with --feature-cache-dir
+                for (prompt_type, embedding_type, aggregation_type, d), (coefs, intercepts, configs) in groups.items():
+                    if not (prompt_type, embedding_type, aggregation_type) in test_data.keys():
+                        test_data[(prompt_type, embedding_type, aggregation_type)] = get_test_data(subdir, dataset, prompt_type, embedding_type, aggregation_type, args.feature_cache_dir, args.feature_cache_max_gb)
+                    X, y = test_data[(prompt_type, embedding_type, aggregation_type)]
+                    if X is None or X.shape[1] != d:
+                        continue
+                    scores = score_classifiers(X.astype(coefs.dtype, copy=False), y, coefs, intercepts)
+                    rows = [{**{key: config[key] for key in ["train_model", "train_dataset", "classifier"]}, **{metric: float(values[i]) for metric, values in scores.items()}} for i, config in enumerate(configs)]
+                    config = dict(get_run_config(subdir, dataset), decoding="", prompt_type=prompt_type, embedding_type=embedding_type, aggregation_type=aggregation_type)
+                    store.upsert_rows("probe_evaluation", config, rows, subdir=subdir) # keyed by the classifier too, so the scores of the other classifiers on the test set are kept
+                    n_scores += len(rows)
+
+    # print the cross-dataset matrix of every (model, prompt type, features)
+    df = store.query("probe_evaluation")
+    for (model, prompt_type, embedding_type, aggregation_type), curr_df in df.groupby(["model", "prompt_type", "embedding_type", "aggregation_type"]):
+        print(f"\nmodel: {model}, prompt type: {prompt_type}, {embedding_type} ({aggregation_type}) - rows: train dataset, columns: test dataset")
+        print(get_probe_heat_map(curr_df[curr_df["train_model"] == model]).to_string(float_format="{:.1f}".format))
+    store.close()
+    print(f"\nsaved {n_scores} scores to {os.path.join(outdir_path, RESULTS_DB)} (table: probe_evaluation)")
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="evaluate every classifier on every test set (the cross-dataset matrix of the probes).")
+    argparser.add_argument("--indirs", nargs='+', type=str, required=True, help="paths to the test set data (run outdirs or their subdirs).")
+    argparser.add_argument('--classifier-dirs', nargs='+', type=str, required=True, help='the classifiers (best_model.pkl files, or outdirs of train_linear_classifiers.py/train_probe_batch.py to search for them).')
+    argparser.add_argument('--outdir', type=str, default=None, help='outdir of the results store (default: evaluation_results).')
+    argparser.add_argument('--feature-cache-dir', type=str, default=None, help='dir of the feature cache (keyed by the artifacts\' content hash), shared with the other probing, erasure and plotting scripts. If None - no caching.')
+    argparser.add_argument('--feature-cache-max-gb', type=float, default=DEFAULT_CACHE_MAX_GB, help='size cap of the feature cache (least recently used entries are evicted).')
+    args = argparser.parse_args()
+    main(args)
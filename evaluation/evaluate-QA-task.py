@@ -1,7 +1,4 @@
-import pandas as pd
-import numpy as np
 import os
-import json
 from tqdm import tqdm
 import argparse
 import sys
@@ -9,93 +6,94 @@ sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from utils import PROMPT_TYPES
 from evaluation_utils import *
-import subprocess
-from pathlib import Path
-import shutil
+from stage_manifest import MANIFEST_FILE, StageManifest
+from qa_scoring import score_prediction_files, check_parity
+from results_store import RESULTS_DB, ResultsStore, export_views
+from run_manifest import get_run_subdirs
+
+def get_gold_outputs_path(curr_dataset, devset):
+    gold_outputs_suffix = "json" if curr_dataset == "squad" else "jsonl"
+    if devset:
+        return os.path.join("data", "gold_outputs", curr_dataset, f"dev_data.{gold_outputs_suffix}")
+    return os.path.join("data", "gold_outputs", curr_dataset, f"test_data.{gold_outputs_suffix}")
+
+def get_QA_task_subdirs(indir):
+    """The {dataset}_QA_task_format subdirs of the decoding subdirs of the run's artifacts (listed from the run manifest, without walking the tree)."""
+    QA_task_subdirs = []
+    for run_subdir in get_run_subdirs(indir):
+        for decoding_type in ["regular_decoding", "beam_relaxation"]:
+            decoding_subdir = os.path.join(run_subdir, decoding_type)
+            if os.path.isdir(decoding_subdir):
+                QA_task_subdirs.extend([os.path.join(decoding_subdir, name) for name in sorted(os.listdir(decoding_subdir)) if name.endswith("_QA_task_format")])
+    return QA_task_subdirs
+
+def get_na_prob_path(subdir, filename):
+    """The no-answer probabilities of the json's questions (saved by post_processing/na_probs.py), or None if there are none."""
+    na_prob_path = os.path.join(f'{subdir[:-len("_QA_task_format")]}_na_probs', filename)
+    return na_prob_path if os.path.exists(na_prob_path) else None
 
 def main(args):
-
-    # create tmp dir inside the outdir path for calculations of each of the prompt variants
     outdir_path = args.outdir if args.outdir else "evaluation_results"
-    tmp_outdir = os.path.join(outdir_path, "tmp")
-    path = Path(tmp_outdir)
-    path.mkdir(parents=True, exist_ok=True)
 
+    # skip the subdirs whose results are up to date with their jsons and gold outputs
+    manifest = StageManifest(os.path.join(outdir_path, MANIFEST_FILE), dry_run=args.dry_run, force=args.force)
+    store = ResultsStore(os.path.join(outdir_path, RESULTS_DB))
 
+    # collect the json files with the generated texts of all the stale subdirs
+    stale_subdirs, jobs = [], []
     for curr_indir in args.indirs:
-        for subdir, dirs, files in os.walk(curr_indir):
-            curr_full_results_df = dict()
-            for filename in files:
-                # if not the json file with the generated texts - ignore
-                if not any(filename.endswith(f"{prompt_type}.json") for prompt_type in PROMPT_TYPES):
-                    continue
+        for subdir in get_QA_task_subdirs(curr_indir):
+            json_files = sorted(filename for filename in os.listdir(subdir) if any(filename.endswith(f"{prompt_type}.json") for prompt_type in PROMPT_TYPES))
+            if not json_files:
+                continue
+            curr_dataset = get_dataset_name(json_files[-1])
+            config = get_run_config(subdir, curr_dataset)
+            unit = os.path.join(get_evalulation_outdir(subdir, curr_dataset, outdir_path, mkdir=False), f"QA-task-results")
+            na_prob_paths = [get_na_prob_path(subdir, filename) for filename in json_files]
+            stage_inputs = [os.path.join(subdir, filename) for filename in json_files] + [get_gold_outputs_path(curr_dataset, args.devset)] + [path for path in na_prob_paths if path is not None]
+            if (manifest.is_up_to_date("QA_scoring", unit, stage_inputs) and store.has_results("QA_task", config)) or args.dry_run:
+                continue
 
+            prompt_types = []
+            for filename, na_prob_path in zip(json_files, na_prob_paths):
                 # get the dataset name
                 curr_dataset = get_dataset_name(filename)
 
                 # get prompt_type (it is in the json file's name - simply remove the suffix and the dataset's prefix)
-                prompt_type = filename.replace(f"{curr_dataset}_", "").replace(".json", "")
-
-
-                ###### run the relevant evaluation script ######
-                # get the script
-                eval_script = "evaluate-squad-v2.0.py" if curr_dataset == "squad" else "evaluate-NQ-musique.py"
-                eval_script = os.path.join("evaluation", eval_script)
-
-                # get path to gold data
-                gold_outputs_suffix = "json" if curr_dataset == "squad" else "jsonl"
-                if args.devset:
-                    gold_outputs_indir =  os.path.join("data", "gold_outputs", curr_dataset, f"dev_data.{gold_outputs_suffix}")
-                else:
-                    gold_outputs_indir =  os.path.join("data", "gold_outputs", curr_dataset, f"test_data.{gold_outputs_suffix}")
-                
-                # get path to generated text
-                generated_text_indir = os.path.join(subdir, filename)
-
-                # get temporary outdir for results
-                curr_tmp_outdir = os.path.join(tmp_outdir, f"{curr_dataset}_{prompt_type}.json")
-
-                # run the script
-                subprocess.run(['python', eval_script, gold_outputs_indir, generated_text_indir, "--out-file", curr_tmp_outdir])
-
-                # read the results and store them to curr_full_results_df
-                with open(curr_tmp_outdir, 'r') as f1:
-                    curr_results = json.loads(f1.read())
-                curr_full_results_df[prompt_type] = curr_results
-                
-                # remove the temporary file
-                if os.path.isfile(curr_tmp_outdir):
-                    os.remove(curr_tmp_outdir)
-            
-            # if empty dataframe, that means no files where found in current subdir
-            if not curr_full_results_df:
-                continue
-            # convert to dataframe
-            labels = list(curr_full_results_df.keys())
-            columns = curr_full_results_df[labels[0]].keys()
-            df_dict = {col:[curr_full_results_df[label][col] for label in labels] for col in columns}
-
-            # rename columns
-            df_dict = {QA_TASK_METRICS_MAP[col]:results for col,results in df_dict.items()}
-
-            curr_out_df = pd.DataFrame(df_dict, index=labels)
-
-            # create outdir
-            curr_outdir_path = get_evalulation_outdir(subdir, curr_dataset, outdir_path)
-            outdir_csv_file = os.path.join(curr_outdir_path, f"QA-task-results.csv")
-            curr_out_df.to_csv(outdir_csv_file)
-
-    # remove the temporary folder altogether
-    try:
-        if os.path.isdir(tmp_outdir):
-            shutil.rmtree(tmp_outdir)
-    except:
-        print(f'Folder {tmp_outdir} not deleted')
+                prompt_types.append(filename.replace(f"{curr_dataset}_", "").replace(".json", ""))
+
+                # get path to gold data, to generated text and to the no-answer probabilities (if any)
+                jobs.append((get_gold_outputs_path(curr_dataset, args.devset), curr_dataset, os.path.join(subdir, filename), na_prob_path))
+            stale_subdirs.append((subdir, config, unit, stage_inputs, prompt_types))
+
+    # score all the files in-process (in parallel), with the logic of the official evaluation scripts
+    all_results = score_prediction_files(jobs, num_workers=args.num_workers)
+    if args.parity_check:
+        for job, curr_results in tqdm(zip(jobs, all_results), total=len(jobs), desc="parity check"):
+            gold_path, dataset, pred_path, na_prob_path = job
+            check_parity(gold_path, dataset, pred_path, curr_results, na_prob_path)
+
+    all_results = iter(all_results)
+    for subdir, config, unit, stage_inputs, prompt_types in stale_subdirs:
+        rows = [{"prompt_type": prompt_type, **next(all_results)} for prompt_type in prompt_types]
+
+        # save to the results store (the csv files are exported on demand - see results_store.py)
+        store.upsert("QA_task", config, rows, subdir=subdir)
+        manifest.record("QA_scoring", unit, stage_inputs, [])
+    store.close()
+    manifest.save()
+    if args.export_views and not args.dry_run:
+        export_views(os.path.join(outdir_path, RESULTS_DB), outdir_path, views=["csv"])
 
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser(description="")
     argparser.add_argument("--indirs", nargs='+', type=str, required=True, help="path to indirs where the generated texts are.")
     argparser.add_argument('--outdir', type=str, default=None, help='outdir to save results')
     argparser.add_argument("--devset", action='store_true', default=False, help="whether the data is the devset (for choosing the best (hinting) variant)")
+    argparser.add_argument("--dry-run", action='store_true', default=False, help="only list the results that would be recomputed.")
+    argparser.add_argument("--force", action='store_true', default=False, help="recompute all the results, even if up to date.")
+    argparser.add_argument("--num-workers", type=int, default=None, help="number of processes to score the files in parallel (default: the number of CPUs).")
+    argparser.add_argument("--parity-check", action='store_true', default=False, help="also score every file with the official evaluation scripts (in a subprocess), and raise if any score differs.")
+    argparser.add_argument("--export-views", action='store_true', default=False, help="also write the results to QA-task-results.csv files (in the former layout of the outdir).")
     args = argparser.parse_args()
     main(args)
\ No newline at end of file
@@ -3,28 +3,36 @@ import pandas as pd
 import numpy as np
 import os
 from tqdm import tqdm
-from openpyxl import load_workbook
 from tabulate import tabulate
 import sys
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from utils import PROMPT_TYPES, UNANSWERABLE_REPLIES, UNANSWERABLE_REPLIES_EXACT
+from utils import PROMPT_TYPES
+from abstention_matcher import are_unanswerable
 from evaluation_utils import *
-
-def check_if_unanswerable(response):
-    value = str(response).lower().strip()
-    return any(elem1==value for elem1 in UNANSWERABLE_REPLIES_EXACT) or any(f"{elem1}."==value for elem1 in UNANSWERABLE_REPLIES_EXACT) or any(elem2 in value.lower() for elem2 in UNANSWERABLE_REPLIES)
-
-def calc_TP_TN_FP_FN(unanswerable_lst, answerable_lst):
-    unanswerable_elems = {"tp": len([elem for elem in unanswerable_lst if elem]),
-                         "fn": len([elem for elem in unanswerable_lst if not elem]),
-                         "fp": len([elem for elem in answerable_lst if not elem]),
-                         "tn": len([elem for elem in answerable_lst if elem])}
+from stage_manifest import MANIFEST_FILE, StageManifest
+from results_store import RESULTS_DB, ResultsStore, export_views
+from run_manifest import get_run_subdirs
+
+def calc_TP_TN_FP_FN(unanswerable_matches, answerable_matches):
+    """
+    The confusion counts of all the prompt types at once.
+    unanswerable_matches: (un-answerable instances, prompt types) whether each reply to an un-answerable instance is unanswerable
+    answerable_matches: (answerable instances, prompt types) whether each reply to an answerable instance is unanswerable
+    returns: the counts of the un-answerable class and of the answerable class (each count - an array with an element per prompt type)
+    """
+    n_unanswerable, n_answerable = unanswerable_matches.shape[0], answerable_matches.shape[0]
+    unanswerable_abstentions = unanswerable_matches.sum(axis=0)
+    answerable_abstentions = answerable_matches.sum(axis=0)
+    unanswerable_elems = {"tp": unanswerable_abstentions,
+                         "fn": n_unanswerable - unanswerable_abstentions,
+                         "fp": answerable_abstentions,
+                         "tn": n_answerable - answerable_abstentions}
     
-    answerable_elems = {"tp": len([elem for elem in answerable_lst if elem]),
-                           "fn": len([elem for elem in answerable_lst if not elem]),
-                           "fp": len([elem for elem in unanswerable_lst if not elem]),
-                           "tn": len([elem for elem in unanswerable_lst if elem])}
+    answerable_elems = {"tp": n_answerable - answerable_abstentions,
+                           "fn": answerable_abstentions,
+                           "fp": n_unanswerable - unanswerable_abstentions,
+                           "tn": unanswerable_abstentions}
 
     return unanswerable_elems, answerable_elems
 
@@ -44,84 +52,70 @@ def get_all_results(elems):
             "support": support
             }
 
-def create_output_tabular_structure(unanswerable_results, answerable_results):
-    labels = ['un-answerable', 'answerable', 'accuracy']
-    columns = ['precision', 'recall', 'f1-score', 'support']
-    data_df = {columns[0] : [unanswerable_results["P"], answerable_results["P"], ''],
-               columns[1] : [unanswerable_results["R"], answerable_results["R"], ''],
-               columns[2] : [unanswerable_results["F1"], answerable_results["F1"], unanswerable_results["accuracy"]],
-               columns[3] : [unanswerable_results["support"], answerable_results["support"], unanswerable_results["support"]+answerable_results["support"]]}
-
-    table_txt = [
-        ['',        columns[0],             columns[1],             columns[2],             columns[3]],
-        [labels[0], data_df[columns[0]][0], data_df[columns[1]][0], data_df[columns[2]][0], data_df[columns[3]][0]],
-        [labels[1], data_df[columns[0]][1], data_df[columns[1]][1], data_df[columns[2]][1], data_df[columns[3]][1]],
-        [labels[2], data_df[columns[0]][2], data_df[columns[1]][2], data_df[columns[2]][2], data_df[columns[3]][2]]
-    ]
-
-    return table_txt, labels, data_df
-
 def main(args):
+    # skip the subdirs whose results are up to date with their csvs
+    outdir_path = args.outdir if args.outdir else "evaluation_results"
+    manifest = StageManifest(os.path.join(outdir_path, MANIFEST_FILE), dry_run=args.dry_run, force=args.force)
+    store = ResultsStore(os.path.join(outdir_path, RESULTS_DB))
+
     for curr_indir in args.indirs:
         curr_unanswerable, curr_answerable = pd.DataFrame(), pd.DataFrame()
 
-        for subdir, dirs, files in os.walk(curr_indir):
-            if not os.path.basename(subdir) in ["regular_decoding", "beam_relaxation"]:
+        # the decoding subdirs of the run's artifacts (listed from the run manifest, without walking the tree)
+        decoding_subdirs = [os.path.join(run_subdir, decoding_type) for run_subdir in get_run_subdirs(curr_indir) for decoding_type in ["regular_decoding", "beam_relaxation"]]
+        for subdir in decoding_subdirs:
+            if not os.path.isdir(subdir):
+                continue
+            csv_files = sorted(filename for filename in os.listdir(subdir) if filename.endswith(".csv"))
+            if not csv_files:
+                continue
+
+            curr_dataset = get_dataset_name(os.path.join(subdir, csv_files[-1]))
+            config = get_run_config(subdir, curr_dataset)
+            unit = os.path.join(get_evalulation_outdir(subdir, curr_dataset, outdir_path, mkdir=False), f"unanswerability_classification_results")
+            stage_inputs = [os.path.join(subdir, filename) for filename in csv_files]
+            if (manifest.is_up_to_date("unanswerability_classification", unit, stage_inputs) and store.has_results("unanswerability_classification", config)) or args.dry_run:
                 continue
-            for filename in files:
-                if not filename.endswith(".csv"):
-                    continue
+
+            for filename in csv_files:
                 if "un-answerable" in filename:
                     curr_unanswerable = pd.read_csv(os.path.join(subdir, filename))
-                elif filename.startwith("answerable"):
+                elif filename.startswith("answerable"):
                     curr_answerable = pd.read_csv(os.path.join(subdir, filename))
                 else:
                     raise Exception(f"invalid csv file: {os.path.join(subdir, filename)}")
-                
-                # get the dataset name
-                curr_dataset = get_dataset_name(os.path.join(subdir, filename))
             
             if curr_answerable.empty or curr_unanswerable.empty:
                 raise Exception(f"didn't find two csv's in {subdir}")
-            
-            # create outdir
-            outdir_path = args.outdir if args.outdir else "evaluation_results"
-            outdir_path = get_evalulation_outdir(subdir, curr_dataset, outdir_path)
-            outdir_excel_file = os.path.join(outdir_path, f"unanswerability_classification_results.xlsx")
-
-            outdir_df_dict = {}
-            for prompt_type in PROMPT_TYPES:
-                if not prompt_type in curr_unanswerable.columns:
-                    continue
-                unanswerable_response_unanswerable = [check_if_unanswerable(elem) for elem in curr_unanswerable[prompt_type]]
-                answerable_response_not_unanswerable = [not check_if_unanswerable(elem) for elem in curr_answerable[prompt_type]]
-                
-                unanswerable_elems, answerable_elems = calc_TP_TN_FP_FN(unanswerable_response_unanswerable, answerable_response_not_unanswerable)        
-
-                unanswerable_results = get_all_results(unanswerable_elems)
-                answerable_results = get_all_results(answerable_elems)
-
-                output_text, labels, data_df = create_output_tabular_structure(unanswerable_results, answerable_results)
-                
+
+            # match the replies of all the prompt types in a single pass
+            prompt_types = [prompt_type for prompt_type in PROMPT_TYPES if prompt_type in curr_unanswerable.columns]
+            unanswerable_matches = are_unanswerable(curr_unanswerable[prompt_types].to_numpy(dtype=object))
+            answerable_matches = are_unanswerable(curr_answerable[prompt_types].to_numpy(dtype=object))
+            unanswerable_elems, answerable_elems = calc_TP_TN_FP_FN(unanswerable_matches, answerable_matches)
+
+            rows = []
+            for i, prompt_type in enumerate(prompt_types):
+                unanswerable_results = get_all_results({key:value[i] for key,value in unanswerable_elems.items()})
+                answerable_results = get_all_results({key:value[i] for key,value in answerable_elems.items()})
+
                 # print results
                 if args.print_results:
+                    output_text, _, _ = create_output_tabular_structure(unanswerable_results, answerable_results)
                     tabulated_scores = tabulate(output_text, headers='firstrow', tablefmt='plain')
                     print(f"\n{prompt_type}:")
                     print(f"\n{tabulated_scores}\n")
-                
-                # convert to dataframe
-                df_scores = pd.DataFrame(data_df, index=labels)
-
-                # save df to the outdir_df_dict
-                outdir_df_dict[prompt_type] = df_scores
-
-            # save to excel file (each prompt type - in a separate sheet)
-            with pd.ExcelWriter(outdir_excel_file, engine='openpyxl') as writer:  
-                for prompt_type,curr_df_scores in outdir_df_dict.items():
-                    curr_df_scores.to_excel(writer, sheet_name=prompt_type)
-
 
+                for label, results, elems in [("un-answerable", unanswerable_results, unanswerable_elems), ("answerable", answerable_results, answerable_elems)]:
+                    rows.append({"prompt_type": prompt_type, "label": label, **results, **{key:int(value[i]) for key,value in elems.items()}})
 
+            # save to the results store (the xlsx files are exported on demand - see results_store.py)
+            store.upsert("unanswerability_classification", config, rows, subdir=subdir)
+            manifest.record("unanswerability_classification", unit, stage_inputs, [])
+    store.close()
+    manifest.save()
+    if args.export_views and not args.dry_run:
+        export_views(os.path.join(outdir_path, RESULTS_DB), outdir_path, views=["xlsx"])
 
 
 
@@ -130,5 +124,8 @@ if __name__ == '__main__':
     argparser.add_argument("--indirs", nargs='+', type=str, required=True, help="path to indirs where the generated texts are.")
     argparser.add_argument('--outdir', type=str, default=None, help='outdir to save results.')
     argparser.add_argument("--print-results", action='store_true', default=False, help="whether to also print the results.")
+    argparser.add_argument("--dry-run", action='store_true', default=False, help="only list the results that would be recomputed.")
+    argparser.add_argument("--force", action='store_true', default=False, help="recompute all the results, even if up to date.")
+    argparser.add_argument("--export-views", action='store_true', default=False, help="also write the results to unanswerability_classification_results.xlsx files (in the former layout of the outdir).")
     args = argparser.parse_args()
     main(args)
\ No newline at end of file
@@ -1,29 +1,33 @@
-import subprocess
-import pandas as pd
-import numpy as np
-import os
-import json
-from tqdm import tqdm
 import argparse
+import importlib.util
+import os
 import sys
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from results_store import RESULTS_DB
+
+EVALUATION_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def load_evaluation_script(script_name):
+    """Import an evaluation script as a module (their file names aren't valid module names)."""
+    spec = importlib.util.spec_from_file_location(os.path.splitext(script_name)[0].replace("-", "_"), os.path.join(EVALUATION_DIR, script_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
 def main(args):
     outdir = args.outdir if args.outdir else "evaluation_results"
 
-    print(f"results are saved under {outdir}")
+    print(f"results are saved to {os.path.join(outdir, RESULTS_DB)}")
+    # only the results that aren't up to date with their inputs are recomputed (see stage_manifest.py)
     print("Calculating performance in unanswerability classification ...")
     # run unanswerability classification
-    eval_script = os.path.join("evaluation", "evaluate-unanswerability-classification.py")
-    script_args = ["--indirs"] + args.indirs + ["--outdir"] + [outdir]
-    subprocess.run(['python', eval_script] + script_args)
+    unanswerability_classification = load_evaluation_script("evaluate-unanswerability-classification.py")
+    unanswerability_classification.main(argparse.Namespace(indirs=args.indirs, outdir=outdir, print_results=False, dry_run=args.dry_run, force=args.force, export_views=args.export_views))
 
     # run QA task evaluation
     print("Calculating performance on the QA task ...")
-    eval_script = os.path.join("evaluation", "evaluate-QA-task.py")
-    script_args = ["--indirs"] + args.indirs + ["--outdir"] + [outdir]
-    if args.devset:
-        script_args += ["--devset"]
-    subprocess.run(['python', eval_script] + script_args)    
+    QA_task = load_evaluation_script("evaluate-QA-task.py")
+    QA_task.main(argparse.Namespace(indirs=args.indirs, outdir=outdir, devset=args.devset, dry_run=args.dry_run, force=args.force, num_workers=args.num_workers, parity_check=args.parity_check, export_views=args.export_views))
 
 
 
@@ -32,5 +36,10 @@ if __name__ == '__main__':
     argparser.add_argument("--indirs", nargs='+', type=str, required=True, help="path to indirs where the generated texts are.")
     argparser.add_argument('--outdir', type=str, default=None, help='outdir to save results.')
     argparser.add_argument("--devset", action='store_true', default=False, help="whether the data is the devset (for choosing the best (hinting) variant).")
+    argparser.add_argument("--dry-run", action='store_true', default=False, help="only list the results that would be recomputed.")
+    argparser.add_argument("--force", action='store_true', default=False, help="recompute all the results, even if up to date.")
+    argparser.add_argument("--num-workers", type=int, default=None, help="number of processes to score the QA-task files in parallel (default: the number of CPUs).")
+    argparser.add_argument("--parity-check", action='store_true', default=False, help="also score every QA-task file with the official evaluation scripts, and raise if any score differs.")
+    argparser.add_argument("--export-views", action='store_true', default=False, help="also write the xlsx/csv files of each results dir (the results are always saved to the results store).")
     args = argparser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
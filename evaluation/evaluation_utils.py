@@ -1,6 +1,10 @@
 import os
+import re
 from pathlib import Path
 import logging
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from run_manifest import SUBDIR_KEYS, get_run_config as lookup_run_config
 # Set the logging level to INFO
 logging.basicConfig(level=logging.INFO)
 
@@ -12,7 +16,15 @@ QA_TASK_METRICS_MAP={'exact' : 'EM (all)',
                      'HasAns_total' : 'total (answerable)',
                      'NoAns_exact' : 'EM (un-answerable)',
                      'NoAns_f1' : 'F1 (un-answerable)',
-                     'NoAns_total' : 'total (un-answerable)'}
+                     'NoAns_total' : 'total (un-answerable)',
+                     # with no-answer probabilities (see post_processing/na_probs.py)
+                     'best_exact' : 'best EM (all)',
+                     'best_exact_thresh' : 'best EM threshold',
+                     'best_f1' : 'best F1 (all)',
+                     'best_f1_thresh' : 'best F1 threshold',
+                     'pr_exact_ap' : 'EM AP',
+                     'pr_f1_ap' : 'F1 AP',
+                     'pr_oracle_ap' : 'oracle AP'}
 
 
 def get_model_name(indir):
@@ -47,16 +59,10 @@ def get_variant(indir):
         raise Exception(f"curr variant not found in indir: {indir}")
 
 def get_num_beams(indir):
-    if "k_beams_1" in indir:
-        return "k_beams_1"
-    if "k_beams_3" in indir:
-        return "k_beams_3"
-    if "k_beams_5" in indir:
-        return "k_beams_5"    
-    if "k_beams_7" in indir:
-        return "k_beams_7"
-    else:
+    num_beams = re.search(r"k_beams_(\d+)", indir)
+    if num_beams is None:
         raise Exception(f"num beams not found in indir: {indir}")
+    return num_beams.group(0)
 
 def get_icl_variant(indir):
     if not "icl_examples" in indir:
@@ -70,23 +76,56 @@ def get_icl_variant(indir):
     else:
         raise Exception(f"icl_examples found in indir, but no known version was found: {indir}")
 
-def get_evalulation_outdir(subdir, curr_dataset, outdir_path):
-    zero_or_few = "zero_shot" if "zero_shot" in subdir else "few_shot"
-    model_name = get_model_name(subdir)
-    variant = get_variant(subdir)
-    num_beams = get_num_beams(subdir)
-    icl_variant = get_icl_variant(subdir)
-
-    top_or_all_beams = "beam_relaxation" if "beam_relaxation" in subdir else "regular_decoding"
-
-    outdir_path = os.path.join(outdir_path, zero_or_few, model_name, curr_dataset, num_beams, variant, top_or_all_beams)
-    if icl_variant != None: # for few-shot there is also icl_example variant
-        outdir_path = os.path.join(outdir_path, icl_variant)
+def get_run_config(subdir, curr_dataset):
+    """
+    The configuration of the results of a subdir (the key of its results in the results store).
+    It is looked up in the run manifest written by the generation scripts, or, for runs without one, inferred from the path.
+    """
+    run_config = lookup_run_config(subdir)
+    if run_config is not None and all(key in run_config.keys() for key in SUBDIR_KEYS):
+        return {"shot": run_config["shot"],
+                "model": run_config["model"],
+                "dataset": curr_dataset,
+                "k_beams": f"k_beams_{run_config['k_beams']}",
+                "variant": run_config["variant"],
+                "decoding": "beam_relaxation" if "beam_relaxation" in subdir else "regular_decoding",
+                "icl_variant": run_config["icl_variant"] or ""}
+    return {"shot": "zero_shot" if "zero_shot" in subdir else "few_shot",
+            "model": get_model_name(subdir),
+            "dataset": curr_dataset,
+            "k_beams": get_num_beams(subdir),
+            "variant": get_variant(subdir),
+            "decoding": "beam_relaxation" if "beam_relaxation" in subdir else "regular_decoding",
+            "icl_variant": get_icl_variant(subdir) or ""}
 
+def get_config_outdir(config, outdir_path, mkdir=True):
+    outdir_path = os.path.join(outdir_path, config["shot"], config["model"], config["dataset"], config["k_beams"], config["variant"], config["decoding"])
+    if config["icl_variant"]: # for few-shot there is also icl_example variant
+        outdir_path = os.path.join(outdir_path, config["icl_variant"])
 
-    path = Path(outdir_path)
-    path.mkdir(parents=True, exist_ok=True)
+    if mkdir:
+        path = Path(outdir_path)
+        path.mkdir(parents=True, exist_ok=True)
     # logging.info(f'saving results to: {outdir_path}')
 
     return outdir_path
 
+def get_evalulation_outdir(subdir, curr_dataset, outdir_path, mkdir=True):
+    return get_config_outdir(get_run_config(subdir, curr_dataset), outdir_path, mkdir)
+
+def create_output_tabular_structure(unanswerable_results, answerable_results):
+    labels = ['un-answerable', 'answerable', 'accuracy']
+    columns = ['precision', 'recall', 'f1-score', 'support']
+    data_df = {columns[0] : [unanswerable_results["P"], answerable_results["P"], ''],
+               columns[1] : [unanswerable_results["R"], answerable_results["R"], ''],
+               columns[2] : [unanswerable_results["F1"], answerable_results["F1"], unanswerable_results["accuracy"]],
+               columns[3] : [unanswerable_results["support"], answerable_results["support"], unanswerable_results["support"]+answerable_results["support"]]}
+
+    table_txt = [
+        ['',        columns[0],             columns[1],             columns[2],             columns[3]],
+        [labels[0], data_df[columns[0]][0], data_df[columns[1]][0], data_df[columns[2]][0], data_df[columns[3]][0]],
+        [labels[1], data_df[columns[0]][1], data_df[columns[1]][1], data_df[columns[2]][1], data_df[columns[3]][1]],
+        [labels[2], data_df[columns[0]][2], data_df[columns[1]][2], data_df[columns[2]][2], data_df[columns[3]][2]]
+    ]
+
+    return table_txt, labels, data_df
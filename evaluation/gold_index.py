@@ -0,0 +1,157 @@
+"""
+A compact index of each gold file (data/gold_outputs/{dataset}/{dev,test}_data.{json,jsonl}), built once, so the evaluations
+don't parse the gold files (and normalize their answers) for every prediction file.
+
+The index of <gold_file> is saved under <gold_file>.index/:
+    meta.json           - the source, its (size, mtime) and content hash, and the index version
+    qids.json           - the qids (in the order of the gold file)
+    vocab.json          - the tokens of the normalized gold answers
+    has_ans.npy         - (qids,) whether each question is answerable
+    answer_offsets.npy  - (qids+1,) the range of each question's gold answers in token_offsets
+    token_offsets.npy   - (answers+1,) the range of each gold answer's tokens in tokens
+    tokens.npy          - the vocab ids of the tokens of all the gold answers
+The gold answers are filtered as in the official get_raw_scores (only the non-empty normalized answers, or ['']), and the
+arrays are memory-mapped when loaded. The index is rebuilt when the gold file's contents change.
+"""
+import numpy as np
+import os
+import json
+import argparse
+from glob import glob
+from collections import Counter
+from functools import lru_cache
+import sys
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from feature_cache import compute_content_hash
+from qa_scoring import get_official_script, load_gold_dataset, get_gold_answers
+
+GOLD_INDEX_VERSION = 1
+GOLD_INDEX_SUFFIX = ".index"
+GOLD_OUTPUTS_DIR = os.path.join("data", "gold_outputs")
+
+
+def get_index_dir(gold_path):
+    return f"{gold_path}{GOLD_INDEX_SUFFIX}"
+
+def _get_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def build_gold_index(gold_path, dataset):
+    """Build (or rebuild) the index of the gold file, and return its dir."""
+    gold_dataset = load_gold_dataset(gold_path)
+    qid_to_has_ans = get_official_script(dataset).make_qid_to_has_ans(gold_dataset)
+    gold_answers = get_gold_answers(gold_dataset)
+    vocab = dict()
+    answer_offsets, token_offsets, tokens = [0], [0], []
+    for qid in qid_to_has_ans.keys():
+        for normalized, _, _ in gold_answers[qid]:
+            tokens.extend([vocab.setdefault(token, len(vocab)) for token in normalized.split()])
+            token_offsets.append(len(tokens))
+        answer_offsets.append(len(token_offsets)-1)
+
+    index_dir = get_index_dir(gold_path)
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, "has_ans.npy"), np.array(list(qid_to_has_ans.values()), dtype=bool))
+    np.save(os.path.join(index_dir, "answer_offsets.npy"), np.array(answer_offsets, dtype=np.int64))
+    np.save(os.path.join(index_dir, "token_offsets.npy"), np.array(token_offsets, dtype=np.int64))
+    np.save(os.path.join(index_dir, "tokens.npy"), np.array(tokens, dtype=np.int32))
+    with open(os.path.join(index_dir, "qids.json"), 'w') as f1:
+        f1.write(json.dumps(list(qid_to_has_ans.keys())))
+    with open(os.path.join(index_dir, "vocab.json"), 'w') as f1:
+        f1.write(json.dumps(list(vocab.keys())))
+    # the meta is written last, so an interrupted build is rebuilt
+    with open(os.path.join(index_dir, "meta.json"), 'w') as f1:
+        f1.write(json.dumps({"version": GOLD_INDEX_VERSION,
+                             "source": os.path.abspath(gold_path),
+                             "dataset": dataset,
+                             "signature": _get_signature(gold_path),
+                             "content_hash": compute_content_hash(gold_path),
+                             "n_questions": len(qid_to_has_ans),
+                             "n_answers": len(token_offsets)-1}, indent=2))
+    return index_dir
+
+def is_up_to_date(gold_path, dataset):
+    """Whether the index exists and was built (by this version) from the current contents of the gold file."""
+    meta_path = os.path.join(get_index_dir(gold_path), "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f1:
+        meta = json.loads(f1.read())
+    if meta["version"] != GOLD_INDEX_VERSION or meta["dataset"] != dataset:
+        return False
+    return meta["signature"] == _get_signature(gold_path) or meta["content_hash"] == compute_content_hash(gold_path)
+
+class GoldIndex:
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, "meta.json"), 'r') as f1:
+            self.meta = json.loads(f1.read())
+        with open(os.path.join(index_dir, "qids.json"), 'r') as f1:
+            self.qids = json.loads(f1.read())
+        with open(os.path.join(index_dir, "vocab.json"), 'r') as f1:
+            self.vocab = json.loads(f1.read())
+        self.has_ans = np.load(os.path.join(index_dir, "has_ans.npy"), mmap_mode='r')
+        self.answer_offsets = np.load(os.path.join(index_dir, "answer_offsets.npy"), mmap_mode='r')
+        self.token_offsets = np.load(os.path.join(index_dir, "token_offsets.npy"), mmap_mode='r')
+        self.tokens = np.load(os.path.join(index_dir, "tokens.npy"), mmap_mode='r')
+        self._gold_answers = None
+
+    def __len__(self):
+        return len(self.qids)
+
+    def qid_to_has_ans(self):
+        """qid -> whether it is answerable (as the official make_qid_to_has_ans)"""
+        return dict(zip(self.qids, self.has_ans.tolist()))
+
+    @property
+    def answerable_qids(self):
+        return [qid for qid, has_ans in zip(self.qids, self.has_ans.tolist()) if has_ans]
+
+    @property
+    def unanswerable_qids(self):
+        return [qid for qid, has_ans in zip(self.qids, self.has_ans.tolist()) if not has_ans]
+
+    def gold_token_lists(self, qid_index):
+        """The token lists of the normalized gold answers of the question."""
+        answer_start, answer_end = self.answer_offsets[qid_index], self.answer_offsets[qid_index+1]
+        return [[self.vocab[token] for token in self.tokens[self.token_offsets[i]:self.token_offsets[i+1]].tolist()] for i in range(answer_start, answer_end)]
+
+    def gold_answers(self):
+        """qid -> the gold answers as (normalized answer, token counts, number of tokens), like qa_scoring.get_gold_answers (built once)."""
+        if self._gold_answers is None:
+            vocab, tokens, token_offsets = self.vocab, self.tokens.tolist(), self.token_offsets.tolist()
+            answers = []
+            for start, end in zip(token_offsets[:-1], token_offsets[1:]):
+                answer_tokens = [vocab[token] for token in tokens[start:end]]
+                answers.append((' '.join(answer_tokens), Counter(answer_tokens), len(answer_tokens)))
+            answer_offsets = self.answer_offsets.tolist()
+            self._gold_answers = {qid: answers[answer_offsets[i]:answer_offsets[i+1]] for i, qid in enumerate(self.qids)}
+        return self._gold_answers
+
+@lru_cache(maxsize=None)
+def load_gold_index(gold_path, dataset):
+    """The index of the gold file (built first if it is missing or stale)."""
+    if not is_up_to_date(gold_path, dataset):
+        build_gold_index(gold_path, dataset)
+    return GoldIndex(get_index_dir(gold_path))
+
+def get_gold_files(gold_outputs_dir=GOLD_OUTPUTS_DIR):
+    """The gold files (and their datasets) under data/gold_outputs/{dataset}/"""
+    return [(gold_path, os.path.basename(os.path.dirname(gold_path))) for gold_path in sorted(glob(os.path.join(gold_outputs_dir, "*", "*_data.json*"))) if not gold_path.endswith(GOLD_INDEX_SUFFIX)]
+
+def main(args):
+    for gold_path, dataset in get_gold_files(args.gold_outputs_dir):
+        if not args.force and is_up_to_date(gold_path, dataset):
+            print(f"{gold_path}: up to date")
+            continue
+        index_dir = build_gold_index(gold_path, dataset)
+        print(f"{gold_path}: indexed {len(GoldIndex(index_dir))} questions to {index_dir}")
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="build the index of each gold file (used by the QA-task evaluation).")
+    argparser.add_argument("--gold-outputs-dir", type=str, default=GOLD_OUTPUTS_DIR, help="the dir with the gold files (under {dataset}/).")
+    argparser.add_argument("--force", action='store_true', default=False, help="rebuild the indices, even if up to date.")
+    args = argparser.parse_args()
+    main(args)
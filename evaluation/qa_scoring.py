@@ -0,0 +1,248 @@
+"""
+In-process QA-task scoring, with the logic of the official evaluation scripts (evaluate-squad-v2.0.py for SQuAD, and
+evaluate-NQ-musique.py for NQ and MuSiQue), so that many prediction files can be scored without a subprocess per file,
+and with the gold answers read from the prebuilt index of each gold file (see gold_index.py).
+Every distinct answer string is normalized and tokenized once (see intern_answer), and the prediction files of the same gold
+file are scored in a single call.
+"""
+import collections
+import importlib.util
+import json
+import os
+import re
+import string
+import subprocess
+import sys
+import tempfile
+import numpy as np
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+EVALUATION_DIR = os.path.dirname(os.path.abspath(__file__))
+OFFICIAL_SCRIPTS = {"squad": "evaluate-squad-v2.0.py",
+                    "NQ": "evaluate-NQ-musique.py",
+                    "musique": "evaluate-NQ-musique.py"}
+NA_PROB_THRESH = 1.0 # the official scripts' default
+_PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+_ARTICLES_REGEX = re.compile(r'\b(a|an|the)\b', re.UNICODE)
+
+
+@lru_cache(maxsize=None)
+def load_official_script(script_name):
+    """Import an official evaluation script as a module (their file names aren't valid module names)."""
+    module_name = os.path.splitext(script_name)[0].replace("-", "_").replace(".", "_")
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(EVALUATION_DIR, script_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def get_official_script(dataset):
+    return load_official_script(OFFICIAL_SCRIPTS[dataset])
+
+@lru_cache(maxsize=None)
+def load_gold_dataset(gold_path):
+    """The gold data in the SQuAD structure (articles -> paragraphs -> qas), as in the official scripts' main."""
+    with open(gold_path) as f:
+        dataset_json = json.load(f)
+    if 'data' in dataset_json:
+        return dataset_json['data']
+    return load_official_script(OFFICIAL_SCRIPTS["NQ"]).make_squad_like(dataset_json)
+
+def normalize_answer(s):
+    """The official normalize_answer (lower, remove punctuation, articles and extra whitespace), with the table and the regex built once."""
+    return ' '.join(_ARTICLES_REGEX.sub(' ', s.lower().translate(_PUNCTUATION_TABLE)).split())
+
+@lru_cache(maxsize=None)
+def intern_answer(s):
+    """The normalized answer and its token counts, computed once per distinct string."""
+    normalized = normalize_answer(s)
+    tokens = normalized.split() if s else [] # the official get_tokens
+    return normalized, collections.Counter(tokens), len(tokens)
+
+def get_gold_answers(gold_dataset):
+    """qid -> the interned gold answers, filtered as in the official get_raw_scores (only the non-empty normalized answers, or [''])."""
+    gold_answers = dict()
+    for article in gold_dataset:
+        for p in article['paragraphs']:
+            for qa in p['qas']:
+                answers = [intern_answer(a['text']) for a in qa['answers'] if intern_answer(a['text'])[0]]
+                gold_answers[qa['id']] = answers if answers else [intern_answer('')]
+    return gold_answers
+
+def compute_exact_f1(gold, pred):
+    """The official compute_exact and compute_f1 of an interned gold and prediction."""
+    gold_normalized, gold_counts, n_gold = gold
+    pred_normalized, pred_counts, n_pred = pred
+    exact = int(gold_normalized == pred_normalized)
+    if n_gold == 0 or n_pred == 0:
+        # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+        return exact, int(n_gold == n_pred)
+    num_same = sum((gold_counts & pred_counts).values())
+    if num_same == 0:
+        return exact, 0
+    precision = 1.0 * num_same / n_pred
+    recall = 1.0 * num_same / n_gold
+    return exact, (2 * precision * recall) / (precision + recall)
+
+def get_raw_scores(gold_answers, preds_list):
+    """
+    The official get_raw_scores of many predictions dicts against the same gold answers (see get_gold_answers).
+    Every (question, normalized prediction) pair is scored once, so predictions shared by several files aren't re-scored.
+    returns: the (exact_scores, f1_scores) of each predictions dict
+    """
+    pair_scores = dict()
+    raw_scores = []
+    for preds in preds_list:
+        exact_scores, f1_scores = {}, {}
+        for qid, golds in gold_answers.items():
+            if qid not in preds:
+                print('Missing prediction for %s' % qid)
+                continue
+            pred = intern_answer(preds[qid])
+            key = (qid, pred[0])
+            if not key in pair_scores.keys():
+                # Take max over all gold answers
+                scores = [compute_exact_f1(gold, pred) for gold in golds]
+                pair_scores[key] = (max(exact for exact, _ in scores), max(f1 for _, f1 in scores))
+            exact_scores[qid], f1_scores[qid] = pair_scores[key]
+        raw_scores.append((exact_scores, f1_scores))
+    return raw_scores
+
+def _sort_by_na_prob(na_probs):
+    """The qids and the no-answer probabilities sorted by the probabilities (stable, like the official sorted(na_probs, key=...))."""
+    qids = list(na_probs.keys())
+    probs = np.fromiter(na_probs.values(), dtype=np.float64, count=len(qids))
+    order = np.argsort(probs, kind="stable")
+    return [qids[i] for i in order], probs[order]
+
+def find_best_thresh(preds, scores, na_probs, qid_to_has_ans):
+    """The official find_best_thresh, with a cumulative sum over the qids sorted by their no-answer probability."""
+    num_no_ans = sum(1 for k in qid_to_has_ans if not qid_to_has_ans[k])
+    qid_list, sorted_probs = _sort_by_na_prob(na_probs)
+    is_scored = np.array([qid in scores for qid in qid_list], dtype=bool)
+    # answering an answerable question adds its score, and answering an un-answerable question subtracts 1
+    diffs = np.array([(scores[qid] if qid_to_has_ans[qid] else (-1 if preds[qid] else 0)) if scored else 0 for qid, scored in zip(qid_list, is_scored)], dtype=np.float64)
+    cur_scores = np.cumsum(np.concatenate(([num_no_ans], diffs)))[1:] # starting from num_no_ans, so the additions (and their rounding) are in the official loop's order
+    best_i = int(np.argmax(np.where(is_scored, cur_scores, -np.inf))) if is_scored.any() else None
+    if best_i is None or cur_scores[best_i] <= num_no_ans:
+        return 100.0 * num_no_ans / len(scores), 0.0
+    return 100.0 * float(cur_scores[best_i]) / len(scores), float(sorted_probs[best_i])
+
+def get_precision_recall_curve(scores, na_probs, num_true_pos, qid_to_has_ans):
+    """
+    The official make_precision_recall_eval's curve and average precision, with cumulative sums over the qids sorted by
+    their no-answer probability.
+    returns: the precisions and recalls (at every threshold between two distinct probabilities), and the average precision
+    """
+    qid_list, sorted_probs = _sort_by_na_prob(na_probs)
+    true_pos = np.cumsum([scores[qid] if qid_to_has_ans[qid] else 0.0 for qid in qid_list], dtype=np.float64)
+    # i.e., the points where a threshold can be put after
+    is_threshold = np.append(sorted_probs[:-1] != sorted_probs[1:], True) if len(qid_list) else np.zeros(0, dtype=bool)
+    precisions = true_pos[is_threshold] / (np.flatnonzero(is_threshold) + 1.0)
+    recalls = true_pos[is_threshold] / float(num_true_pos)
+    avg_prec = np.cumsum(precisions * np.diff(recalls, prepend=0.0))
+    return np.concatenate(([1.0], precisions)), np.concatenate(([0.0], recalls)), float(avg_prec[-1]) if len(avg_prec) else 0.0
+
+def add_na_prob_evals(out_eval, preds, exact_raw, f1_raw, na_probs, qid_to_has_ans):
+    """The official find_all_best_thresh, and the average precision of the official run_precision_recall_analysis (without the plots)."""
+    for name, raw_scores in [("exact", exact_raw), ("f1", f1_raw)]:
+        out_eval[f'best_{name}'], out_eval[f'best_{name}_thresh'] = find_best_thresh(preds, raw_scores, na_probs, qid_to_has_ans)
+    num_true_pos = sum(1 for v in qid_to_has_ans.values() if v)
+    if num_true_pos == 0:
+        return out_eval
+    oracle_scores = {k: float(v) for k, v in qid_to_has_ans.items()}
+    for name, raw_scores in [("exact", exact_raw), ("f1", f1_raw), ("oracle", oracle_scores)]:
+        out_eval[f'pr_{name}_ap'] = 100.0 * get_precision_recall_curve(raw_scores, na_probs, num_true_pos, qid_to_has_ans)[2]
+    return out_eval
+
+def evaluate_predictions(gold_path, dataset, preds_list, na_probs_list=None):
+    """
+    The official scripts' main, on many predictions dicts against the same gold file.
+    The gold answers are read from the gold file's index (see gold_index.py), which is built on the first use.
+    na_probs_list: the no-answer probabilities of each predictions dict (None - no probabilities, i.e., all 0.0). With the
+                   probabilities, the best thresholds and the average precisions are also returned.
+    """
+    from gold_index import load_gold_index # gold_index builds on the functions of this module
+    script = get_official_script(dataset)
+    gold_index = load_gold_index(gold_path, dataset)
+    qid_to_has_ans = gold_index.qid_to_has_ans()  # maps qid to True/False
+    has_ans_qids = gold_index.answerable_qids
+    no_ans_qids = gold_index.unanswerable_qids
+    na_probs_list = [None] * len(preds_list) if na_probs_list is None else na_probs_list
+    out_evals = []
+    for preds, curr_na_probs, (exact_raw, f1_raw) in zip(preds_list, na_probs_list, get_raw_scores(gold_index.gold_answers(), preds_list)):
+        na_probs = {k: 0.0 for k in preds} if curr_na_probs is None else curr_na_probs
+        exact_thresh = script.apply_no_ans_threshold(exact_raw, na_probs, qid_to_has_ans, NA_PROB_THRESH)
+        f1_thresh = script.apply_no_ans_threshold(f1_raw, na_probs, qid_to_has_ans, NA_PROB_THRESH)
+        out_eval = script.make_eval_dict(exact_thresh, f1_thresh)
+        if has_ans_qids:
+            has_ans_eval = script.make_eval_dict(exact_thresh, f1_thresh, qid_list=has_ans_qids)
+            script.merge_eval(out_eval, has_ans_eval, 'HasAns')
+        if no_ans_qids:
+            no_ans_eval = script.make_eval_dict(exact_thresh, f1_thresh, qid_list=no_ans_qids)
+            script.merge_eval(out_eval, no_ans_eval, 'NoAns')
+        if curr_na_probs is not None:
+            add_na_prob_evals(out_eval, preds, exact_raw, f1_raw, na_probs, qid_to_has_ans)
+        out_evals.append(out_eval)
+    return out_evals
+
+def score_prediction_group(gold_path, dataset, pred_paths, na_prob_paths=None):
+    """Score prediction files (with their no-answer probability files, if not None) against the same gold file, in a single call."""
+    preds_list, na_probs_list = [], []
+    for pred_path, na_prob_path in zip(pred_paths, na_prob_paths or [None] * len(pred_paths)):
+        with open(pred_path) as f:
+            preds_list.append(json.load(f))
+        na_probs_list.append(None)
+        if na_prob_path is not None:
+            with open(na_prob_path) as f:
+                na_probs_list[-1] = json.load(f)
+    return evaluate_predictions(gold_path, dataset, preds_list, na_probs_list)
+
+def score_prediction_files(jobs, num_workers=None):
+    """
+    Score many prediction files in parallel.
+    jobs: a list of (gold_path, dataset, pred_path) or (gold_path, dataset, pred_path, na_prob_path)
+    num_workers: number of processes (None - the number of CPUs, 1 - score in this process)
+    returns: the evaluation dict of each job (in the order of the jobs)
+    """
+    # the files of the same gold file are scored together (in chunks, one per process), so each gold file is parsed and
+    # normalized at most once per process, and the predictions shared by the files are scored once
+    from gold_index import load_gold_index
+    groups = dict()
+    jobs = [tuple(job) + (None,) * (4 - len(job)) for job in jobs]
+    for i, (gold_path, dataset, _, _) in enumerate(jobs):
+        groups.setdefault((gold_path, dataset), []).append(i)
+    for gold_path, dataset in groups.keys():
+        load_gold_index(gold_path, dataset) # build the missing indices before the workers load them
+    n_chunks = 1 if num_workers == 1 else (num_workers or os.cpu_count() or 1)
+    tasks = []
+    for (gold_path, dataset), indices in groups.items():
+        chunk_size = max(1, -(-len(indices) // n_chunks))
+        tasks.extend([(gold_path, dataset, indices[i:i+chunk_size]) for i in range(0, len(indices), chunk_size)])
+    if num_workers == 1 or len(tasks) <= 1:
+        tasks_results = [score_prediction_group(gold_path, dataset, [jobs[i][2] for i in indices], [jobs[i][3] for i in indices]) for gold_path, dataset, indices in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            tasks_results = list(executor.map(score_prediction_group, *zip(*[(gold_path, dataset, [jobs[i][2] for i in indices], [jobs[i][3] for i in indices]) for gold_path, dataset, indices in tasks])))
+    results = [None] * len(jobs)
+    for (_, _, indices), task_results in zip(tasks, tasks_results):
+        for i, result in zip(indices, task_results):
+            results[i] = result
+    return results
+
+def run_official_script(gold_path, dataset, pred_path, na_prob_path=None):
+    """Score a prediction file with the official script (in a subprocess, as before)."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_file = os.path.join(tmp_dir, "eval.json")
+        na_prob_args = [] if na_prob_path is None else ["--na-prob-file", na_prob_path]
+        subprocess.run([sys.executable, os.path.join(EVALUATION_DIR, OFFICIAL_SCRIPTS[dataset]), gold_path, pred_path, "--out-file", out_file] + na_prob_args, check=True, stdout=subprocess.DEVNULL)
+        with open(out_file, 'r') as f1:
+            return json.loads(f1.read())
+
+def check_parity(gold_path, dataset, pred_path, out_eval, na_prob_path=None):
+    """Raise if the in-process evaluation dict differs from the one of the official script (the average precisions are only computed by it with --out-image-dir, so they aren't compared)."""
+    official_eval = run_official_script(gold_path, dataset, pred_path, na_prob_path)
+    out_eval = {k: v for k, v in json.loads(json.dumps(out_eval)).items() if not k.startswith("pr_")}
+    mismatches = {k: (official_eval.get(k), out_eval.get(k)) for k in set(official_eval) | set(out_eval) if official_eval.get(k) != out_eval.get(k)}
+    if mismatches:
+        raise Exception(f"in-process scores of {pred_path} differ from {OFFICIAL_SCRIPTS[dataset]} (official, in-process): {mismatches}")
@@ -0,0 +1,156 @@
+"""
+A single SQLite database with the results of all the evaluations (instead of an xlsx/csv per results dir), keyed by the
+configuration of each result (shot, model, dataset, k_beams, variant, decoding, icl_variant) and its prompt type.
+
+Tables:
+    unanswerability_classification - a row per (configuration, prompt type, label), with the P/R/F1/accuracy/support and
+                                     the confusion counts (label is "un-answerable" or "answerable")
+    QA_task                        - a row per (configuration, prompt type), with the official scripts' metrics
+    probe_evaluation               - a row per (test set configuration, prompt type, features, probe), with the probe's
+                                     accuracy and F1 on the test set (see eval_probe_matrix.py)
+The xlsx (unanswerability classification) and csv (QA task) files of the former layout are generated on demand by
+export_views (or by running this script).
+"""
+import sqlite3
+import pandas as pd
+import os
+import time
+import argparse
+import sys
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from evaluation_utils import QA_TASK_METRICS_MAP, get_config_outdir, create_output_tabular_structure
+
+RESULTS_DB = "results.sqlite"
+CONFIG_COLUMNS = ["shot", "model", "dataset", "k_beams", "variant", "decoding", "icl_variant"]
+UNANSWERABILITY_COLUMNS = ["P", "R", "F1", "accuracy", "support", "tp", "fp", "fn", "tn"]
+UNANSWERABILITY_LABELS = ["un-answerable", "answerable"]
+QA_TASK_COLUMNS = list(QA_TASK_METRICS_MAP.keys())
+PROBE_EVALUATION_COLUMNS = ["accuracy", "unanswerable_F1", "answerable_F1", "support"]
+TABLES = {"unanswerability_classification": (CONFIG_COLUMNS + ["prompt_type", "label"], UNANSWERABILITY_COLUMNS),
+          "QA_task": (CONFIG_COLUMNS + ["prompt_type"], QA_TASK_COLUMNS),
+          "probe_evaluation": (CONFIG_COLUMNS + ["prompt_type", "embedding_type", "aggregation_type", "train_model", "train_dataset", "classifier"], PROBE_EVALUATION_COLUMNS)}
+
+
+def get_where_clause(columns):
+    return " AND ".join(f"{column} = ?" for column in columns)
+
+class ResultsStore:
+    def __init__(self, path):
+        """path: the database file (created if it doesn't exist)"""
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        for table, (key_columns, value_columns) in TABLES.items():
+            columns = [f'{column} TEXT NOT NULL' for column in key_columns] + [f'{column} REAL' for column in value_columns] + ['subdir TEXT', 'updated_at REAL']
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} ({", ".join(columns)}, PRIMARY KEY ({", ".join(key_columns)}))')
+            # the value columns that were added since the table was created
+            existing_columns = {row[1] for row in self.connection.execute(f'PRAGMA table_info({table})')}
+            for column in value_columns:
+                if not column in existing_columns:
+                    self.connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} REAL')
+            # the model and the dataset are also indexed separately, for the queries of a single model/dataset
+            for column in ["model", "dataset"]:
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def upsert(self, table, config, rows, subdir=None):
+        """
+        Replace the results of the configuration in the table.
+        config: the values of CONFIG_COLUMNS (and optionally of more key columns, to only replace the rows with these values too)
+        rows: dicts with the rest of the table's key columns (e.g., the prompt type) and its values (missing values are NULL)
+        """
+        with self.connection:
+            self.connection.execute(f'DELETE FROM {table} WHERE {get_where_clause(config.keys())}', list(config.values()))
+            self._insert(table, config, rows, subdir)
+
+    def upsert_rows(self, table, config, rows, subdir=None):
+        """
+        Insert the rows, replacing only the stored rows with the same (full) key - unlike upsert, the other rows of the
+        configuration are kept (e.g., the scores of the probes that are not re-evaluated on a test set).
+        """
+        with self.connection:
+            self._insert(table, config, rows, subdir, or_replace=True)
+
+    def _insert(self, table, config, rows, subdir, or_replace=False):
+        key_columns, value_columns = TABLES[table]
+        columns = key_columns + value_columns + ["subdir", "updated_at"]
+        updated_at = time.time()
+        values = [[{**config, **row}.get(column) for column in key_columns + value_columns] + [subdir, updated_at] for row in rows]
+        self.connection.executemany(f'INSERT {"OR REPLACE " if or_replace else ""}INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', values)
+
+    def has_results(self, table, config):
+        query = f'SELECT 1 FROM {table} WHERE {get_where_clause(CONFIG_COLUMNS)} LIMIT 1'
+        return self.connection.execute(query, [config[column] for column in CONFIG_COLUMNS]).fetchone() is not None
+
+    def query(self, table, **filters):
+        """The rows of the table (as a dataframe), optionally filtered by the values of columns (e.g., model="Flan-UL2")."""
+        where = f' WHERE {get_where_clause(filters.keys())}' if filters else ""
+        return pd.read_sql_query(f'SELECT * FROM {table}{where}', self.connection, params=list(filters.values()))
+
+def get_unanswerability_view(df):
+    """The former sheets of unanswerability_classification_results.xlsx (prompt type -> table) of a single configuration's rows."""
+    sheets = dict()
+    for prompt_type, prompt_type_df in df.groupby("prompt_type", sort=False):
+        results = {label: prompt_type_df[prompt_type_df["label"] == label].iloc[0].to_dict() for label in UNANSWERABILITY_LABELS}
+        _, labels, data_df = create_output_tabular_structure(results["un-answerable"], results["answerable"])
+        sheets[prompt_type] = pd.DataFrame(data_df, index=labels)
+    return sheets
+
+def get_QA_task_view(df):
+    """The former QA-task-results.csv (a row per prompt type, with the renamed metrics) of a single configuration's rows."""
+    view = df.set_index("prompt_type")[QA_TASK_COLUMNS].dropna(axis=1, how='all')
+    view.index.name = None
+    view = view.astype({column: int for column in view.columns if column.endswith("total")})
+    return view.rename(columns=QA_TASK_METRICS_MAP)
+
+def get_probe_heat_map(df, metric="accuracy"):
+    """The cross-dataset matrix of the probes (a row per train dataset, a column per test dataset, in %) of the rows of a single model, prompt type and features."""
+    heat_map = df.pivot_table(index="train_dataset", columns="dataset", values=metric, aggfunc="mean") * 100
+    order = ["squad", "NQ", "musique"]
+    return heat_map.reindex(index=[dataset for dataset in order if dataset in heat_map.index], columns=[dataset for dataset in order if dataset in heat_map.columns])
+
+def export_views(db_path, outdir, views=("xlsx", "csv"), **filters):
+    """
+    Write the xlsx/csv files of the former layout (under outdir/{shot}/{model}/{dataset}/{k_beams}/{variant}/{decoding}[/{icl_variant}]).
+    filters: only export the configurations with these values (e.g., model="Flan-UL2")
+    returns: the paths of the written files
+    """
+    outpaths = []
+    with ResultsStore(db_path) as store:
+        if "xlsx" in views:
+            df = store.query("unanswerability_classification", **filters)
+            for config, config_df in df.groupby(CONFIG_COLUMNS, sort=False):
+                outpaths.append(os.path.join(get_config_outdir(dict(zip(CONFIG_COLUMNS, config)), outdir), "unanswerability_classification_results.xlsx"))
+                # each prompt type - in a separate sheet
+                with pd.ExcelWriter(outpaths[-1], engine='openpyxl') as writer:
+                    for prompt_type, curr_df_scores in get_unanswerability_view(config_df).items():
+                        curr_df_scores.to_excel(writer, sheet_name=prompt_type)
+        if "csv" in views:
+            df = store.query("QA_task", **filters)
+            for config, config_df in df.groupby(CONFIG_COLUMNS, sort=False):
+                outpaths.append(os.path.join(get_config_outdir(dict(zip(CONFIG_COLUMNS, config)), outdir), "QA-task-results.csv"))
+                get_QA_task_view(config_df).to_csv(outpaths[-1])
+    return outpaths
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="export the xlsx/csv views of the results store.")
+    argparser.add_argument("--db", type=str, default=os.path.join("evaluation_results", RESULTS_DB), help="path to the results store.")
+    argparser.add_argument("--outdir", type=str, default="evaluation_results", help="where to write the views.")
+    argparser.add_argument("--views", nargs='+', type=str, default=["xlsx", "csv"], choices=["xlsx", "csv"], help="xlsx - the unanswerability classification results, csv - the QA-task results.")
+    for column in CONFIG_COLUMNS:
+        argparser.add_argument(f"--{column.replace('_', '-')}", type=str, default=None, help=f"only export the results with this {column}.")
+    args = argparser.parse_args()
+    filters = {column: getattr(args, column) for column in CONFIG_COLUMNS if getattr(args, column) is not None}
+    outpaths = export_views(args.db, args.outdir, args.views, **filters)
+    print(f"wrote {len(outpaths)} files under {args.outdir}")
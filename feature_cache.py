@@ -0,0 +1,161 @@
+"""
+Content-hash keyed cache of the feature matrices, shared by the probes, the eraser, the classifier evaluation and the plots.
+
+Each entry is keyed by the content hash of the source artifact plus the extraction parameters, and holds ready-to-use
+features.npy, row_to_instance.npy, labels.npy (0 for un-answerable, 1 for answerable), ids.json and outputs.json.
+A changed source artifact gets a new content hash (so a new entry), and its stale entries are removed.
+The content hashes are memoized by the files' (size, mtime), so unchanged artifacts are not re-read.
+When the cache exceeds its size cap, the least recently used entries are evicted.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+from feature_extraction import get_aggregation_type, load_features
+
+# Set the logging level to INFO
+logging.basicConfig(level=logging.INFO)
+
+FEATURE_CACHE_VERSION = 1
+DEFAULT_CACHE_MAX_GB = 50.0
+HASH_INDEX_FILE = "hash_index.json"
+
+
+def _get_stat_signature(path):
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [[os.path.basename(path), stat.st_size, stat.st_mtime_ns]]
+    signature = []
+    for subdir, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            stat = os.stat(os.path.join(subdir, name))
+            signature.append([os.path.relpath(os.path.join(subdir, name), path), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+def _update_hasher(hasher, file_path):
+    with open(file_path, 'rb') as f1:
+        for chunk in iter(lambda: f1.read(1 << 24), b''):
+            hasher.update(chunk)
+
+def compute_content_hash(path):
+    """Hash the contents of an artifact (a pt file, or all the files of a columnar artifact)."""
+    hasher = hashlib.blake2b(digest_size=16)
+    if not os.path.isdir(path):
+        _update_hasher(hasher, path)
+        return hasher.hexdigest()
+    for subdir, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            hasher.update(os.path.relpath(os.path.join(subdir, name), path).encode())
+            _update_hasher(hasher, os.path.join(subdir, name))
+    return hasher.hexdigest()
+
+def _write_json_atomically(obj, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f1:
+        f1.write(json.dumps(obj))
+    os.replace(tmp_path, path)
+
+def get_content_hash(path, cache_dir):
+    """Return the content hash of the artifact, recomputing it only if its files' sizes or modification times changed."""
+    index_path = os.path.join(cache_dir, HASH_INDEX_FILE)
+    hash_index = dict()
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f1:
+            hash_index = json.loads(f1.read())
+    abs_path = os.path.abspath(path)
+    signature = _get_stat_signature(abs_path)
+    if abs_path in hash_index and hash_index[abs_path]["signature"] == signature:
+        return hash_index[abs_path]["hash"]
+    content_hash = compute_content_hash(abs_path)
+    hash_index[abs_path] = {"signature": signature, "hash": content_hash}
+    _write_json_atomically(hash_index, index_path)
+    return content_hash
+
+def get_cache_key(content_hash, prompt_type, embedding_type, aggregation_type, num_instances, dtype):
+    params = [FEATURE_CACHE_VERSION, content_hash, prompt_type, embedding_type, get_aggregation_type(aggregation_type), num_instances, np.dtype(dtype).name]
+    return hashlib.blake2b(json.dumps(params).encode(), digest_size=16).hexdigest()
+
+def _get_entries(cache_dir):
+    entries = []
+    for name in os.listdir(cache_dir):
+        meta_path = os.path.join(cache_dir, name, "meta.json")
+        if not os.path.isfile(meta_path):
+            continue
+        with open(meta_path, 'r') as f1:
+            meta = json.loads(f1.read())
+        meta.update({"dir": os.path.join(cache_dir, name), "last_used": os.stat(meta_path).st_mtime})
+        entries.append(meta)
+    return entries
+
+def _remove_stale_entries(cache_dir, meta):
+    """Remove the entries of the same source and extraction parameters, that were extracted from older contents of the source."""
+    for entry in _get_entries(cache_dir):
+        if entry["source"] == meta["source"] and entry["params"] == meta["params"] and entry["content_hash"] != meta["content_hash"]:
+            logging.info(f"removing stale feature cache entry of {entry['source']}")
+            shutil.rmtree(entry["dir"], ignore_errors=True)
+
+def evict(cache_dir, max_size_gb):
+    """Evict the least recently used entries until the cache is under max_size_gb."""
+    entries = sorted(_get_entries(cache_dir), key=lambda entry: entry["last_used"])
+    total_bytes = sum(entry["n_bytes"] for entry in entries)
+    for entry in entries:
+        if total_bytes <= max_size_gb * 1024**3:
+            break
+        logging.info(f"evicting feature cache entry of {entry['source']} ({entry['n_bytes']/1024**2:.0f}MiB)")
+        shutil.rmtree(entry["dir"], ignore_errors=True)
+        total_bytes -= entry["n_bytes"]
+
+def _get_label(path):
+    return 0 if "un-answerable" in os.path.basename(path) else 1
+
+def _store_entry(entry_dir, features, row_to_instance, ids, outputs, meta):
+    tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    np.save(os.path.join(tmp_dir, "features.npy"), features)
+    np.save(os.path.join(tmp_dir, "row_to_instance.npy"), row_to_instance)
+    np.save(os.path.join(tmp_dir, "labels.npy"), np.full(len(features), _get_label(meta["source"]), dtype=np.int8))
+    with open(os.path.join(tmp_dir, "ids.json"), 'w') as f1:
+        f1.write(json.dumps(ids))
+    with open(os.path.join(tmp_dir, "outputs.json"), 'w') as f1:
+        f1.write(json.dumps(outputs))
+    meta["n_bytes"] = sum(os.path.getsize(os.path.join(tmp_dir, name)) for name in os.listdir(tmp_dir))
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as f1:
+        f1.write(json.dumps(meta))
+    if os.path.exists(entry_dir): # stored concurrently by another process
+        shutil.rmtree(tmp_dir)
+    else:
+        os.rename(tmp_dir, entry_dir)
+
+def _load_entry(entry_dir):
+    os.utime(os.path.join(entry_dir, "meta.json")) # mark as recently used
+    features = np.load(os.path.join(entry_dir, "features.npy"), mmap_mode="r")
+    row_to_instance = np.load(os.path.join(entry_dir, "row_to_instance.npy"))
+    with open(os.path.join(entry_dir, "ids.json"), 'r') as f1:
+        ids = json.loads(f1.read())
+    with open(os.path.join(entry_dir, "outputs.json"), 'r') as f1:
+        outputs = json.loads(f1.read())
+    return features, row_to_instance, ids, outputs
+
+def load_cached_features(path, prompt_type, embedding_type, aggregation_type, num_instances=None, dtype=np.float32, cache_dir=None, max_size_gb=DEFAULT_CACHE_MAX_GB):
+    """Like feature_extraction.load_features, but served from (and stored to) the feature cache under cache_dir (if cache_dir is None - no caching)."""
+    if cache_dir is None:
+        return load_features(path, prompt_type, embedding_type, aggregation_type, num_instances, dtype)
+    os.makedirs(cache_dir, exist_ok=True)
+    content_hash = get_content_hash(path, cache_dir)
+    entry_dir = os.path.join(cache_dir, get_cache_key(content_hash, prompt_type, embedding_type, aggregation_type, num_instances, dtype))
+    if os.path.isdir(entry_dir):
+        logging.info(f"loading {embedding_type} features of {path} from the feature cache")
+        return _load_entry(entry_dir)
+
+    features, row_to_instance, ids, outputs = load_features(path, prompt_type, embedding_type, aggregation_type, num_instances, dtype)
+    meta = {"source": os.path.abspath(path),
+            "content_hash": content_hash,
+            "params": [prompt_type, embedding_type, get_aggregation_type(aggregation_type), num_instances, np.dtype(dtype).name]}
+    _store_entry(entry_dir, features, row_to_instance, ids, outputs, meta)
+    _remove_stale_entries(cache_dir, meta)
+    evict(cache_dir, max_size_gb)
+    return features, row_to_instance, ids, outputs
@@ -0,0 +1,184 @@
+"""
+Vectorized extraction of (N, d) feature matrices from the captured hidden states, shared by the probes, the eraser and the plots.
+
+All the aggregations take the first beam's generation steps up to the EOS (see artifact_utils.EOS_ID):
+    only_first_tkn - the first generated token's hidden state (one row per instance)
+    average        - the average over the generation steps (one row per instance)
+    union          - every generation step is a row of its own
+Each extraction also returns the instance index of every row (row_to_instance).
+iter_features yields the same features a chunk of instances at a time, for consumers that can't hold the whole matrix
+(e.g., the union rows of a full train set - see train_streaming_probe.py).
+load_layer_features returns the first generated token's state at every captured layer ((N, layers, d), from the
+layers_first_tkn_embedding field that is saved with --capture-layers).
+"""
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from artifact_utils import COLUMNAR_SUFFIX, EOS_ID, ColumnarArtifact, load_responses, log_load_stats
+
+AGGREGATION_TYPES = ["only_first_tkn", "average", "union"]
+AGGREGATION_ALIASES = {"only_first": "only_first_tkn", # train_concept_eraser.py's name
+                       "aggregated": "union"} # PCA_plots_generation.py's name
+
+
+def get_aggregation_type(aggregation_type):
+    aggregation_type = AGGREGATION_ALIASES.get(aggregation_type, aggregation_type)
+    if not aggregation_type in AGGREGATION_TYPES:
+        raise Exception(f"--aggregation-type did not receive a valid option. Only one of {', '.join(repr(a) for a in AGGREGATION_TYPES)}")
+    return aggregation_type
+
+def _get_first_beam_steps(instance, embedding_type):
+    value = instance[embedding_type]
+    if embedding_type == "first_hidden_embedding": # a single (input-averaged) vector per instance
+        return (value if value.dim() == 1 else value.mean(dim=0)).unsqueeze(0).float()
+    if torch.is_tensor(value):
+        value = [value]
+    # either a list of beams (each of steps x dim), or a list of the generation steps of a single beam (few-shot format)
+    return value[0].float() if value[0].dim() == 2 else torch.stack(value).float()
+
+def pad_instances(instances, embedding_type):
+    """Return the first beam's hidden states of the instances padded to (B, T, d), and the mask of the steps before the EOS (B, T)."""
+    steps = [_get_first_beam_steps(instance, embedding_type) for instance in instances]
+    n_steps = torch.tensor([len(s) for s in steps])
+    padded = pad_sequence(steps, batch_first=True)
+    if embedding_type != "first_hidden_embedding" and all("all_outputs_ids" in instance.keys() for instance in instances):
+        ids = pad_sequence([instance["all_outputs_ids"][0] for instance in instances], batch_first=True, padding_value=-1)
+        eos_mask = ids.eq(EOS_ID)
+        # the index of the first EOS (if no EOS then no "padding" and so can take all steps)
+        eos_index = torch.where(eos_mask.any(dim=1), eos_mask.int().argmax(dim=1), n_steps)
+        lengths = torch.minimum(eos_index, n_steps)
+    else:
+        lengths = n_steps
+    steps_mask = torch.arange(padded.shape[1]).unsqueeze(0) < lengths.unsqueeze(1)
+    return padded, steps_mask
+
+def _aggregate_padded(padded, steps_mask, aggregation_type):
+    lengths = steps_mask.sum(dim=1)
+    if aggregation_type == "union":
+        return padded[steps_mask], torch.arange(len(lengths)).repeat_interleave(lengths)
+    valid_instances = torch.nonzero(lengths > 0, as_tuple=True)[0]
+    if aggregation_type == "only_first_tkn":
+        features = padded[valid_instances, 0]
+    else:
+        features = (padded * steps_mask.unsqueeze(-1)).sum(dim=1)[valid_instances] / lengths[valid_instances].unsqueeze(1)
+    return features, valid_instances
+
+def extract_features(instances, embedding_type, aggregation_type, dtype=np.float32, batch_size=1024):
+    """Extract the features of instances in the pt files' structure (dicts with embedding_type and "all_outputs_ids"), batch_size instances at a time."""
+    aggregation_type = get_aggregation_type(aggregation_type)
+    all_features, all_row_to_instance = [], []
+    for batch_start in range(0, len(instances), batch_size):
+        padded, steps_mask = pad_instances(instances[batch_start:batch_start+batch_size], embedding_type)
+        features, row_to_instance = _aggregate_padded(padded, steps_mask, aggregation_type)
+        all_features.append(features.numpy().astype(dtype, copy=False))
+        all_row_to_instance.append(row_to_instance.numpy() + batch_start)
+    if not all_features:
+        return np.zeros((0, 0), dtype=dtype), np.zeros(0, dtype=np.int64)
+    return np.concatenate(all_features), np.concatenate(all_row_to_instance)
+
+def extract_ragged_features(ragged, aggregation_type, dtype=np.float32):
+    """Extract the features of a columnar artifact's ragged field (artifact_utils.RaggedArray, already truncated at the EOS)."""
+    aggregation_type = get_aggregation_type(aggregation_type)
+    starts = ragged.offsets[:-1][::ragged.beams_per_instance]
+    lengths = ragged.lengths(beam_i=0)
+    if aggregation_type == "union":
+        row_to_instance = np.repeat(np.arange(len(lengths)), lengths)
+        # the row of the j-th step of instance i is starts[i]+j
+        rows = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(int(lengths.sum()))
+        return np.asarray(ragged.values[rows], dtype=dtype), row_to_instance
+
+    valid_instances = np.flatnonzero(lengths > 0)
+    starts, lengths = starts[valid_instances], lengths[valid_instances]
+    if aggregation_type == "only_first_tkn":
+        features = np.asarray(ragged.values[starts], dtype=dtype)
+    elif len(valid_instances) == 0:
+        features = np.zeros((0,) + ragged.values.shape[1:], dtype=dtype)
+    else:
+        # only the rows of these instances are read (or decoded) - the values are shared with the whole field (see RaggedArray.head/slice)
+        window_start, window_end = int(starts[0]), int(starts[-1] + lengths[-1])
+        values = np.asarray(ragged.values[window_start:window_end])
+        # sum each [start, end) range in one pass (interleaving the ends, whose sums are then dropped)
+        boundaries = np.stack([starts, starts + lengths], axis=1).reshape(-1) - window_start
+        if boundaries[-1] == len(values):
+            boundaries = boundaries[:-1]
+        sums = np.add.reduceat(values, boundaries, axis=0, dtype=np.float32)[::2]
+        features = (sums / lengths[:, None]).astype(dtype, copy=False)
+    return features, valid_instances
+
+def load_features(path, prompt_type, embedding_type, aggregation_type, num_instances=None, dtype=np.float32):
+    """
+    Load the features of a single artifact (pt file or columnar).
+    Returns the (N, d) feature matrix, the instance index of every row, and the ids and outputs of the artifact's instances.
+    """
+    with log_load_stats(f"{embedding_type} features of {path} ({prompt_type}, {aggregation_type})"):
+        if path.endswith(COLUMNAR_SUFFIX):
+            artifact = ColumnarArtifact(path)
+            num_instances = artifact.n_instances if num_instances is None else min(num_instances, artifact.n_instances)
+            ragged = artifact.ragged(prompt_type, embedding_type).head(num_instances)
+            features, row_to_instance = extract_ragged_features(ragged, aggregation_type, dtype)
+            return features, row_to_instance, artifact.text("ids")[:num_instances], artifact.outputs(prompt_type)[:num_instances]
+        responses = load_responses(path,
+                                   prompt_types=[prompt_type],
+                                   fields=[embedding_type, "all_outputs_ids"],
+                                   text_columns=["ids"],
+                                   num_instances=num_instances)
+        features, row_to_instance = extract_features(responses[prompt_type], embedding_type, aggregation_type, dtype)
+        return features, row_to_instance, responses["ids"], [elem["outputs"] for elem in responses[prompt_type]]
+
+def iter_features(path, prompt_type, embedding_type, aggregation_type, chunk_instances=256, num_instances=None, dtype=np.float32):
+    """
+    Like load_features, but yields the features of chunk_instances instances at a time (with the instance index of every row),
+    so the whole feature matrix is never materialized. Of a columnar artifact only the chunk's rows are read (memory-mapped),
+    while a pt file is still loaded whole (convert it with post_processing/pt_to_columnar.py for a bounded memory).
+    """
+    if path.endswith(COLUMNAR_SUFFIX):
+        artifact = ColumnarArtifact(path)
+        num_instances = artifact.n_instances if num_instances is None else min(num_instances, artifact.n_instances)
+        ragged = artifact.ragged(prompt_type, embedding_type)
+        for chunk_start in range(0, num_instances, chunk_instances):
+            features, row_to_instance = extract_ragged_features(ragged.slice(chunk_start, min(chunk_start+chunk_instances, num_instances)), aggregation_type, dtype)
+            yield features, row_to_instance + chunk_start
+    else:
+        instances = load_responses(path,
+                                   prompt_types=[prompt_type],
+                                   fields=[embedding_type, "all_outputs_ids"],
+                                   text_columns=[],
+                                   num_instances=num_instances)[prompt_type]
+        for chunk_start in range(0, len(instances), chunk_instances):
+            features, row_to_instance = extract_features(instances[chunk_start:chunk_start+chunk_instances], embedding_type, aggregation_type, dtype)
+            yield features, row_to_instance + chunk_start
+
+LAYERS_FIELD = "layers_first_tkn_embedding"
+
+def load_layer_features(path, prompt_type, layers=None, num_instances=None, dtype=np.float32):
+    """
+    Load the first generated token's state at the captured layers of a single artifact (pt file or columnar).
+    layers: the positions (in the captured layers) to load (None - all of them)
+    Returns the (N, layers, d) feature array, the instance index of every row (the instances whose first generated token is
+    the EOS are dropped, as in only_first_tkn), and the ids and outputs of the artifact's instances.
+    """
+    with log_load_stats(f"{LAYERS_FIELD} features of {path} ({prompt_type})"):
+        if path.endswith(COLUMNAR_SUFFIX):
+            artifact = ColumnarArtifact(path)
+            num_instances = artifact.n_instances if num_instances is None else min(num_instances, artifact.n_instances)
+            ragged = artifact.ragged(prompt_type, LAYERS_FIELD).head(num_instances)
+            ids_ragged = artifact.ragged(prompt_type, "all_outputs_ids").head(num_instances)
+            ids_starts, ids_lengths = ids_ragged.offsets[:-1][::ids_ragged.beams_per_instance], ids_ragged.lengths(beam_i=0)
+            first_ids = np.full(len(ids_starts), EOS_ID)
+            first_ids[ids_lengths > 0] = np.asarray(ids_ragged.values[ids_starts[ids_lengths > 0]])
+            valid_instances = np.flatnonzero(first_ids != EOS_ID)
+            features = np.asarray(ragged.values[ragged.offsets[:-1][::ragged.beams_per_instance][valid_instances]], dtype=dtype)
+            ids, outputs = artifact.text("ids")[:num_instances], artifact.outputs(prompt_type)[:num_instances]
+        else:
+            responses = load_responses(path,
+                                       prompt_types=[prompt_type],
+                                       fields=[LAYERS_FIELD, "all_outputs_ids"],
+                                       text_columns=["ids"],
+                                       num_instances=num_instances)
+            instances = responses[prompt_type]
+            valid_instances = np.array([i for i, instance in enumerate(instances) if len(instance["all_outputs_ids"][0]) > 0 and int(instance["all_outputs_ids"][0][0]) != EOS_ID], dtype=np.int64)
+            features = np.stack([instances[i][LAYERS_FIELD].float().numpy() for i in valid_instances]).astype(dtype, copy=False) if len(valid_instances) else np.zeros((0, 0, 0), dtype=dtype)
+            ids, outputs = responses["ids"], [instance["outputs"] for instance in instances]
+        if layers is not None:
+            features = features[:, layers]
+        return features, valid_instances, ids, outputs
@@ -10,6 +10,10 @@ import argparse
 from pathlib import Path
 import logging
 from utils import *
+from artifact_utils import OUTPUT_FORMATS, STORAGE_DTYPES, COMPRESSIONS, get_artifact_path, get_fields_storage_dtype, save_responses
+from run_manifest import RUN_MANIFEST_FILE, RunManifest
+from projection import Projector, load_projection, copy_projection
+from leace import OnlineStatistics, get_statistics_path
 from post_processing.pt_to_benchmarks_evaluate_format import main as pt_to_evaluate_format_converter
 # Set the logging level to INFO
 logging.basicConfig(level=logging.INFO)
@@ -59,17 +63,17 @@ def get_responses_unanswerable_questions_squad(p_variant, icl_variant, data_type
         if "Unanswerablity-Reason" in data[0].keys():
             responses["Unanswerablity-Reason"].extend([sample["Unanswerablity-Reason"] for sample in curr_data])
 
-        responses["Regular-Prompt"].extend(HF_request([sample['Regular-Prompt'] for sample in curr_data], **kwargs))
-        responses["Hint-Prompt"].extend(HF_request([sample['Hint-Prompt'] for sample in curr_data], **kwargs))
-        responses["Ablation1"].extend(HF_request([sample['Ablation1'] for sample in curr_data], **kwargs))
-        responses["Ablation2"].extend(HF_request([sample['Ablation2'] for sample in curr_data], **kwargs))
+        responses["Regular-Prompt"].extend(HF_request([sample['Regular-Prompt'] for sample in curr_data], prompt_type='Regular-Prompt', **kwargs))
+        responses["Hint-Prompt"].extend(HF_request([sample['Hint-Prompt'] for sample in curr_data], prompt_type='Hint-Prompt', **kwargs))
+        responses["Ablation1"].extend(HF_request([sample['Ablation1'] for sample in curr_data], prompt_type='Ablation1', **kwargs))
+        responses["Ablation2"].extend(HF_request([sample['Ablation2'] for sample in curr_data], prompt_type='Ablation2', **kwargs))
 
         # Chain-of-Thought prompts
         if args.CoT_prompt:
-            responses["Regular-Prompt-CoT"].extend(HF_request([sample['Regular-Prompt-CoT'] for sample in curr_data], **kwargs))
-            responses["Hint-Prompt-CoT"].extend(HF_request([sample['Hint-Prompt-CoT'] for sample in curr_data], **kwargs))
-            responses["Ablation1-CoT"].extend(HF_request([sample['Ablation1-CoT'] for sample in curr_data], **kwargs))
-            responses["Ablation2-CoT"].extend(HF_request([sample['Ablation2-CoT'] for sample in curr_data], **kwargs))
+            responses["Regular-Prompt-CoT"].extend(HF_request([sample['Regular-Prompt-CoT'] for sample in curr_data], prompt_type='Regular-Prompt-CoT', **kwargs))
+            responses["Hint-Prompt-CoT"].extend(HF_request([sample['Hint-Prompt-CoT'] for sample in curr_data], prompt_type='Hint-Prompt-CoT', **kwargs))
+            responses["Ablation1-CoT"].extend(HF_request([sample['Ablation1-CoT'] for sample in curr_data], prompt_type='Ablation1-CoT', **kwargs))
+            responses["Ablation2-CoT"].extend(HF_request([sample['Ablation2-CoT'] for sample in curr_data], prompt_type='Ablation2-CoT', **kwargs))
         else:
             responses["Regular-Prompt-CoT"].extend([""]*batch_size)
             responses["Hint-Prompt-CoT"].extend([""]*batch_size)
@@ -78,10 +82,10 @@ def get_responses_unanswerable_questions_squad(p_variant, icl_variant, data_type
 
         # Binary Answerability prompts ("Is it answerable?")
         if args.binary_answerability_prompt:
-            responses["Answerability"].extend(HF_request([sample['Answerability'] for sample in curr_data], **kwargs))
+            responses["Answerability"].extend(HF_request([sample['Answerability'] for sample in curr_data], prompt_type='Answerability', **kwargs))
             
             if args.CoT_prompt:
-                responses["Answerability-CoT"].extend(HF_request([sample['Answerability-CoT'] for sample in curr_data], **kwargs))
+                responses["Answerability-CoT"].extend(HF_request([sample['Answerability-CoT'] for sample in curr_data], prompt_type='Answerability-CoT', **kwargs))
             else:
                 responses["Answerability-CoT"].extend([""]*batch_size)
         else:
@@ -134,17 +138,17 @@ def get_responses_unanswerable_questions_NQ(p_variant, icl_variant, data_type, a
         responses["ids"].extend([sample["example_id"] for sample in curr_data])
         responses["annotation_ids"].extend([sample["annotation_id"] for sample in curr_data])
 
-        responses["Regular-Prompt"].extend(HF_request([sample['Regular-Prompt'] for sample in curr_data], **kwargs))
-        responses["Hint-Prompt"].extend(HF_request([sample['Hint-Prompt'] for sample in curr_data], **kwargs))
-        responses["Ablation1"].extend(HF_request([sample['Ablation1'] for sample in curr_data], **kwargs))
-        responses["Ablation2"].extend(HF_request([sample['Ablation2'] for sample in curr_data], **kwargs))
+        responses["Regular-Prompt"].extend(HF_request([sample['Regular-Prompt'] for sample in curr_data], prompt_type='Regular-Prompt', **kwargs))
+        responses["Hint-Prompt"].extend(HF_request([sample['Hint-Prompt'] for sample in curr_data], prompt_type='Hint-Prompt', **kwargs))
+        responses["Ablation1"].extend(HF_request([sample['Ablation1'] for sample in curr_data], prompt_type='Ablation1', **kwargs))
+        responses["Ablation2"].extend(HF_request([sample['Ablation2'] for sample in curr_data], prompt_type='Ablation2', **kwargs))
 
         # Chain-of-Thought prompts
         if args.CoT_prompt:
-            responses["Regular-Prompt-CoT"].extend(HF_request([sample['Regular-Prompt-CoT'] for sample in curr_data], **kwargs))
-            responses["Hint-Prompt-CoT"].extend(HF_request([sample['Hint-Prompt-CoT'] for sample in curr_data], **kwargs))
-            responses["Ablation1-CoT"].extend(HF_request([sample['Ablation1-CoT'] for sample in curr_data], **kwargs))
-            responses["Ablation2-CoT"].extend(HF_request([sample['Ablation2-CoT'] for sample in curr_data], **kwargs))
+            responses["Regular-Prompt-CoT"].extend(HF_request([sample['Regular-Prompt-CoT'] for sample in curr_data], prompt_type='Regular-Prompt-CoT', **kwargs))
+            responses["Hint-Prompt-CoT"].extend(HF_request([sample['Hint-Prompt-CoT'] for sample in curr_data], prompt_type='Hint-Prompt-CoT', **kwargs))
+            responses["Ablation1-CoT"].extend(HF_request([sample['Ablation1-CoT'] for sample in curr_data], prompt_type='Ablation1-CoT', **kwargs))
+            responses["Ablation2-CoT"].extend(HF_request([sample['Ablation2-CoT'] for sample in curr_data], prompt_type='Ablation2-CoT', **kwargs))
         else:
             responses["Regular-Prompt-CoT"].extend([""]*batch_size)
             responses["Hint-Prompt-CoT"].extend([""]*batch_size)
@@ -153,10 +157,10 @@ def get_responses_unanswerable_questions_NQ(p_variant, icl_variant, data_type, a
 
         # Binary Answerability prompts ("Is it answerable?")
         if args.binary_answerability_prompt:
-            responses["Answerability"].extend(HF_request([sample['Answerability'] for sample in curr_data], **kwargs))
+            responses["Answerability"].extend(HF_request([sample['Answerability'] for sample in curr_data], prompt_type='Answerability', **kwargs))
             
             if args.CoT_prompt:
-                responses["Answerability-CoT"].extend(HF_request([sample['Answerability-CoT'] for sample in curr_data], **kwargs))
+                responses["Answerability-CoT"].extend(HF_request([sample['Answerability-CoT'] for sample in curr_data], prompt_type='Answerability-CoT', **kwargs))
             else:
                 responses["Answerability-CoT"].extend([""]*batch_size)
         else:
@@ -207,17 +211,17 @@ def get_responses_unanswerable_questions_musique(p_variant, icl_variant, data_ty
         curr_data = data[batch_i*batch_size:(batch_i+1)*batch_size]
         responses["ids"].extend([sample["id"] for sample in curr_data])
 
-        responses["Regular-Prompt"].extend(HF_request([sample['Regular-Prompt'] for sample in curr_data], **kwargs))
-        responses["Hint-Prompt"].extend(HF_request([sample['Hint-Prompt'] for sample in curr_data], **kwargs))
-        responses["Ablation1"].extend(HF_request([sample['Ablation1'] for sample in curr_data], **kwargs))
-        responses["Ablation2"].extend(HF_request([sample['Ablation2'] for sample in curr_data], **kwargs))
+        responses["Regular-Prompt"].extend(HF_request([sample['Regular-Prompt'] for sample in curr_data], prompt_type='Regular-Prompt', **kwargs))
+        responses["Hint-Prompt"].extend(HF_request([sample['Hint-Prompt'] for sample in curr_data], prompt_type='Hint-Prompt', **kwargs))
+        responses["Ablation1"].extend(HF_request([sample['Ablation1'] for sample in curr_data], prompt_type='Ablation1', **kwargs))
+        responses["Ablation2"].extend(HF_request([sample['Ablation2'] for sample in curr_data], prompt_type='Ablation2', **kwargs))
 
         # Chain-of-Thought prompts
         if args.CoT_prompt:
-            responses["Regular-Prompt-CoT"].extend(HF_request([sample['Regular-Prompt-CoT'] for sample in curr_data], **kwargs))
-            responses["Hint-Prompt-CoT"].extend(HF_request([sample['Hint-Prompt-CoT'] for sample in curr_data], **kwargs))
-            responses["Ablation1-CoT"].extend(HF_request([sample['Ablation1-CoT'] for sample in curr_data], **kwargs))
-            responses["Ablation2-CoT"].extend(HF_request([sample['Ablation2-CoT'] for sample in curr_data], **kwargs))
+            responses["Regular-Prompt-CoT"].extend(HF_request([sample['Regular-Prompt-CoT'] for sample in curr_data], prompt_type='Regular-Prompt-CoT', **kwargs))
+            responses["Hint-Prompt-CoT"].extend(HF_request([sample['Hint-Prompt-CoT'] for sample in curr_data], prompt_type='Hint-Prompt-CoT', **kwargs))
+            responses["Ablation1-CoT"].extend(HF_request([sample['Ablation1-CoT'] for sample in curr_data], prompt_type='Ablation1-CoT', **kwargs))
+            responses["Ablation2-CoT"].extend(HF_request([sample['Ablation2-CoT'] for sample in curr_data], prompt_type='Ablation2-CoT', **kwargs))
         else:
             responses["Regular-Prompt-CoT"].extend([""]*batch_size)
             responses["Hint-Prompt-CoT"].extend([""]*batch_size)
@@ -226,10 +230,10 @@ def get_responses_unanswerable_questions_musique(p_variant, icl_variant, data_ty
 
         # Binary Answerability prompts ("Is it answerable?")
         if args.binary_answerability_prompt:
-            responses["Answerability"].extend(HF_request([sample['Answerability'] for sample in curr_data], **kwargs))
+            responses["Answerability"].extend(HF_request([sample['Answerability'] for sample in curr_data], prompt_type='Answerability', **kwargs))
 
             if args.CoT_prompt:
-                responses["Answerability-CoT"].extend(HF_request([sample['Answerability-CoT'] for sample in curr_data], **kwargs))
+                responses["Answerability-CoT"].extend(HF_request([sample['Answerability-CoT'] for sample in curr_data], prompt_type='Answerability-CoT', **kwargs))
             else:
                 responses["Answerability-CoT"].extend([""]*batch_size)
         else:
@@ -241,7 +245,7 @@ def get_responses_unanswerable_questions_musique(p_variant, icl_variant, data_ty
 
     return responses
 
-def HF_request(prompts, k_beams, tokenizer, model, output_max_length, prompt_suffix, return_only_generated_text):
+def HF_request(prompts, k_beams, tokenizer, model, output_max_length, prompt_suffix, return_only_generated_text, capture_layers=None, projector=None, statistics=None, prompt_type=None):
     prompts = [f"{p}{prompt_suffix}" if not p.strip().endswith(prompt_suffix) else p for p in prompts]
     input_ids = tokenizer.batch_encode_plus(prompts, 
                                             padding=True,
@@ -255,13 +259,18 @@ def HF_request(prompts, k_beams, tokenizer, model, output_max_length, prompt_suf
                              return_dict_in_generate=True, 
                              num_beams=k_beams, 
                              early_stopping=True)
+    if statistics is not None:
+        statistics.update_first_step(prompt_type, outputs, k_beams)
     outputs_logits = [s.to("cpu") for s in outputs.scores]
 
     if "decoder_hidden_states" in outputs.keys(): # in the case of encoder-decoder models (Flan-T5-xxl and Flan-UL2)
-        outputs_last_hidden_embeddings = [s[-1][:,-1,:].to("cpu") for s in outputs.decoder_hidden_states]
+        outputs_last_hidden_embeddings = [(s[-1][:,-1,:] if projector is None else projector(s[-1][:,-1,:])).to("cpu") for s in outputs.decoder_hidden_states]
     else: # in the case of decoder-only models (OPT-IML)
-        outputs_last_hidden_embeddings = [s[-1][:,-1,:].to("cpu") for s in outputs.hidden_states]
+        outputs_last_hidden_embeddings = [(s[-1][:,-1,:] if projector is None else projector(s[-1][:,-1,:])).to("cpu") for s in outputs.hidden_states]
     
+    if capture_layers is not None and not return_only_generated_text:
+        outputs_layers_first_tkn_embeddings = get_first_token_layers(outputs, capture_layers)
+
     if model.config.model_type in ["t5", "bart", "led"]:
         outputs_sequences = outputs.sequences.to("cpu")
     else:
@@ -273,10 +282,14 @@ def HF_request(prompts, k_beams, tokenizer, model, output_max_length, prompt_suf
     return_dicts = []
     for batch_i in range(batch_size):
         curr_return_dict = {"outputs":decoded_outputs[batch_i*k_beams:(batch_i+1)*k_beams]}
+        if "sequences_scores" in outputs.keys(): # in beam search - the (length-normalized) log-probability of each of the returned beams
+            curr_return_dict["sequences_scores"] = outputs.sequences_scores[batch_i*k_beams:(batch_i+1)*k_beams].tolist()
         if not return_only_generated_text:
             curr_return_dict["all_outputs_ids"] = outputs_sequences[batch_i*k_beams:(batch_i+1)*k_beams]
             curr_return_dict["full_logits"] = [curr_logits[batch_i*k_beams] for curr_logits in outputs_logits]
             curr_return_dict["last_hidden_embedding"] = [curr_last_hidden_embedding[batch_i*k_beams] for curr_last_hidden_embedding in outputs_last_hidden_embeddings]
+            if capture_layers is not None:
+                curr_return_dict["layers_first_tkn_embedding"] = outputs_layers_first_tkn_embeddings[batch_i*k_beams] # of the first beam
 
             if torch.any(curr_return_dict["all_outputs_ids"] == 1): 
                 curr_max_sentence = int(torch.max((curr_return_dict["all_outputs_ids"] == 1).nonzero(as_tuple=False)[:, 1]))
@@ -341,12 +354,16 @@ def main(args):
     now_str = now.strftime("%d-%m-%Y_%H:%M:%S")
     outdir_path = args.outdir if args.outdir else os.path.join("generated_outputs", now_str)
     logging.info(f'saving to: {outdir_path}')
+    # the configuration of every artifact is recorded in the run manifest (read by the evaluation, probes and plots)
+    run_manifest = RunManifest(os.path.join(outdir_path, RUN_MANIFEST_FILE))
+    run_manifest.record_run(args)
     datasets_list = get_all_relevant_datasets(args)
     if args.k_beams_grid_search is None:
         k_beams_list = [args.k_beams]
     else:
         k_beams_list = json.loads(args.k_beams_grid_search)
     
+    projector = None if args.projection is None else Projector(load_projection(args.projection))
     model = None
     for model_name in args.models:
         if model: # free up memory to enable loading the next model
@@ -354,6 +371,8 @@ def main(args):
             gc.collect()
             torch.cuda.empty_cache()
         model = get_model(args, model_name)
+        capture_layers = None if args.return_only_generated_text else get_capture_layers(model['kwargs']['model'], args.capture_layers)
+        statistics_layers = get_capture_layers(model['kwargs']['model'], args.capture_layers) # also without the hidden states
         for p_variant in args.prompt_variant:
             for icl_variant in args.icl_examples_variant:
                 for k_beams in k_beams_list:
@@ -366,10 +385,13 @@ def main(args):
                         path.mkdir(parents=True, exist_ok=True)
                         curr_outdir = os.path.join(curr_outdir, f"{dataset['type']}_{dataset['data_name']}.pt")
  
-                        if os.path.exists(curr_outdir):
-                            print(f"{curr_outdir} exists! skipping...")
+                        artifact_config = dict(model=model['output_subdir'], shot="few_shot", k_beams=k_beams, variant=p_variant, icl_variant=f"icl_examples_v{icl_variant}", dataset=dataset['data_name'], data_type=dataset['type'], split=None, output_format=args.output_format)
+                        if os.path.exists(get_artifact_path(curr_outdir, args.output_format)):
+                            print(f"{get_artifact_path(curr_outdir, args.output_format)} exists! skipping...")
+                            run_manifest.record_artifact(get_artifact_path(curr_outdir, args.output_format), **artifact_config)
                             continue
 
+                        statistics = OnlineStatistics(label=0 if dataset['type'] == "un-answerable" else 1, layers=statistics_layers) if args.accumulate_statistics else None
                         responses = dataset['get_data_function'](p_variant=p_variant,
                                                                  icl_variant=icl_variant,
                                                                  data_type=dataset['type'],
@@ -379,16 +401,20 @@ def main(args):
                                                                  tokenizer=model['kwargs']['tokenizer'], 
                                                                  model=model['kwargs']['model'], 
                                                                  prompt_suffix=model['kwargs']['prompt_suffix'], 
-                                                                 return_only_generated_text=args.return_only_generated_text)
-                        torch.save(responses, curr_outdir)
+                                                                 return_only_generated_text=args.return_only_generated_text, 
+                                                                 capture_layers=capture_layers, 
+                                                                 projector=projector, 
+                                                                 statistics=statistics)
+                        outpath = save_responses(responses, curr_outdir, args.output_format, 
+                                       storage_dtype=get_fields_storage_dtype(args.storage_dtype, args.logits_storage_dtype), 
+                                       compression=args.compression)
+                        run_manifest.record_artifact(outpath, **artifact_config, **({} if capture_layers is None else {"captured_layers": capture_layers}), **({} if projector is None else {"projection": os.path.basename(copy_projection(args.projection, outpath))}), **({} if statistics is None else {"statistics": os.path.basename(statistics.save(get_statistics_path(outpath)))}))
 
     # if not only_answerable_instances and not only_unanswerable_instances - namely we have both answerable and answerable prompts - then convert the pt files to the formats adhering to the evaluation scripts
     if not args.only_answerable_instances and not args.only_unanswerable_instances:
-        pt_to_evaluate_format_converter(indirs=[outdir_path], is_beam_experiment=False)
-
-        # if in beams larger than 1 - also run the conversion to the beam relaxation
-        if [k for k in k_beams_list if k>1]:
-            pt_to_evaluate_format_converter(indirs=[outdir_path], is_beam_experiment=True)
+        # if in beams larger than 1 - also run the conversion to the beam relaxation (in the same pass)
+        decoding_types = ["regular_decoding", "beam_relaxation"] if [k for k in k_beams_list if k>1] else ["regular_decoding"]
+        pt_to_evaluate_format_converter(indirs=[outdir_path], decoding_types=decoding_types)
 
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser(description="")
@@ -401,6 +427,9 @@ if __name__ == '__main__':
     argparser.add_argument("--prompt-variant", nargs='+', type=str, default=["variant1"], help="prompt variant list (any of variant1, variant2, variant3).")
     argparser.add_argument("--icl-examples-variant", nargs='+', type=str, default=["1"], help="in-context-learning variant list (any of 1, 2, 3).")
     argparser.add_argument("--return-only-generated-text", action='store_true', default=False, help="whether to return only the generated text, without the logits (in cases of OOM)")
+    argparser.add_argument("--projection", type=str, default=None, help="project the hidden states (last_hidden_embedding) with this projection (saved by projection.py) on the device, and store the projected vectors. A copy of the projection is saved next to every artifact.")
+    argparser.add_argument("--accumulate-statistics", action='store_true', default=False, help="accumulate the running statistics (count, sum and sum of outer products, in float64 on the device) of the first generated token's last hidden state (and of the --capture-layers) of every prompt type, and save them next to every artifact (<artifact>.stats.npz) - enough for train_concept_eraser.py --from-statistics, also with --return-only-generated-text.")
+    argparser.add_argument("--capture-layers", nargs='+', type=str, default=None, help="also save the first generated token's state at every layer (\"all\") or at the given layer indices (0 is the embedding layer, negative indices count from the last layer), as a single (layers, d) block per instance.")
     argparser.add_argument("--batch-size", type=int, default=1, help="size of batch.")
     argparser.add_argument("--model-max-length", type=int, default=2048, help="max input length of model (for datasets like NQ where inputs are very long).")
     argparser.add_argument("--output-max-length", type=int, default=100, help="max output length.")
@@ -408,6 +437,10 @@ if __name__ == '__main__':
     argparser.add_argument("--only-unanswerable-instances", action='store_true', default=False, help="send only the un-answerable prompts.")
     argparser.add_argument("--CoT-prompt", action='store_true', default=False, help="whether to also send CoT prompt")
     argparser.add_argument("--binary-answerability-prompt", action='store_true', default=False, help="whether to also send the binary answerability prompt ('Is the question answerable by the passage?').")
+    argparser.add_argument("--output-format", type=str, default="columnar", choices=OUTPUT_FORMATS, help="how to save the responses: a columnar artifact (text sidecar + memory-mapped float16 tensors), or a single pt file.")
+    argparser.add_argument("--storage-dtype", type=str, default="float16", choices=STORAGE_DTYPES, help="dtype to store the hidden states in (columnar output format only). int8 is quantized with a per-row scale.")
+    argparser.add_argument("--logits-storage-dtype", type=str, default="float16", choices=STORAGE_DTYPES, help="dtype to store the full logits in (columnar output format only).")
+    argparser.add_argument("--compression", type=str, default=None, choices=COMPRESSIONS, help="compress the stored tensors in blocks of rows (columnar output format only).")
     args = argparser.parse_args()
     main(args)
 
@@ -1,6 +1,5 @@
 import numpy as np
 from tqdm import tqdm
-import torch
 
 import os
 from sklearn.decomposition import PCA
@@ -8,34 +7,16 @@ import umap.umap_ as umap
 import plotly.graph_objects as go
 import argparse
 from pathlib import Path
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from run_manifest import get_run_config, iter_artifacts
+from abstention_matcher import are_unanswerable
+from feature_cache import DEFAULT_CACHE_MAX_GB, load_cached_features
 
 
 
 
 
-def adapt_hidden_embeddings(instance):
-    
-    # if the embeddings of all the generation steps were saved in a single matrix, rather than in a list, separate them
-    if len(instance['last_hidden_embedding'][-1].shape) == 2:
-        instance['last_hidden_embedding'] = [instance['last_hidden_embedding'][0][i,:] for i in range(instance['last_hidden_embedding'][0].shape[0])]
-
-
-    # removing the paddings
-    # Compare all elements to 1
-    if "all_outputs_ids" in instance.keys():
-        matches = instance['all_outputs_ids'][0,:].eq(1)
-
-        # Find the first non-zero element in matches
-        indices = matches.nonzero(as_tuple=True)
-
-        # Get the first index where value is 1 (if no 1 then no "padding" and so can take all embeddings)
-        filter_index = indices[0][0].item() if indices[0].numel() != 0 else len(instance['last_hidden_embedding'])
-    else:
-        filter_index = len(instance['last_hidden_embedding'])
-
-    filtered_hidden_embedding = instance['last_hidden_embedding'][:filter_index]
-    return filtered_hidden_embedding
-
 def get_data_name(full_file_path):
     if "squad" in full_file_path:
         return "squad"
@@ -47,6 +28,9 @@ def get_data_name(full_file_path):
         raise Exception(f"dataset name not found in {full_file_path}")
 
 def get_model_name(curr_indir):
+    run_config = get_run_config(curr_indir) # recorded by the generation scripts (None for runs without a run manifest)
+    if run_config is not None and run_config.get("model") is not None:
+        return run_config["model"]
     if "Flan-UL2" in curr_indir:
         return "Flan-UL2"
     elif "Flan-T5-xxl" in curr_indir:
@@ -59,49 +43,29 @@ def get_model_name(curr_indir):
 
 
 
-def get_response(options):
-    unanswerable_replies = ["unanswerable", "n/a", "idk", "i don't know", "not known", "answer not in context"]
-    unanswerable_replies_exact = ['nan', 'unknown', 'no answer', 'it is unknown', "none of the above", 'none of the above choices']
-    for option in options:
-        option = str(option).lower().strip()
-        if any(option==elem1 for elem1 in unanswerable_replies_exact) or any(option==f"{elem1}." for elem1 in unanswerable_replies_exact) or any(elem2 in option for elem2 in unanswerable_replies):
-            return "unanswerable"
-    return options[0]
-
-
-def get_data(curr_indir, prompt_type, embedding_type):
-    full_pt_dicts = dict()
-
-    for subdir, dirs, files in os.walk(curr_indir):
-        for file in files:
-            if not file.endswith(".pt"):
-                continue
-            curr_data = torch.load(os.path.join(subdir, file))
-            curr_data_name = get_data_name(os.path.join(subdir, file))
+def get_data(curr_indir, prompt_type, embedding_type, aggregation_type, feature_cache_dir=None, feature_cache_max_gb=DEFAULT_CACHE_MAX_GB):
+    embeddings, outputs = dict(), dict()
 
-            if file.startswith("un-answerable"):
-                
-                full_pt_dicts["unanswerable"] = curr_data
+    for subdir, file in iter_artifacts(curr_indir):
+        curr_data_name = get_data_name(os.path.join(subdir, file))
 
+        if file.startswith("un-answerable"):
+            data_type = "unanswerable"
+        elif file.startswith("answerable"):
+            data_type = "answerable"
+        else:
+            raise Exception(f"{file} file doesn't start with \"unanswerable\" nor with \"answerable\".")
 
+        embeddings[data_type], row_to_instance, _, all_outputs = load_cached_features(os.path.join(subdir, file), 
+                                                                                      prompt_type=prompt_type, 
+                                                                                      embedding_type=embedding_type, 
+                                                                                      aggregation_type=aggregation_type, 
+                                                                                      cache_dir=feature_cache_dir, 
+                                                                                      max_size_gb=feature_cache_max_gb)
+        # the actual text output of the instance of each embedding
+        outputs[data_type] = [all_outputs[i][0] for i in row_to_instance]
 
-                if embedding_type == "first_hidden_embedding":
-                    unanswerable_all_embeddings = [instance[embedding_type] for instance in curr_data[prompt_type]]
-                else:
-                    unanswerable_all_embeddings = [torch.stack(adapt_hidden_embeddings(instance)) for instance in curr_data[prompt_type]]
-            
-
-            elif file.startswith("answerable"):
-                full_pt_dicts["answerable"] = curr_data
-
-                if embedding_type == "first_hidden_embedding":
-                    answerable_all_embeddings = [instance[embedding_type] for instance in curr_data[prompt_type]]
-                else:
-                    answerable_all_embeddings = [torch.stack(adapt_hidden_embeddings(instance)) for instance in curr_data[prompt_type]]
-            else:
-                raise Exception(f"{file} file doesn't start with \"unanswerable\" nor with \"answerable\".")
-    
-    return unanswerable_all_embeddings, answerable_all_embeddings, full_pt_dicts, curr_data_name
+    return embeddings["unanswerable"], embeddings["answerable"], outputs["unanswerable"], outputs["answerable"], curr_data_name
 
 
 
@@ -203,39 +167,17 @@ def main(args):
     outdir_path_cls.mkdir(parents=True, exist_ok=True)
 
     for indir in tqdm(indirs):
-        unanswerable_all_embeddings, answerable_all_embeddings, full_pt_dicts, curr_data_name = get_data(indir, prompt_type, embedding_type)
-
-
-
-        if embedding_type == "first_hidden_embedding":
-            unanswerable_embeddings = [elem.cpu().numpy() for elem in unanswerable_all_embeddings]
-            answerable_embeddings = [elem.cpu().numpy() for elem in answerable_all_embeddings]
-        elif aggregation_type == "only_first_tkn":
-            unanswerable_embeddings = [elem.squeeze()[0,:].cpu().numpy()  if len(elem.shape)>2 else elem[0,:].cpu().numpy() for elem in unanswerable_all_embeddings]
-            answerable_embeddings = [elem.squeeze()[0,:].cpu().numpy()  if len(elem.shape)>2 else elem[0,:].cpu().numpy() for elem in answerable_all_embeddings]
-        elif aggregation_type == "average":
-            unanswerable_embeddings = [elem.mean(dim=0).cpu().numpy() for elem in unanswerable_all_embeddings]
-            answerable_embeddings = [elem.mean(dim=0).cpu().numpy() for elem in answerable_all_embeddings]
-        elif aggregation_type == "aggregated":
-            unanswerable_instances = [(emb.cpu().numpy(), instance["outputs"][0]) for instance in full_pt_dicts["unanswerable"][prompt_type] for emb in adapt_hidden_embeddings(instance)]
-            answerable_instances = [(emb.cpu().numpy(), instance["outputs"][0]) for instance in full_pt_dicts["answerable"][prompt_type] for emb in adapt_hidden_embeddings(instance)]
-
-            unanswerable_embeddings = [elem[0] for elem in unanswerable_instances]
-            answerable_embeddings = [elem[0] for elem in answerable_instances]
-        else:
-            raise Exception(f'aggregation_type can only be any of any of "average", "only_first_tkn" and "aggregated", but got {aggregation_type}')
-
-        # Extracting Actual Text Outputs
-        unanswerable_outputs = [elem["outputs"][0] for elem in full_pt_dicts["unanswerable"][prompt_type]]
-        answerable_outputs = [elem["outputs"][0] for elem in full_pt_dicts["answerable"][prompt_type]]
+        unanswerable_embeddings, answerable_embeddings, unanswerable_outputs, answerable_outputs, curr_data_name = get_data(indir, prompt_type, embedding_type, aggregation_type, args.feature_cache_dir, args.feature_cache_max_gb)
 
 
         # separate questions into "unanswerable" replies and other
-        unanswerable_identifies_as_unanswerable = [unanswerable_embeddings[i] for i,txt in enumerate(unanswerable_outputs) if get_response([txt])=="unanswerable"]
-        unanswerable_identifies_as_answerable = [unanswerable_embeddings[i] for i,txt in enumerate(unanswerable_outputs) if get_response([txt])!="unanswerable"]
+        unanswerable_replied_unanswerable = are_unanswerable(unanswerable_outputs)
+        unanswerable_identifies_as_unanswerable = unanswerable_embeddings[unanswerable_replied_unanswerable]
+        unanswerable_identifies_as_answerable = unanswerable_embeddings[~unanswerable_replied_unanswerable]
 
-        answerable_identified_as_unanswerable = [answerable_embeddings[i] for i,txt in enumerate(answerable_outputs) if get_response([txt])=="unanswerable"]
-        answerable_identified_as_answerable = [answerable_embeddings[i] for i,txt in enumerate(answerable_outputs) if get_response([txt])!="unanswerable"]
+        answerable_replied_unanswerable = are_unanswerable(answerable_outputs)
+        answerable_identified_as_unanswerable = answerable_embeddings[answerable_replied_unanswerable]
+        answerable_identified_as_answerable = answerable_embeddings[~answerable_replied_unanswerable]
 
         # Stack all vectors
         combined_data = np.vstack((unanswerable_identifies_as_unanswerable, unanswerable_identifies_as_answerable, answerable_identified_as_unanswerable, answerable_identified_as_answerable))
@@ -262,5 +204,7 @@ if __name__ == '__main__':
     argparser.add_argument('--prompt-type', type=str, default="Regular-Prompt", help='prompt type to classify ("Regular-Prompt" or "Hint-Prompt")')
     argparser.add_argument('--aggregation-type', type=str, default="only_first_tkn", help='how to aggregate all the hidden layers of all the generated tokens of a single instance (choose from "average" to average them, "union" to treat each of them as an instance, and "only_first_tkn" to only take the first token\'s hidden layers).')
     argparser.add_argument('--embedding-type', type=str, default="last_hidden_embedding", help='which layer to take: any one of "last_hidden_embedding" and "first_hidden_embedding"')
+    argparser.add_argument('--feature-cache-dir', type=str, default=None, help='dir of the feature cache (keyed by the artifacts\' content hash), shared with the other probing, erasure and plotting scripts. If None - no caching.')
+    argparser.add_argument('--feature-cache-max-gb', type=float, default=DEFAULT_CACHE_MAX_GB, help='size cap of the feature cache (least recently used entries are evicted).')
     args = argparser.parse_args()
     main(args)
\ No newline at end of file
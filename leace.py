@@ -0,0 +1,270 @@
+"""
+LEACE (LEAst-squares Concept Erasure) of the answerability concept, fitted from streamed sufficient statistics instead of a
+materialized feature matrix.
+
+LeaceStatistics accumulates, in float64 on the CPU, the count, the sum and the sum of outer products of the hidden states, and
+the count and sum of the answerable (label 1) ones - enough for the mean, the covariance and the cross-covariance with the
+(binary) label. fit_leace then computes the eraser once, with the defaults of concept_erasure's LeaceFitter (which
+ConceptEraser.fit(X, y) of the former eraser.pkl files uses):
+    the covariance is shrunk (the optimal linear shrinkage toward a scaled identity)
+    W  = the inverse square root of the covariance (whitening) on its eigenvalues above svd_tol, W+ its pseudo-inverse
+    u  = the (normalized) whitened cross-covariance (zero - no erasure - if its norm isn't above svd_tol)
+    eraser(x) = x - W+ u u^T W (x - mean)
+    if the erasure increases the trace of the covariance, it is blended toward the orthogonal projection (I - u u^T), so
+    that it doesn't (this matters as zero_shot_erasure_prompting.py applies the eraser at every decoding step)
+The cross-covariance of a binary label has rank 1, so everything but the eigendecomposition is a rank-1 (or rank-2)
+computation. benchmarks/leace_parity.py checks the erased features against concept_erasure's.
+
+The eraser is saved as plain tensors (eraser.pt), so it can be loaded on any device (or on a machine without a GPU).
+
+OnlineStatistics accumulates the same statistics during generation (--accumulate-statistics of the generation scripts), on
+the device of the hidden states, per (prompt type, layer) of the first generated token, and saves them next to the artifact
+(<artifact>.stats.npz). Since every artifact holds a single data type, the statistics of the un-answerable and the answerable
+artifacts are merged to fit the eraser (or any other estimator of the class means and covariances) without the hidden states.
+"""
+import pickle
+import numpy as np
+import torch
+from artifact_utils import get_artifact_stem
+
+ERASER_FILE = "eraser.pt"
+STATISTICS_SUFFIX = ".stats.npz"
+LAST_LAYER = "last" # the key of the last hidden state (the layer of last_hidden_embedding and of the eraser)
+
+
+class LeaceStatistics:
+    """The float64 sufficient statistics of the hidden states (and of the answerable ones) for fitting LEACE."""
+    def __init__(self, dim=None):
+        self.n, self.n_positive = 0, 0
+        self.sum_x = self.sum_xx = self.sum_positive = None
+        if dim is not None:
+            self._init(dim)
+
+    def _init(self, dim):
+        self.sum_x = np.zeros(dim)
+        self.sum_xx = np.zeros((dim, dim))
+        self.sum_positive = np.zeros(dim)
+
+    @property
+    def dim(self):
+        return None if self.sum_x is None else len(self.sum_x)
+
+    def update(self, X, y, batch_rows=4096):
+        """Add rows (n, d) and their labels (n,) - 0 (un-answerable) or 1 (answerable) - batch_rows rows at a time (each is cast to float64)."""
+        if len(X) == 0:
+            return
+        if self.sum_x is None:
+            self._init(X.shape[1])
+        y = np.asarray(y)
+        for batch_start in range(0, len(X), batch_rows):
+            X_batch = np.asarray(X[batch_start:batch_start+batch_rows], dtype=np.float64)
+            positive = y[batch_start:batch_start+batch_rows] > 0
+            self.n += len(X_batch)
+            self.n_positive += int(positive.sum())
+            self.sum_x += X_batch.sum(axis=0)
+            self.sum_xx += X_batch.T @ X_batch
+            self.sum_positive += X_batch[positive].sum(axis=0)
+
+    def merge(self, other):
+        if other.sum_x is None:
+            return self
+        if self.sum_x is None:
+            self._init(other.dim)
+        self.n += other.n
+        self.n_positive += other.n_positive
+        self.sum_x += other.sum_x
+        self.sum_xx += other.sum_xx
+        self.sum_positive += other.sum_positive
+        return self
+
+    def save(self, path):
+        np.savez(path, n=self.n, n_positive=self.n_positive, sum_x=self.sum_x, sum_xx=self.sum_xx, sum_positive=self.sum_positive)
+        return path
+
+    @staticmethod
+    def load(path):
+        stats = LeaceStatistics()
+        with np.load(path) as data:
+            stats.n, stats.n_positive = int(data["n"]), int(data["n_positive"])
+            stats.sum_x, stats.sum_xx, stats.sum_positive = data["sum_x"], data["sum_xx"], data["sum_positive"]
+        return stats
+
+class LeaceEraser:
+    """x - proj_left @ proj_right @ (x - mean), with plain float32 tensors (moved to the device and dtype of the hidden states on the first use)."""
+    def __init__(self, mean, proj_left, proj_right):
+        self.mean = mean
+        self.proj_left = proj_left # (d, rank)
+        self.proj_right = proj_right # (rank, d)
+        self._tensors = dict()
+
+    def to(self, device):
+        return LeaceEraser(self.mean.to(device), self.proj_left.to(device), self.proj_right.to(device))
+
+    def _get_tensors(self, device, dtype):
+        if not (device, dtype) in self._tensors.keys():
+            self._tensors[(device, dtype)] = tuple(tensor.to(device=device, dtype=dtype) for tensor in [self.mean, self.proj_left, self.proj_right])
+        return self._tensors[(device, dtype)]
+
+    def __call__(self, x):
+        mean, proj_left, proj_right = self._get_tensors(x.device, x.dtype)
+        return x - ((x - mean) @ proj_right.T) @ proj_left.T
+
+    def save(self, path):
+        torch.save({"mean": self.mean.cpu(), "proj_left": self.proj_left.cpu(), "proj_right": self.proj_right.cpu()}, path)
+        return path
+
+    @staticmethod
+    def load(path, device="cpu"):
+        state = torch.load(path, map_location=device)
+        return LeaceEraser(state["mean"], state["proj_left"], state["proj_right"])
+
+def optimal_linear_shrinkage(S, n):
+    """The optimal linear shrinkage of a sample covariance S (of n rows) toward tr(S)/p * I (as concept_erasure's optimal_linear_shrinkage)."""
+    p = len(S)
+    trace_S = np.trace(S)
+    sigma0_norm_sq = trace_S ** 2 / p # the squared Frobenius norm of tr(S)/p * I (and its inner product with S)
+    top = trace_S ** 2 * sigma0_norm_sq / n
+    bottom = np.sum(S ** 2) * sigma0_norm_sq - sigma0_norm_sq ** 2
+    eps = np.finfo(S.dtype).eps
+    alpha = 1 - (top + eps) / (bottom + eps)
+    beta = (1 - alpha) * (sigma0_norm_sq + eps) / (sigma0_norm_sq + eps)
+    return alpha * S + beta * np.eye(p) * trace_S / p
+
+def constrain_cov_trace(sigma_xx, proj_left, proj_right, u):
+    """
+    LeaceFitter's constrain_cov_trace: if the erasure P = I - proj_left @ proj_right increases the trace of the covariance,
+    blend it with the orthogonal projection Q = I - u u^T (alpha * P + (1 - alpha) * Q) so that the trace is kept. The traces
+    are computed from the rank-1 factors, and the blended eraser is returned as its rank-2 factors.
+    """
+    l, r = proj_left[:, 0], proj_right[0]
+    sigma_l, sigma_r, sigma_u = sigma_xx @ l, sigma_xx @ r, sigma_xx @ u
+    old_trace = np.trace(sigma_xx)
+    new_trace = old_trace - 2 * r @ sigma_l + (r @ sigma_r) * (l @ l) # tr(P sigma P^T)
+    if new_trace <= old_trace:
+        return proj_left, proj_right
+    x, w = new_trace, old_trace
+    y = 2 * (old_trace - r @ sigma_l - u @ sigma_u + (r @ sigma_u) * (u @ l)) # 2 tr(P sigma Q^T)
+    z = old_trace - 2 * u @ sigma_u + (u @ sigma_u) * (u @ u) # tr(Q sigma Q^T)
+    # the mixture of P and Q whose trace is the trace of the original covariance
+    discr = np.sqrt(4 * w * x - 4 * w * y + 4 * w * z - 4 * x * z + y ** 2)
+    alpha1 = (-y / 2 + z - discr / 2) / (x - y + z)
+    alpha2 = (-y / 2 + z + discr / 2) / (x - y + z)
+    alpha = float(np.clip(alpha1 if alpha1 > 0 else alpha2, 0, 1))
+    # I - (alpha * P + (1 - alpha) * Q) = alpha * l r^T + (1 - alpha) * u u^T
+    return np.stack([alpha * l, (1 - alpha) * u], axis=1), np.stack([r, u])
+
+def fit_leace(stats, svd_tol=0.01, shrinkage=True, constrain_trace=True):
+    """
+    Fit the eraser from the statistics (in float64, on the CPU), with the defaults of concept_erasure's LeaceFitter.
+    svd_tol: the smallest eigenvalue of the covariance (and singular value of the whitened cross-covariance) that is kept
+    """
+    if stats.n < 2 or stats.n_positive in [0, stats.n]:
+        raise Exception(f"LEACE needs the hidden states of both labels (got {stats.n_positive} answerable out of {stats.n})")
+    mean = stats.sum_x / stats.n
+    sigma_xx = stats.sum_xx - stats.n * np.outer(mean, mean)
+    sigma_xx = (sigma_xx + sigma_xx.T) / 2
+    sigma_xx = optimal_linear_shrinkage(sigma_xx / stats.n, stats.n) if shrinkage else sigma_xx / (stats.n - 1)
+    sigma_xz = (stats.sum_positive - mean * stats.n_positive) / (stats.n - 1) # the cross-covariance with the (0/1) label
+
+    # the inverse square root of the covariance (on its eigenvalues above svd_tol), and its pseudo-inverse
+    eigenvalues, eigenvectors = np.linalg.eigh(sigma_xx)
+    kept = eigenvalues > svd_tol
+    W = (eigenvectors[:, kept] / np.sqrt(eigenvalues[kept])) @ eigenvectors[:, kept].T
+    W_inv = (eigenvectors[:, kept] * np.sqrt(eigenvalues[kept])) @ eigenvectors[:, kept].T
+
+    u = W @ sigma_xz
+    u_norm = np.linalg.norm(u)
+    u = u / u_norm if u_norm > svd_tol else np.zeros_like(u)
+    proj_left = (W_inv @ u)[:, None]
+    proj_right = (u @ W)[None, :]
+    if constrain_trace and u_norm > svd_tol:
+        proj_left, proj_right = constrain_cov_trace(sigma_xx, proj_left, proj_right, u)
+    return LeaceEraser(*(torch.from_numpy(value.astype(np.float32)) for value in [mean, proj_left, proj_right]))
+
+def load_eraser(path, device="cpu"):
+    """Load an eraser saved by train_concept_eraser.py (eraser.pt), or a pickled ConceptEraser of its former versions (eraser.pkl)."""
+    if path.endswith(".pkl"):
+        with open(path, "rb") as file:
+            return pickle.load(file).to(device)
+    return LeaceEraser.load(path, device)
+
+def get_statistics_path(artifact_path):
+    """The statistics (of OnlineStatistics) that are saved next to an artifact."""
+    return f"{get_artifact_stem(artifact_path)}{STATISTICS_SUFFIX}"
+
+class OnlineStatistics:
+    """
+    The running statistics of the first generated token's hidden states of an artifact's instances (of a single label), per
+    (prompt type, layer): the last hidden state, and the hidden states of the given layers (indices into the model's hidden
+    states, as in --capture-layers).
+    The float64 sums are kept on the CPU, so their d x d matrices don't take the device's memory: the (half-precision)
+    states of each batch are moved to the CPU (in float32, which holds them exactly), and are added to the sums every
+    flush_rows rows, in a single matmul.
+    """
+    def __init__(self, label, layers=None, flush_rows=1024):
+        self.label = label
+        self.layers = [] if layers is None else list(layers)
+        self.flush_rows = flush_rows
+        self._sums = dict()
+        self._buffers = dict()
+
+    def update(self, key, hidden_states):
+        buffer = self._buffers.setdefault(key, [])
+        buffer.append(hidden_states.detach().to("cpu", torch.float32))
+        if sum(len(rows) for rows in buffer) >= self.flush_rows:
+            self._flush(key)
+
+    def _flush(self, key):
+        buffer = self._buffers.pop(key, [])
+        if not buffer:
+            return
+        hidden_states = torch.cat(buffer).to(torch.float64)
+        if not key in self._sums.keys():
+            self._sums[key] = {"n": 0,
+                               "sum_x": torch.zeros(hidden_states.shape[1], dtype=torch.float64),
+                               "sum_xx": torch.zeros((hidden_states.shape[1], hidden_states.shape[1]), dtype=torch.float64)}
+        sums = self._sums[key]
+        sums["n"] += len(hidden_states)
+        sums["sum_x"] += hidden_states.sum(dim=0)
+        sums["sum_xx"].addmm_(hidden_states.T, hidden_states)
+
+    def update_first_step(self, prompt_type, outputs, k_beams):
+        """Add the first decoding step's states of a batch (the output of model.generate, with the hidden states) - of the first beam, as all the beams share it."""
+        first_step = outputs.decoder_hidden_states[0] if "decoder_hidden_states" in outputs.keys() else outputs.hidden_states[0]
+        self.update((prompt_type, LAST_LAYER), first_step[-1][::k_beams, -1, :])
+        for layer in self.layers:
+            self.update((prompt_type, layer), first_step[layer][::k_beams, -1, :])
+
+    def get_statistics(self):
+        """The LeaceStatistics of every (prompt type, layer)."""
+        for key in list(self._buffers.keys()):
+            self._flush(key)
+        all_stats = dict()
+        for key, sums in self._sums.items():
+            stats = LeaceStatistics()
+            stats.n, stats.sum_x, stats.sum_xx = sums["n"], sums["sum_x"].numpy(), sums["sum_xx"].numpy()
+            stats.n_positive, stats.sum_positive = (stats.n, stats.sum_x.copy()) if self.label > 0 else (0, np.zeros_like(stats.sum_x))
+            all_stats[key] = stats
+        return all_stats
+
+    def save(self, path):
+        save_statistics(self.get_statistics(), path)
+        return path
+
+def save_statistics(all_stats, path):
+    arrays = dict()
+    for (prompt_type, layer), stats in all_stats.items():
+        for field in ["n", "n_positive", "sum_x", "sum_xx", "sum_positive"]:
+            arrays[f"{prompt_type}/{layer}/{field}"] = np.asarray(getattr(stats, field))
+    np.savez(path, **arrays)
+
+def load_statistics(path):
+    """The LeaceStatistics of every (prompt type, layer) of a statistics file (the layers are ints, or LAST_LAYER)."""
+    all_stats = dict()
+    with np.load(path) as data:
+        for name in data.files:
+            prompt_type, layer, field = name.split("/")
+            key = (prompt_type, layer if layer == LAST_LAYER else int(layer))
+            stats = all_stats.setdefault(key, LeaceStatistics())
+            setattr(stats, field, int(data[name]) if field in ["n", "n_positive"] else data[name])
+    return all_stats
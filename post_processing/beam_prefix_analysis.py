@@ -0,0 +1,146 @@
+"""
+Beam-relaxation results for every k <= K from the ranked beams of a single K-beam run.
+
+The k-beam run is approximated by the k highest-scored beams of the K-beam run: an instance is "any beam" unanswerable at k
+if any of its top-k beams is unanswerable, and "top beam" unanswerable if its highest-scored beam is.
+For the un-answerable instances, the percentage of "unanswerable" replies is the QA task's F1 (and EM) on the un-answerable
+instances, and for the answerable instances it is the percentage of false abstentions.
+If true k-beam runs (with the same layout, under k_beams_<k> instead of k_beams_<K>) exist on (a sample of) the same instances,
+the gap between the derived and the true results is also reported.
+"""
+import pandas as pd
+import numpy as np
+from tqdm import tqdm
+import os
+import re
+import argparse
+import sys
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from artifact_utils import SCORES_FIELD, get_artifact_stem, load_responses, list_artifacts
+from run_manifest import iter_artifacts, get_run_config
+from abstention_matcher import are_unanswerable
+
+DATA_NAMES = ["squad", "NQ", "musique"]
+SEED = 42
+
+
+def rank_beams(outputs, scores):
+    """The outputs of the beams from the highest to the lowest sequence score (as returned, if the scores weren't saved)."""
+    if scores is None:
+        return list(outputs)
+    return [outputs[i] for i in np.argsort(-np.asarray(scores, dtype=np.float64), kind="stable")]
+
+def load_ranked_outputs(path):
+    """Return the ids, and the ranked beams' outputs of each instance of each prompt type."""
+    responses = load_responses(path, fields=[SCORES_FIELD], text_columns=["ids"])
+    ranked_outputs = {key:[rank_beams(elem["outputs"], elem.get(SCORES_FIELD)) for elem in value] for key,value in responses.items() if key != "ids"}
+    return responses["ids"], ranked_outputs
+
+def get_beam_abstentions(ranked_outputs, max_k=None):
+    """
+    ranked_outputs: the ranked beams' outputs of each instance (at least max_k beams per instance)
+    returns: any_beam - (instances, max_k) whether any of the top-k beams is unanswerable (column k-1), and top_beam - (instances,) whether the top beam is.
+    """
+    max_k = min(len(outputs) for outputs in ranked_outputs) if max_k is None else max_k
+    matches = are_unanswerable(np.array([outputs[:max_k] for outputs in ranked_outputs], dtype=object)).reshape(len(ranked_outputs), max_k)
+    return np.logical_or.accumulate(matches, axis=1), matches[:, 0]
+
+def get_num_beams(path):
+    run_config = get_run_config(path)
+    if run_config is not None and run_config.get("k_beams") is not None:
+        return int(run_config["k_beams"])
+    num_beams = re.search(r"k_beams_(\d+)", path)
+    return int(num_beams.group(1)) if num_beams else None
+
+def get_data_name(file_name):
+    data_names = [data_name for data_name in DATA_NAMES if data_name in file_name]
+    return data_names[0] if data_names else None
+
+def analyze_artifact(file, ranked_outputs):
+    """The any-beam and top-beam abstention rate for every k <= K, for each prompt type of the artifact."""
+    data_type = "un-answerable" if "un-answerable" in file else "answerable"
+    rows = []
+    for prompt_type, outputs in ranked_outputs.items():
+        if not outputs:
+            continue
+        any_beam, top_beam = get_beam_abstentions(outputs)
+        for k in range(1, any_beam.shape[1]+1):
+            rows.append({"dataset": get_data_name(file),
+                         "prompt type": prompt_type,
+                         "k": k,
+                         f"any beam ({data_type})": round(100 * float(any_beam[:, k-1].mean()), 2),
+                         f"top beam ({data_type})": round(100 * float(top_beam.mean()), 2)})
+    return rows
+
+def get_true_run_path(subdir, file, num_beams, k):
+    """The path of the same artifact in the true k-beam run (None if it doesn't exist)."""
+    true_subdir = subdir.replace(f"k_beams_{num_beams}", f"k_beams_{k}")
+    true_files = [true_file for true_file in list_artifacts(true_subdir) if get_artifact_stem(true_file) == get_artifact_stem(file)] if os.path.isdir(true_subdir) else []
+    return os.path.join(true_subdir, true_files[0]) if true_files else None
+
+def get_approximation_gap(subdir, file, ids, ranked_outputs, sample_size=None):
+    """Compare the results derived from the K-beam artifact with the true k-beam runs (for every k < K that was run), on the instances of both."""
+    num_beams = get_num_beams(subdir)
+    if num_beams is None:
+        return []
+    id_to_index = {curr_id: i for i, curr_id in enumerate(ids)}
+    rows = []
+    for k in range(1, num_beams):
+        true_path = get_true_run_path(subdir, file, num_beams, k)
+        if true_path is None:
+            continue
+        true_ids, true_ranked_outputs = load_ranked_outputs(true_path)
+        sample = [i for i, curr_id in enumerate(true_ids) if curr_id in id_to_index]
+        if sample_size is not None and len(sample) > sample_size:
+            sample = sorted(np.random.default_rng(SEED).choice(sample, size=sample_size, replace=False).tolist())
+        for prompt_type, true_outputs in true_ranked_outputs.items():
+            if not prompt_type in ranked_outputs.keys() or not sample:
+                continue
+            derived_any_beam, derived_top_beam = get_beam_abstentions([ranked_outputs[prompt_type][id_to_index[true_ids[i]]] for i in sample], max_k=k)
+            true_any_beam, true_top_beam = get_beam_abstentions([true_outputs[i] for i in sample], max_k=k)
+            rows.append({"subdir": subdir,
+                         "file": get_artifact_stem(file),
+                         "prompt type": prompt_type,
+                         "k": k,
+                         "n": len(sample),
+                         "any beam (derived)": round(100 * float(derived_any_beam[:, -1].mean()), 2),
+                         "any beam (true)": round(100 * float(true_any_beam[:, -1].mean()), 2),
+                         "top beam (derived)": round(100 * float(derived_top_beam.mean()), 2),
+                         "top beam (true)": round(100 * float(true_top_beam.mean()), 2),
+                         "any beam agreement": round(100 * float((derived_any_beam[:, -1] == true_any_beam[:, -1]).mean()), 2),
+                         "top beam agreement": round(100 * float((derived_top_beam == true_top_beam).mean()), 2)})
+    for row in rows:
+        row["any beam gap"] = round(row["any beam (derived)"] - row["any beam (true)"], 2)
+        row["top beam gap"] = round(row["top beam (derived)"] - row["top beam (true)"], 2)
+    return rows
+
+def main(indirs, outdir, gap_sample_size=None, skip_gap=False):
+    results, gaps = [], []
+    for indir in tqdm(indirs):
+        for subdir, file in iter_artifacts(indir):
+            if get_num_beams(subdir) == 1:
+                continue
+            ids, ranked_outputs = load_ranked_outputs(os.path.join(subdir, file))
+            results.extend([dict(row, subdir=subdir) for row in analyze_artifact(file, ranked_outputs)])
+            if not skip_gap:
+                gaps.extend(get_approximation_gap(subdir, file, ids, ranked_outputs, gap_sample_size))
+    os.makedirs(outdir, exist_ok=True)
+    if results:
+        # a single row per (subdir, dataset, prompt type, k), with the results of both the answerable and the un-answerable artifacts
+        results_df = pd.DataFrame(results).groupby(["subdir", "dataset", "prompt type", "k"], sort=True, dropna=False).first().reset_index()
+        results_df.to_csv(os.path.join(outdir, "beam_prefix_results.csv"), index=False)
+        print(f"saved the results of every k to {os.path.join(outdir, 'beam_prefix_results.csv')}")
+    if gaps:
+        pd.DataFrame(gaps).to_csv(os.path.join(outdir, "beam_prefix_approximation_gap.csv"), index=False)
+        print(f"saved the approximation gap to {os.path.join(outdir, 'beam_prefix_approximation_gap.csv')}")
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="derive the beam-relaxation results of every k <= K from K-beam runs.")
+    argparser.add_argument("--indirs", nargs='+', type=str, required=True, help="path to the indirs of the K-beam runs (with the pt files or columnar artifacts).")
+    argparser.add_argument("--outdir", type=str, required=True, help="where to save beam_prefix_results.csv (and beam_prefix_approximation_gap.csv).")
+    argparser.add_argument("--gap-sample-size", type=int, default=None, help="max number of instances to compare with each true k-beam run (default: all the common instances).")
+    argparser.add_argument("--skip-gap", action='store_true', default=False, help="don't compare with the true k-beam runs.")
+    args = argparser.parse_args()
+    main(args.indirs, args.outdir, args.gap_sample_size, args.skip_gap)
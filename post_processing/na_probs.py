@@ -0,0 +1,134 @@
+"""
+The no-answer probability of every question, for the best-threshold and precision-recall analysis of the QA-task evaluation
+(the --na-prob-file of the official scripts).
+
+Sources:
+    logits - the probability mass that the first decoding step puts on the first tokens of the abstention replies (from
+             the saved first-step logits of the first beam). Instances whose first generated token is EOS get 1.0.
+    probe  - the "unanswerable" probability of a linear classifier trained by train_linear_classifiers.py (averaged over
+             the rows of an instance for the "union" aggregation).
+The probabilities are saved next to the QA-task jsons of each decoding subdir, to
+{decoding_subdir}/{data_name}_na_probs/{data_name}_{prompt_type}.json, where evaluate-QA-task.py picks them up.
+"""
+import numpy as np
+from tqdm import tqdm
+import os
+import json
+import pickle
+import argparse
+import sys
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils import PROMPT_TYPES
+from artifact_utils import get_artifact_stem, load_responses
+from feature_extraction import load_features
+from feature_cache import DEFAULT_CACHE_MAX_GB, load_cached_features
+from run_manifest import iter_artifacts
+from pt_to_benchmarks_evaluate_format import DECODING_TYPES, DATA_NAMES, get_QA_task_ids
+
+ABSTENTION_WORDS = ["unanswerable", "unknown", "n/a", "idk", "nan"] # the replies of utils.UNANSWERABLE_REPLIES(_EXACT) whose first token is an abstention by itself
+
+
+def get_abstention_token_ids(tokenizer_name):
+    """The first token of each abstention word (lower-cased and capitalized), by the model's tokenizer."""
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    token_ids = set()
+    for word in ABSTENTION_WORDS:
+        for curr_word in [word, word.capitalize()]:
+            ids = tokenizer(curr_word, add_special_tokens=False)["input_ids"]
+            if ids:
+                token_ids.add(ids[0])
+    return sorted(token_ids)
+
+def softmax(logits):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    exp_logits = np.exp(logits)
+    return exp_logits / exp_logits.sum(axis=-1, keepdims=True)
+
+def get_logits_na_probs(path, prompt_type, abstention_token_ids):
+    """The abstention tokens' probability mass at the first decoding step of each instance of the artifact."""
+    first_logits, row_to_instance, ids, _ = load_features(path, prompt_type, "full_logits", "only_first_tkn", dtype=np.float32)
+    na_probs = np.ones(len(ids)) # the instances without a first step (i.e., that immediately generated EOS) abstained
+    na_probs[row_to_instance] = softmax(first_logits)[:, abstention_token_ids].sum(axis=1)
+    return ids, na_probs
+
+def get_probe_na_probs(path, prompt_type, clf, embedding_type, aggregation_type, feature_cache_dir=None, feature_cache_max_gb=DEFAULT_CACHE_MAX_GB):
+    """The classifier's probability of label 0 ("unanswerable") for each instance of the artifact."""
+    X, row_to_instance, ids, _ = load_cached_features(path,
+                                                      prompt_type=prompt_type,
+                                                      embedding_type=embedding_type,
+                                                      aggregation_type=aggregation_type,
+                                                      cache_dir=feature_cache_dir,
+                                                      max_size_gb=feature_cache_max_gb)
+    unanswerable_probs = clf.predict_proba(X)[:, list(clf.classes_).index(0)]
+    n_rows = np.bincount(row_to_instance, minlength=len(ids))
+    na_probs = np.ones(len(ids)) # like the logits source - an instance without rows abstained
+    has_rows = n_rows > 0
+    na_probs[has_rows] = np.bincount(row_to_instance, weights=unanswerable_probs, minlength=len(ids))[has_rows] / n_rows[has_rows]
+    return ids, na_probs
+
+def get_prompt_types(path, prompt_types):
+    """The prompt types of the artifact (out of prompt_types) that were generated (i.e., that have outputs)."""
+    responses = load_responses(path, prompt_types=prompt_types, fields=[], text_columns=[])
+    return [prompt_type for prompt_type in prompt_types if len(responses.get(prompt_type, [])) > 0 and type(responses[prompt_type][0]) == dict]
+
+def save_na_probs(decoding_subdir, data_name, prompt_type, na_probs):
+    curr_subdir = os.path.join(decoding_subdir, f"{data_name}_na_probs")
+    os.makedirs(curr_subdir, exist_ok=True)
+    outpath = os.path.join(curr_subdir, f"{data_name}_{prompt_type}.json")
+    with open(outpath, 'w') as f1:
+        f1.write(json.dumps(na_probs))
+    return outpath
+
+def main(args):
+    if args.source == "logits":
+        abstention_token_ids = args.abstention_token_ids if args.abstention_token_ids else get_abstention_token_ids(args.tokenizer)
+        print(f"abstention token ids: {abstention_token_ids}")
+    else:
+        with open(args.classifier_path, "rb") as file:
+            clf = pickle.load(file)
+
+    n_files = 0
+    for indir in args.indirs:
+        # (subdir, data_name) -> prompt type -> {qid: no-answer probability}, merged over the answerable and un-answerable artifacts
+        groups = dict()
+        for subdir, file in tqdm(list(iter_artifacts(indir))):
+            file_stem = get_artifact_stem(file)
+            data_names = [data_name for data_name in DATA_NAMES if data_name in file_stem]
+            if not data_names:
+                continue
+            path = os.path.join(subdir, file)
+            for prompt_type in get_prompt_types(path, args.prompt_types):
+                if args.source == "logits":
+                    ids, na_probs = get_logits_na_probs(path, prompt_type, abstention_token_ids)
+                else:
+                    ids, na_probs = get_probe_na_probs(path, prompt_type, clf, args.embedding_type, args.aggregation_type, args.feature_cache_dir, args.feature_cache_max_gb)
+                for data_name in data_names:
+                    curr_na_probs = groups.setdefault((subdir, data_name), dict()).setdefault(prompt_type, dict())
+                    curr_na_probs.update(zip(get_QA_task_ids(ids, file_stem, data_name), na_probs.tolist()))
+        for (subdir, data_name), na_probs_per_prompt_type in groups.items():
+            for decoding_type in args.decoding_types:
+                for prompt_type, na_probs in na_probs_per_prompt_type.items():
+                    save_na_probs(os.path.join(subdir, decoding_type), data_name, prompt_type, na_probs)
+                    n_files += 1
+    print(f"saved {n_files} no-answer probability files")
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="save the no-answer probability of every question (for the best-threshold and precision-recall analysis of the QA-task evaluation).")
+    argparser.add_argument("--indirs", nargs='+', type=str, required=True, help="path to the indirs where the pt files (or columnar artifacts) were saved")
+    argparser.add_argument("--source", type=str, default="logits", choices=["logits", "probe"], help="logits - the first-step probability of the abstention tokens, probe - the \"unanswerable\" probability of a trained linear classifier.")
+    argparser.add_argument("--prompt-types", nargs='+', type=str, default=PROMPT_TYPES, help="the prompt types to compute the probabilities of.")
+    argparser.add_argument("--decoding-types", nargs='+', type=str, default=["regular_decoding"], choices=DECODING_TYPES, help="the decoding subdirs to save the probabilities to (next to their QA-task jsons).")
+    argparser.add_argument("--tokenizer", type=str, default="google/flan-ul2", help="(logits) the tokenizer of the model that generated the artifacts (for the ids of the abstention tokens).")
+    argparser.add_argument("--abstention-token-ids", nargs='+', type=int, default=None, help="(logits) the ids of the abstention tokens (overrides --tokenizer).")
+    argparser.add_argument("--classifier-path", type=str, default=None, help="(probe) path to the classifier (e.g., best_model.pkl of train_linear_classifiers.py).")
+    argparser.add_argument('--aggregation-type', type=str, default="only_first_tkn", help='(probe) the aggregation type that the classifier was trained on ("average", "union" or "only_first_tkn").')
+    argparser.add_argument('--embedding-type', type=str, default="last_hidden_embedding", help='(probe) the embedding type that the classifier was trained on ("last_hidden_embedding" or "first_hidden_embedding").')
+    argparser.add_argument('--feature-cache-dir', type=str, default=None, help='(probe) dir of the feature cache, shared with the probing, erasure and plotting scripts. If None - no caching.')
+    argparser.add_argument('--feature-cache-max-gb', type=float, default=DEFAULT_CACHE_MAX_GB, help='(probe) size cap of the feature cache.')
+    args = argparser.parse_args()
+    if args.source == "probe" and args.classifier_path is None:
+        argparser.error("--classifier-path is required with --source probe")
+    main(args)
@@ -1,125 +1,178 @@
-import torch
 import pandas as pd
 from tqdm import tqdm
 import os
+import time
 import argparse
 import json
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import sys
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from utils import PROMPT_TYPES, UNANSWERABLE_REPLIES, UNANSWERABLE_REPLIES_EXACT
-
-
-def pt_to_csv_non_beam(indirs):
-    for indir in tqdm(indirs):
-        for subdir, dirs, files in os.walk(indir):
-            for file in files:
-                if not file.endswith("pt"):
-                    continue
-                new_subdir = os.path.join(subdir, f"regular_decoding")
-
-                if not os.path.exists(new_subdir):
-                    os.makedirs(new_subdir)
-
-
-                curr_outdir = os.path.join(new_subdir, file.replace("pt", "csv"))
-                curr_data = torch.load(os.path.join(subdir, file))
-                curr_df_dict = dict()
-                for key,value in curr_data.items():
-                    if len(value)>0 and type(value[0]) == dict:
-                        curr_df_dict[key] = [elem["outputs"][0] for elem in value]
-                    elif any(r for r in value): # if all results are empty strings - this the case when only the "hint" prompts were sent, and then the "Regular-Prompt" and "Answerability" weren't sent and can be omitted
-                        curr_df_dict[key] = value
-                curr_df = pd.DataFrame(curr_df_dict)
-                curr_df.to_csv(curr_outdir)
-
-def get_response_beam_relaxation(options):
-    for i,option in enumerate(options["outputs"]):
-        option_str = str(option).lower().strip()
-        if any(option_str==elem1 for elem1 in UNANSWERABLE_REPLIES_EXACT) or any(option_str==f"{elem1}." for elem1 in UNANSWERABLE_REPLIES_EXACT) or any(elem2 in option_str for elem2 in UNANSWERABLE_REPLIES):
-            return ("unanswerable", "")
-    return (options["outputs"][0], "")
-
-def pt_to_csv_beam(indirs):
-    for indir in tqdm(indirs):
-        for subdir, dirs, files in os.walk(indir):
-            for file in files:
-                if not file.endswith("pt"):
-                    continue
-
-                new_subdir = os.path.join(subdir, f"beam_relaxation")
-
-                if not os.path.exists(new_subdir):
-                    os.makedirs(new_subdir)
-                curr_outdir = os.path.join(new_subdir, file.replace("pt", "csv"))
-                curr_data = torch.load(os.path.join(subdir, file))
-                curr_df_dict = dict()
-                for key,value in curr_data.items():
-                    if len(value)>0 and type(value[0]) == dict:
-                        results = [get_response_beam_relaxation(elem) for elem in value]
-                        curr_df_dict[key] = [elem[0] for elem in results]
-                    elif any(elem for elem in value): # remove "empty" replies
-                        curr_df_dict[key] = value
-                curr_df = pd.DataFrame(curr_df_dict)
-                curr_df.to_csv(curr_outdir)
-
-def csv_to_benchmark_evaluate_format(indirs, data_name):
-    eval_dir = f"{data_name}_QA_task_format"
-
-    for indir in tqdm(indirs):
-        for subdir, dirs, files in os.walk(indir):
-            json_dicts = {prompt_type:{} for prompt_type in PROMPT_TYPES}
-            for file in files:
-                if not file.endswith("csv") or not data_name in file:
-                    continue
-                curr_df = pd.read_csv(os.path.join(subdir, file))
-                if data_name == "squad" or file.startswith("answerable"):
-                    id_suffix = ""
-                else:
-                    id_suffix = "-unanswerable" 
-                for prompt_type in PROMPT_TYPES:
-                    try:
-                        if not prompt_type in curr_df.columns:
-                            continue
-                        if prompt_type == "Answerability":
-                            is_answerable_results = ["unanswerable" if "unanswerable" in str(row[prompt_type]).lower() else curr_df.iloc[i]["Regular-Prompt"] for i, row in curr_df.iterrows()]
-                            curr_out_dict = {f'{row["ids"]}{id_suffix}'.strip(): is_answerable_results[i] for i, row in curr_df.iterrows()}
-                        else:
-                            curr_out_dict = {f'{row["ids"]}{id_suffix}'.strip(): row[prompt_type] for _, row in curr_df.iterrows()}
-                        json_dicts[prompt_type].update(curr_out_dict)
-                    except:
-                        print("done")
-            for prompt_type in PROMPT_TYPES:
-                if not json_dicts[prompt_type]:
-                    continue
-
-                curr_subdir = os.path.join(subdir, eval_dir)
-                if not os.path.exists(curr_subdir):
-                    os.makedirs(curr_subdir)
-
-                out_dict = json_dicts[prompt_type]
-                for key,value in out_dict.items():
-                    value = str(value).lower().strip()
-                    if any(elem1==value for elem1 in UNANSWERABLE_REPLIES_EXACT) or any(f"{elem1}."==value for elem1 in UNANSWERABLE_REPLIES_EXACT) or any(elem2 in value.lower() for elem2 in UNANSWERABLE_REPLIES):
-                        out_dict[key] = ""
-
-                with open(os.path.join(curr_subdir, f"{data_name}_{prompt_type}.json"), 'w') as f1:
-                    f1.write(json.dumps(out_dict))    
-
-def main(indirs, is_beam_experiment):
-    if is_beam_experiment:
-        pt_to_csv_beam(indirs)
+from utils import PROMPT_TYPES
+from abstention_matcher import are_unanswerable, any_unanswerable
+from artifact_utils import COLUMNAR_SUFFIX, get_artifact_stem, load_responses
+from run_manifest import iter_artifacts
+from stage_manifest import MANIFEST_FILE, StageManifest
+
+DECODING_TYPES = ["regular_decoding", "beam_relaxation"]
+DATA_NAMES = ["squad", "NQ", "musique"]
+# the replies that the former csv round-trip of the QA-task answers (pd.read_csv's default na_values) read as NaN, i.e.,
+# as the "nan" unanswerable reply - they are still written as unanswerable ("")
+CSV_NA_REPLIES = frozenset(["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"])
+
+
+def get_decoding_columns(responses, decoding_type):
+    """The columns of the decoding type's csv: the (first or beam-relaxed) response of each prompt type, and the other columns."""
+    columns = dict()
+    for key,value in responses.items():
+        if len(value)>0 and type(value[0]) == dict:
+            if decoding_type == "beam_relaxation":
+                # "unanswerable" if any of the beams is unanswerable, otherwise the top beam
+                any_beam_unanswerable = any_unanswerable([elem["outputs"] for elem in value])
+                columns[key] = ["unanswerable" if is_unanswerable else elem["outputs"][0] for elem, is_unanswerable in zip(value, any_beam_unanswerable)]
+            else:
+                columns[key] = [elem["outputs"][0] for elem in value]
+        elif any(r for r in value): # if all results are empty strings - this the case when only the "hint" prompts were sent, and then the "Regular-Prompt" and "Answerability" weren't sent and can be omitted
+            columns[key] = value
+    return columns
+
+def get_QA_task_ids(ids, file_name, data_name):
+    """The ids of the instances in the gold files of the QA-task evaluation (the un-answerable instances of NQ and musique have an "-unanswerable" suffix)."""
+    id_suffix = "" if data_name == "squad" or file_name.startswith("answerable") else "-unanswerable"
+    return [f'{curr_id}{id_suffix}'.strip() for curr_id in ids]
+
+def get_QA_task_answers(columns, file_name, data_name):
+    """The answers of each prompt type in the format of the QA-task evaluation scripts ({id: answer}, with "" for unanswerable replies and for the replies in CSV_NA_REPLIES)."""
+    ids = get_QA_task_ids(columns["ids"], file_name, data_name)
+    answers = dict()
+    for prompt_type in PROMPT_TYPES:
+        if not prompt_type in columns.keys():
+            continue
+        if prompt_type == "Answerability":
+            if not "Regular-Prompt" in columns.keys():
+                continue
+            replies = ["unanswerable" if "unanswerable" in str(reply).lower() else regular_reply for reply, regular_reply in zip(columns[prompt_type], columns["Regular-Prompt"])]
+        else:
+            replies = columns[prompt_type]
+        answers[prompt_type] = {curr_id: "" if is_unanswerable or reply in CSV_NA_REPLIES else reply for curr_id, reply, is_unanswerable in zip(ids, replies, are_unanswerable(replies))}
+    return answers
+
+def convert_artifact(subdir, file, decoding_types):
+    """Write the csv of each decoding type of a single artifact, and return its QA-task answers (read the artifact only once, and without the tensors)."""
+    responses = load_responses(os.path.join(subdir, file))
+    file_stem = get_artifact_stem(file)
+    QA_task_answers = dict()
+    for decoding_type in decoding_types:
+        columns = get_decoding_columns(responses, decoding_type)
+        new_subdir = os.path.join(subdir, decoding_type)
+        os.makedirs(new_subdir, exist_ok=True)
+        pd.DataFrame(columns).to_csv(os.path.join(new_subdir, f"{file_stem}.csv"))
+        QA_task_answers[new_subdir] = {data_name: get_QA_task_answers(columns, file_stem, data_name) for data_name in DATA_NAMES if data_name in file_stem}
+    return file, QA_task_answers
+
+def get_artifact_input_files(path):
+    """The files that the conversion reads: the pt file, or the meta and the text columns of a columnar artifact (not its tensors)."""
+    if path.endswith(COLUMNAR_SUFFIX):
+        return [os.path.join(path, "meta.json")] + sorted(glob(os.path.join(path, "text", "*.json")))
+    return [path]
+
+def get_csv_path(subdir, file, decoding_type):
+    return os.path.join(subdir, decoding_type, f"{get_artifact_stem(file)}.csv")
+
+def get_QA_task_answers_from_csv(csv_path, data_name):
+    """The QA-task answers of an artifact that wasn't converted in this run, from its csv (read as strings, like the original outputs)."""
+    columns = pd.read_csv(csv_path, dtype=str, keep_default_na=False, index_col=0).to_dict("list")
+    return get_QA_task_answers(columns, os.path.basename(csv_path)[:-len(".csv")], data_name)
+
+def save_QA_task_files(decoding_subdir, data_name, answers_per_file):
+    """Merge the QA-task answers of the artifacts of the decoding subdir, and save them to {data_name}_QA_task_format/{data_name}_{prompt_type}.json"""
+    json_dicts = dict()
+    for _, answers in sorted(answers_per_file, key=lambda elem: elem[0]):
+        for prompt_type, curr_out_dict in answers.items():
+            json_dicts.setdefault(prompt_type, dict()).update(curr_out_dict)
+    outpaths = []
+    for prompt_type, out_dict in json_dicts.items():
+        if not out_dict:
+            continue
+        curr_subdir = os.path.join(decoding_subdir, f"{data_name}_QA_task_format")
+        os.makedirs(curr_subdir, exist_ok=True)
+        outpaths.append(os.path.join(curr_subdir, f"{data_name}_{prompt_type}.json"))
+        with open(outpaths[-1], 'w') as f1:
+            f1.write(json.dumps(out_dict))
+    return outpaths
+
+def convert_artifacts(artifacts, decoding_types, num_workers):
+    """Convert the artifacts (in parallel), and return the QA-task answers of each of them."""
+    results = dict()
+    if num_workers == 1 or len(artifacts) <= 1:
+        for subdir, file in tqdm(artifacts):
+            results[(subdir, file)] = convert_artifact(subdir, file, decoding_types)[1]
     else:
-        pt_to_csv_non_beam(indirs)
-        
-    csv_to_benchmark_evaluate_format(indirs, 'squad')
-    csv_to_benchmark_evaluate_format(indirs, 'NQ')
-    csv_to_benchmark_evaluate_format(indirs, 'musique')
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(convert_artifact, subdir, file, decoding_types):(subdir, file) for subdir, file in artifacts}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                results[futures[future]] = future.result()[1]
+    return results
+
+def convert_indir(indir, decoding_types, num_workers, dry_run=False, force=False):
+    """Convert the stale artifacts under indir, and rebuild the QA-task jsons of the stale (decoding subdir, dataset) pairs. Returns the number of converted artifacts."""
+    manifest = StageManifest(os.path.join(indir, MANIFEST_FILE), dry_run=dry_run, force=force)
+    artifacts = list(iter_artifacts(indir))
+
+    # pt -> csv (an artifact is converted if the csv of any of the decoding types is stale)
+    stale_artifacts = [(subdir, file) for subdir, file in artifacts if not all([manifest.is_up_to_date("pt_to_csv", get_csv_path(subdir, file, decoding_type), get_artifact_input_files(os.path.join(subdir, file))) for decoding_type in decoding_types])]
+    stale_artifacts_set = set(stale_artifacts)
+    results = dict() if dry_run else convert_artifacts(stale_artifacts, decoding_types, num_workers)
+    for subdir, file in stale_artifacts:
+        for decoding_type in decoding_types:
+            manifest.record("pt_to_csv", get_csv_path(subdir, file, decoding_type), get_artifact_input_files(os.path.join(subdir, file)), [get_csv_path(subdir, file, decoding_type)])
+
+    # csv -> QA-task json (of all the artifacts of each dataset in each decoding subdir)
+    groups = dict()
+    for subdir, file in artifacts:
+        for decoding_type in decoding_types:
+            for data_name in DATA_NAMES:
+                if data_name in get_artifact_stem(file):
+                    groups.setdefault((os.path.join(subdir, decoding_type), data_name), []).append((subdir, file, decoding_type))
+    for (decoding_subdir, data_name), members in groups.items():
+        unit = os.path.join(decoding_subdir, f"{data_name}_QA_task_format")
+        csv_paths = [get_csv_path(subdir, file, decoding_type) for subdir, file, decoding_type in members]
+        if dry_run and any((subdir, file) in stale_artifacts_set for subdir, file, _ in members):
+            manifest.mark_stale("csv_to_QA_json", unit) # its csvs would be recomputed
+            continue
+        if manifest.is_up_to_date("csv_to_QA_json", unit, csv_paths) or dry_run:
+            continue
+        answers_per_file = [(file, results[(subdir, file)][decoding_subdir][data_name] if (subdir, file) in results.keys() else get_QA_task_answers_from_csv(get_csv_path(subdir, file, decoding_type), data_name)) for subdir, file, decoding_type in members]
+        manifest.record("csv_to_QA_json", unit, csv_paths, save_QA_task_files(decoding_subdir, data_name, answers_per_file))
+    manifest.save()
+    return len(stale_artifacts)
+
+def main(indirs, is_beam_experiment=False, decoding_types=None, num_workers=None, dry_run=False, force=False):
+    """
+    Convert the artifacts under indirs to the csvs of each decoding type and to the QA-task evaluation jsons, in a single pass over the artifacts.
+    Only the stale outputs are recomputed (according to the stage manifest in each indir).
+    decoding_types: any of "regular_decoding" and "beam_relaxation" (if None - "beam_relaxation" if is_beam_experiment else "regular_decoding")
+    num_workers: number of processes converting the artifacts in parallel (None - the number of CPUs, 1 - convert in this process)
+    dry_run: only list the outputs that would be recomputed
+    force: recompute all the outputs
+    """
+    if decoding_types is None:
+        decoding_types = ["beam_relaxation"] if is_beam_experiment else ["regular_decoding"]
+    start_time = time.time()
+    n_converted = sum(convert_indir(indir, decoding_types, num_workers, dry_run, force) for indir in indirs)
+    elapsed_time = max(time.time() - start_time, 1e-9)
+    if not dry_run:
+        print(f"converted {n_converted} files ({', '.join(decoding_types)}) in {elapsed_time:.1f}s ({n_converted/elapsed_time:.2f} files/sec)")
 
 
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser(description="")
-    argparser.add_argument("--indirs", nargs='+', type=str, required=True, help="path to the indirs where the pt files were saved")
+    argparser.add_argument("--indirs", nargs='+', type=str, required=True, help="path to the indirs where the pt files (or columnar artifacts) were saved")
     argparser.add_argument("--is-beam-experiment", action='store_true', default=False, help="Whether this is the beam relaxation experiment or the regular prompt-manipulation experiments.")
+    argparser.add_argument("--decoding-types", nargs='+', type=str, default=None, choices=DECODING_TYPES, help="which outputs to generate (overrides --is-beam-experiment). Pass both to generate the regular-decoding and the beam-relaxation outputs in the same pass.")
+    argparser.add_argument("--num-workers", type=int, default=None, help="number of processes to convert the files in parallel (default: the number of CPUs).")
+    argparser.add_argument("--dry-run", action='store_true', default=False, help="only list what would be recomputed.")
+    argparser.add_argument("--force", action='store_true', default=False, help="recompute everything, even if up to date.")
     args = argparser.parse_args()
-    main(args.indirs, args.is_beam_experiment)
+    main(args.indirs, args.is_beam_experiment, args.decoding_types, args.num_workers, args.dry_run, args.force)
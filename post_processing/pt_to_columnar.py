@@ -0,0 +1,39 @@
+import torch
+from tqdm import tqdm
+import os
+import argparse
+import sys
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from artifact_utils import COLUMNAR_SUFFIX, STORAGE_DTYPES, COMPRESSIONS, get_artifact_path, get_fields_storage_dtype, save_columnar
+
+
+def convert_pt_file(pt_path, remove_pt, storage_dtype="float16", compression=None):
+    outpath = get_artifact_path(pt_path, "columnar")
+    if os.path.exists(outpath):
+        print(f"{outpath} exists! skipping...")
+        return
+    responses = torch.load(pt_path, map_location="cpu")
+    save_columnar(responses, outpath, storage_dtype=storage_dtype, compression=compression)
+    if remove_pt:
+        os.remove(pt_path)
+
+def main(indirs, remove_pt, storage_dtype="float16", compression=None):
+    for indir in tqdm(indirs):
+        for subdir, dirs, files in os.walk(indir):
+            dirs[:] = [d for d in dirs if not d.endswith(COLUMNAR_SUFFIX)]
+            for file in files:
+                if not file.endswith(".pt"):
+                    continue
+                convert_pt_file(os.path.join(subdir, file), remove_pt, storage_dtype, compression)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="")
+    argparser.add_argument("--indirs", nargs='+', type=str, required=True, help="path to the indirs where the pt files were saved")
+    argparser.add_argument("--remove-pt", action='store_true', default=False, help="whether to remove each pt file once it was converted.")
+    argparser.add_argument("--storage-dtype", type=str, default="float16", choices=STORAGE_DTYPES, help="dtype to store the hidden states in. int8 is quantized with a per-row scale.")
+    argparser.add_argument("--logits-storage-dtype", type=str, default="float16", choices=STORAGE_DTYPES, help="dtype to store the full logits in.")
+    argparser.add_argument("--compression", type=str, default=None, choices=COMPRESSIONS, help="compress the stored tensors in blocks of rows.")
+    args = argparser.parse_args()
+    main(args.indirs, args.remove_pt, get_fields_storage_dtype(args.storage_dtype, args.logits_storage_dtype), args.compression)
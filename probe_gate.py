@@ -0,0 +1,119 @@
+"""
+Probe-gated generation: the answerability probe is scored on the first decoding step's hidden state, and the instances it
+confidently classifies as un-answerable are answered "unanswerable" right away, without decoding the rest of the reply.
+
+The probes are exported (by train_linear_classifiers.py and train_probe_batch.py, or from an existing best_model.pkl by
+running this script) next to their best_model.pkl, to a numpy file that needs neither sklearn nor pickle:
+    coef        - (d,) the weights of the answerable class (label 1)
+    intercept   - () its bias
+    prompt_type, embedding_type, aggregation_type - the features the probe was trained on
+so the answerable probability of a hidden state x is sigmoid(x @ coef + intercept).
+"""
+import os
+import json
+import time
+import argparse
+import pickle
+from glob import glob
+import numpy as np
+import torch
+from artifact_utils import get_artifact_stem
+
+NUMPY_PROBE_FILE = "best_model.npz"
+PROBE_GATE_SUFFIX = ".probe_gate.json"
+GATED_REPLY = "unanswerable"
+GATED_FEATURES = {"embedding_type": "last_hidden_embedding", "aggregation_type": "only_first_tkn"} # the features that exist after the first decoding step
+
+
+def export_numpy_probe(clf, path, **config):
+    """Save the weights of a binary (0 - un-answerable, 1 - answerable) linear classifier as a numpy probe."""
+    if list(clf.classes_) != [0, 1]:
+        raise Exception(f"only binary classifiers of 0 (unanswerable) and 1 (answerable) can be exported (got {clf.classes_})")
+    np.savez(path, coef=clf.coef_[0].astype(np.float32), intercept=np.float32(clf.intercept_[0]), **{key: np.array(value) for key, value in config.items()})
+    return path
+
+def load_numpy_probe(path):
+    with np.load(path) as data:
+        return {key: (str(data[key]) if data[key].dtype.kind == "U" else data[key]) for key in data.files}
+
+def get_probe_gate_path(artifact_path):
+    """The summary of the gate (its scores and compute) that is saved next to an artifact."""
+    return f"{get_artifact_stem(artifact_path)}{PROBE_GATE_SUFFIX}"
+
+class ProbeGate:
+    """Scores a numpy probe on hidden states on their device, and keeps the scores and the compute of every prompt type (until reset)."""
+    def __init__(self, probe, threshold):
+        for key, value in GATED_FEATURES.items():
+            if probe.get(key, value) != value:
+                raise Exception(f"the probe gate needs a probe trained on the first generated token's last hidden state ({key}={value}, got {probe[key]})")
+        self.probe = probe
+        self.threshold = threshold
+        self._tensors = dict()
+        self.reset()
+
+    @property
+    def prompt_type(self):
+        return self.probe.get("prompt_type")
+
+    def applies_to(self, prompt_type):
+        """The gate is only applied to the replies of the prompt type that the probe was trained on."""
+        return self.prompt_type is None or prompt_type == self.prompt_type
+
+    def _get_tensors(self, device):
+        if not device in self._tensors.keys():
+            self._tensors[device] = (torch.from_numpy(self.probe["coef"]).to(device=device, dtype=torch.float32),
+                                     torch.tensor(float(self.probe["intercept"]), device=device, dtype=torch.float32))
+        return self._tensors[device]
+
+    def answerable_probs(self, hidden_states):
+        coef, intercept = self._get_tensors(hidden_states.device)
+        return torch.sigmoid(hidden_states.float() @ coef + intercept)
+
+    def reset(self):
+        self.summary = {"threshold": self.threshold, "prompt_types": dict()}
+
+    def record(self, prompt_type, answerable_probs, gated, gate_time, decoding_time, decoding_steps, prefill_passes):
+        """
+        Record the scores of a batch, the time of the gating pass and of the decoding of the rest, the number of decoding
+        steps that were run, and the number of prompts that were prefilled (encoded) - once per prompt in the gating pass, and
+        again for the kept prompts of the decoder-only models (the encoder outputs are reused by the encoder-decoder models).
+        """
+        curr_summary = self.summary["prompt_types"].setdefault(prompt_type, {"answerable_probs": [], "gated": [], "gate_time": 0.0, "decoding_time": 0.0, "decoding_steps": 0, "prefill_passes": 0})
+        curr_summary["answerable_probs"].extend([round(float(prob), 6) for prob in answerable_probs])
+        curr_summary["gated"].extend([bool(is_gated) for is_gated in gated])
+        curr_summary["gate_time"] += gate_time
+        curr_summary["decoding_time"] += decoding_time
+        curr_summary["decoding_steps"] += decoding_steps
+        curr_summary["prefill_passes"] += prefill_passes
+
+    def save_summary(self, artifact_path):
+        with open(get_probe_gate_path(artifact_path), 'w') as f1:
+            f1.write(json.dumps(self.summary))
+        for prompt_type, curr_summary in self.summary["prompt_types"].items():
+            n_gated, n_instances = sum(curr_summary["gated"]), len(curr_summary["gated"])
+            print(f"probe gate ({prompt_type}): {n_gated}/{n_instances} gated, gating pass: {curr_summary['gate_time']:.1f}s, decoding of the rest: {curr_summary['decoding_time']:.1f}s ({curr_summary['decoding_steps']} steps, {curr_summary['prefill_passes']} prefilled prompts)")
+        self.reset()
+
+def time_sync(model):
+    """The time, after the model's device is done with its queued work."""
+    if model.device.type == "cuda":
+        torch.cuda.synchronize()
+    return time.time()
+
+def main(args):
+    classifier_paths = sorted(path for classifier_dir in args.classifier_dirs for path in ([classifier_dir] if classifier_dir.endswith(".pkl") else glob(os.path.join(classifier_dir, "**", "best_model.pkl"), recursive=True)))
+    for classifier_path in classifier_paths:
+        with open(classifier_path, "rb") as file:
+            clf = pickle.load(file)
+        # the layout of train_linear_classifiers.py: <dataset>/<embedding_type>/<prompt_type>/<aggregation_type>/<model>_<N>N/best_model.pkl
+        parts = os.path.normpath(classifier_path).split(os.sep)
+        config = {"embedding_type": parts[-5], "prompt_type": parts[-4], "aggregation_type": parts[-3]} if len(parts) >= 6 else dict()
+        outpath = export_numpy_probe(clf, os.path.join(os.path.dirname(classifier_path), NUMPY_PROBE_FILE), **config)
+        print(f"exported {classifier_path} to {outpath}")
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="export trained classifiers (best_model.pkl) as numpy probes (best_model.npz, for --probe-gate of zero_shot_prompting.py).")
+    argparser.add_argument('--classifier-dirs', nargs='+', type=str, required=True, help='the classifiers (best_model.pkl files, or outdirs of train_linear_classifiers.py/train_probe_batch.py to search for them).')
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,86 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import pickle
+from pathlib import Path
+from sklearn.model_selection import train_test_split
+from artifact_utils import list_artifacts
+from feature_extraction import load_layer_features
+from run_manifest import get_run_config
+from probe_training import L2_VALUES, train_batched_probes
+from train_linear_classifiers import SEED, get_model_name
+
+
+def get_captured_layers(artifact_path, n_layers):
+    """The model's layer indices of the captured layers (recorded in the run manifest, otherwise 0..n_layers-1)."""
+    run_config = get_run_config(artifact_path)
+    if run_config is not None and run_config.get("captured_layers") is not None:
+        return run_config["captured_layers"]
+    return list(range(n_layers))
+
+def get_data(indir, prompt_type, dataset, num_instances):
+    """The (N, layers, d) first-token states of the un-answerable and the answerable instances of the dataset."""
+    data = dict()
+    for file_name in list_artifacts(indir):
+        if not dataset in file_name:
+            continue
+        data_type = "un-answerable" if "un-answerable" in file_name else "answerable"
+        data[data_type], _, _, _ = load_layer_features(os.path.join(indir, file_name), prompt_type=prompt_type, num_instances=num_instances)
+    return data["un-answerable"], data["answerable"]
+
+def main(args):
+    model_name = get_model_name(args.indir)
+    outdir = os.path.join(args.outdir, args.dataset, "layers_first_tkn_embedding", args.prompt_type, f"{model_name}_{args.num_instances}N")
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+
+    unanswerable_instances, answerable_instances = get_data(args.indir, args.prompt_type, args.dataset, args.num_instances)
+    X = np.concatenate((unanswerable_instances, answerable_instances))
+    y = np.concatenate((np.zeros(len(unanswerable_instances)), np.ones(len(answerable_instances))))
+    layers = get_captured_layers(os.path.join(args.indir, next(file_name for file_name in list_artifacts(args.indir) if args.dataset in file_name)), X.shape[1])
+
+    # the same train/test split as train_linear_classifiers.py, and a probe per layer - all trained together (see probe_training.py)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=SEED)
+    results = train_batched_probes([(X_train[:, i], y_train) for i in range(len(layers))],
+                                   l2_values=args.l2_values,
+                                   max_epochs=args.max_epochs,
+                                   lr=args.lr,
+                                   patience=args.patience,
+                                   seed=SEED)
+
+    rows = []
+    for i, (layer, result) in enumerate(zip(layers, results)):
+        rows.append({"layer": layer,
+                     "l2": result["l2"],
+                     "epochs": result["epochs"],
+                     "validation accuracy": result["val_accuracy"],
+                     "test accuracy": float((result["probe"].predict(X_test[:, i]) == y_test).mean())})
+        if args.save_probes:
+            Path(os.path.join(outdir, f"layer_{layer}")).mkdir(parents=True, exist_ok=True)
+            with open(os.path.join(outdir, f"layer_{layer}", "best_model.pkl"), 'wb') as file:
+                pickle.dump(result["probe"], file)
+    df = pd.DataFrame(rows).set_index("layer")
+    df.to_csv(os.path.join(outdir, "layer_sweep.csv"))
+    print(df.to_string(float_format="{:.4f}".format))
+
+    # the cheapest (i.e., earliest) layer whose validation accuracy is within the tolerance of the best one
+    best_accuracy = df["validation accuracy"].max()
+    cheapest_layer = df.index[df["validation accuracy"] >= best_accuracy - args.tolerance][0]
+    print(f"best validation accuracy: {best_accuracy:.4f} (layer {df['validation accuracy'].idxmax()}), cheapest layer within {args.tolerance}: {cheapest_layer} (test accuracy: {df.loc[cheapest_layer, 'test accuracy']:.4f})")
+    print(f"results saved to {os.path.join(outdir, 'layer_sweep.csv')}")
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="train an answerability probe on every captured layer (see --capture-layers of the generation scripts), and report the accuracy per layer.")
+    argparser.add_argument('-i', '--indir', type=str, required=True, help='path to the train set data (generated with --capture-layers)')
+    argparser.add_argument('-o', '--outdir', type=str, required=True, help='path to outdir')
+    argparser.add_argument('--dataset', type=str, default="squad", help='dataset to classify ("squad", "NQ", "musique")')
+    argparser.add_argument('--prompt-type', type=str, default="Regular-Prompt", help='prompt type to classify ("Regular-Prompt", "Hint-Prompt", "CoT-Prompt", "Answerability")')
+    argparser.add_argument('--num-instances', type=int, default=None, help='number of instances to use for training (will take the same amount from the answerable and the un-answerable). If None - will take all.')
+    argparser.add_argument('--l2-values', nargs='+', type=float, default=L2_VALUES, help='the L2 penalty strengths to train each probe with (the best one on the validation set is kept).')
+    argparser.add_argument('--max-epochs', type=int, default=1000, help='maximal number of (full-batch) epochs.')
+    argparser.add_argument('--lr', type=float, default=0.01, help='learning rate (Adam).')
+    argparser.add_argument('--patience', type=int, default=20, help='stop a probe once its validation loss didn\'t improve for this many epochs.')
+    argparser.add_argument('--tolerance', type=float, default=0.01, help='report the earliest layer whose validation accuracy is within this tolerance of the best layer.')
+    argparser.add_argument('--save-probes', action='store_true', default=False, help='also save the probe of every layer (to layer_<i>/best_model.pkl).')
+    args = argparser.parse_args()
+    main(args)
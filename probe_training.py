@@ -0,0 +1,382 @@
+"""
+Cross-validated training of the answerability probes (logistic regression), replacing the GridSearchCV of
+train_linear_classifiers.py (a cold liblinear fit for each of C x penalty x max_iter x fold).
+
+For each penalty, the whole C path is fitted in ascending order with warm starts (each fit starts from the solution of the
+previous C), so the later fits converge in a few epochs. The max_iter axis is not searched - it only changes the stopping
+condition, so every fit runs to convergence (up to max_iter). The (penalty, fold) paths run in parallel, and a path stops
+early once its validation accuracy fell more than prune_margin below its best for `patience` consecutive C values (the
+larger C values are dominated). A configuration that was pruned in any fold is not selected.
+
+The features are standardized for the solver (saga), and the standardization is folded back into the coefficients, so the
+returned model is a plain LogisticRegression on the raw features (the interface of best_model.pkl is unchanged).
+
+train_batched_probes trains many probes at once (e.g., of every layer, prompt type and dataset): the probes whose features
+have the same dimension are stacked and trained together, with an L2-regularized logistic loss for each of a few penalty
+strengths, by full-batch Adam on batched matmuls. Each (probe, penalty) stops on its own when its validation loss stops
+improving, and a probe's best penalty is chosen by its validation accuracy. The stacked (zero-padded) features are only
+compacted when some probes stop, and the probes can be trained in several batches of a memory budget.
+
+StreamingProbes trains a probe by SGD over a stream of mini-batches (for features that don't fit in memory, e.g., the union
+rows of a full train set): a logistic-regression SGDClassifier per penalty strength is updated on each mini-batch, the
+standardization comes from a first pass over the stream, and each penalty stops on its own once the loss on the held-out
+rows stopped improving for `patience` epochs. Its whole state can be saved and restored between epochs.
+"""
+import os
+import time
+import pickle
+import warnings
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.model_selection import StratifiedKFold, train_test_split
+
+C_VALUES = [0.0001, 0.001, 0.01, 0.1, 1, 10, 100, 1000]
+PENALTIES = ["l1", "l2"]
+MAX_ITER = 5000 # the largest max_iter of the former grid
+TOL = 1e-4
+L2_VALUES = [1e-4, 1e-3, 1e-2, 1e-1] # the penalty strengths of the batched probes (the coefficient of ||w||^2/2, i.e., 1/(C*n))
+
+
+def get_standardization(X, eps=1e-12):
+    mean = X.mean(axis=0)
+    scale = X.std(axis=0)
+    scale[scale < eps] = 1.0
+    return mean, scale
+
+def standardize(X, eps=1e-12):
+    mean, scale = get_standardization(X, eps)
+    return (X - mean) / scale, mean, scale
+
+def fold_standardization(clf, mean, scale):
+    """Convert a classifier trained on (X - mean) / scale to the equivalent classifier on X (in place)."""
+    clf.coef_ = clf.coef_ / scale
+    clf.intercept_ = clf.intercept_ - clf.coef_ @ mean
+    clf.n_features_in_ = len(mean)
+    return clf
+
+def get_classifier(penalty, C, seed, max_iter=MAX_ITER, warm_start=False):
+    return LogisticRegression(penalty=penalty, C=C, solver="saga", max_iter=max_iter, tol=TOL, warm_start=warm_start, random_state=seed)
+
+def fit_C_path(X_train, y_train, X_val, y_val, penalty, C_values, seed, max_iter=MAX_ITER, prune_margin=0.02, patience=2):
+    """
+    Fit the C path (in ascending order) of a single penalty with warm starts, on standardized features.
+    returns: a list of dicts (C, accuracy, fit_time, n_iter) of the fitted C values (the path may be pruned before its end)
+    """
+    clf = get_classifier(penalty, C_values[0], seed, max_iter, warm_start=True)
+    path, best_accuracy, n_worse = [], -np.inf, 0
+    for C in sorted(C_values):
+        clf.set_params(C=C)
+        start_time = time.time()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=ConvergenceWarning)
+            clf.fit(X_train, y_train)
+        accuracy = float((clf.predict(X_val) == y_val).mean())
+        path.append({"C": C, "accuracy": accuracy, "fit_time": time.time() - start_time, "n_iter": int(clf.n_iter_.max())})
+        best_accuracy = max(best_accuracy, accuracy)
+        n_worse = n_worse + 1 if accuracy < best_accuracy - prune_margin else 0
+        if n_worse >= patience:
+            break
+    return path
+
+def _fit_fold_path(X, y, train_index, val_index, penalty, C_values, seed, max_iter, prune_margin, patience):
+    X_train, mean, scale = standardize(X[train_index])
+    X_val = (X[val_index] - mean) / scale
+    return fit_C_path(X_train, y[train_index], X_val, y[val_index], penalty, C_values, seed, max_iter, prune_margin, patience)
+
+def cross_validate(X, y, C_values=C_VALUES, penalties=PENALTIES, cv=5, n_jobs=-1, seed=0, max_iter=MAX_ITER, prune_margin=0.02, patience=2):
+    """
+    Cross-validate the (penalty, C) configurations, with a warm-started C path per (penalty, fold), in parallel.
+    returns: a list of dicts (penalty, C, mean_accuracy, std_accuracy, mean_fit_time, mean_n_iter, n_folds) of every configuration
+             (configurations that were pruned in some fold have n_folds < cv and no mean accuracy)
+    """
+    folds = list(StratifiedKFold(n_splits=cv).split(X, y)) # like GridSearchCV's cv=cv for a classifier
+    tasks = [(penalty, train_index, val_index) for penalty in penalties for train_index, val_index in folds]
+    paths = Parallel(n_jobs=n_jobs)(delayed(_fit_fold_path)(X, y, train_index, val_index, penalty, C_values, seed, max_iter, prune_margin, patience) for penalty, train_index, val_index in tasks)
+    fold_results = dict()
+    for (penalty, _, _), path in zip(tasks, paths):
+        for point in path:
+            fold_results.setdefault((penalty, point["C"]), []).append(point)
+    results = []
+    for penalty in penalties:
+        for C in sorted(C_values):
+            points = fold_results.get((penalty, C), [])
+            accuracies = [point["accuracy"] for point in points]
+            results.append({"penalty": penalty,
+                            "C": C,
+                            "mean_accuracy": float(np.mean(accuracies)) if len(points) == cv else None,
+                            "std_accuracy": float(np.std(accuracies)) if len(points) == cv else None,
+                            "mean_fit_time": float(np.mean([point["fit_time"] for point in points])) if points else None,
+                            "mean_n_iter": float(np.mean([point["n_iter"] for point in points])) if points else None,
+                            "n_folds": len(points)})
+    return results
+
+def get_best_config(results):
+    """The (penalty, C) with the best mean accuracy (the first one on ties, in the order of the results - like GridSearchCV)."""
+    complete = [result for result in results if result["mean_accuracy"] is not None]
+    best = max(complete, key=lambda result: result["mean_accuracy"])
+    return best["penalty"], best["C"]
+
+def train_probe(X, y, C_values=C_VALUES, penalties=PENALTIES, cv=5, n_jobs=-1, seed=0, max_iter=MAX_ITER, prune_margin=0.02, patience=2):
+    """
+    Select the probe's (penalty, C) by cross-validation, and refit it on all of X.
+    returns: the refitted LogisticRegression (on the raw features), and the cross-validation results (see cross_validate)
+    """
+    results = cross_validate(X, y, C_values, penalties, cv, n_jobs, seed, max_iter, prune_margin, patience)
+    penalty, C = get_best_config(results)
+    X_standardized, mean, scale = standardize(X)
+    clf = get_classifier(penalty, C, seed, max_iter)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=ConvergenceWarning)
+        clf.fit(X_standardized, y)
+    return fold_standardization(clf, mean, scale), results
+
+def to_sklearn_classifier(coef, intercept, mean, scale, l2, n_samples, n_iter, classes=(0.0, 1.0)):
+    """A fitted LogisticRegression with the given coefficients (on standardized features), on the raw features."""
+    clf = LogisticRegression(C=1.0 / (l2 * n_samples), penalty="l2")
+    clf.classes_ = np.array(classes)
+    clf.coef_ = np.asarray(coef, dtype=np.float64).reshape(1, -1)
+    clf.intercept_ = np.asarray([intercept], dtype=np.float64)
+    clf.n_iter_ = np.array([n_iter], dtype=np.int32)
+    return fold_standardization(clf, mean, scale)
+
+def _stack(arrays, n_max, dtype, standardizations=None):
+    """
+    Zero-pad the arrays (each (n, ...)) to n_max rows and stack them, with the mask of the real rows.
+    standardizations: the (mean, scale) of each array, to standardize the arrays one at a time while stacking them
+    """
+    import torch
+    stacked = torch.zeros((len(arrays), n_max) + arrays[0].shape[1:], dtype=dtype)
+    mask = torch.zeros((len(arrays), n_max), dtype=dtype)
+    for i, array in enumerate(arrays):
+        if standardizations is not None:
+            mean, scale = standardizations[i]
+            array = (array - mean) / scale
+        stacked[i, :len(array)] = torch.from_numpy(np.ascontiguousarray(array)).to(dtype)
+        mask[i, :len(array)] = 1.0
+    return stacked, mask
+
+def _masked_bce(logits, y, mask, n):
+    """The mean binary cross-entropy of every (probe, penalty) - logits: (P, N, L), y and mask: (P, N), n: (P,)"""
+    import torch
+    losses = torch.nn.functional.binary_cross_entropy_with_logits(logits, y.unsqueeze(2).expand_as(logits), reduction="none")
+    return (losses * mask.unsqueeze(2)).sum(dim=1) / n.unsqueeze(1)
+
+def _masked_accuracy(logits, y, mask, n):
+    """The accuracy of every (probe, penalty) - logits: (P, N, L), y and mask: (P, N), n: (P,)"""
+    import torch
+    return (((logits > 0).to(torch.float32) == y.unsqueeze(2)).to(torch.float32) * mask.unsqueeze(2)).sum(dim=1) / n.unsqueeze(1)
+
+def get_problem_batches(n_rows, d, max_batch_bytes=None):
+    """
+    Group the problems (of n_rows[i] rows of dimension d) into batches whose zero-padded float32 features take at most
+    max_batch_bytes (at least a problem per batch). The problems are grouped in ascending order of their number of rows,
+    so each batch is padded to rows of similar problems. None - a single batch of all the problems (in their order).
+    returns: the indices of the problems of each batch
+    """
+    if max_batch_bytes is None:
+        return [list(range(len(n_rows)))]
+    batches = [[]]
+    for i in sorted(range(len(n_rows)), key=lambda i: n_rows[i]):
+        # in ascending order, the new problem is the largest of the batch
+        if batches[-1] and (len(batches[-1]) + 1) * n_rows[i] * d * 4 > max_batch_bytes:
+            batches.append([])
+        batches[-1].append(i)
+    return batches
+
+def train_batched_probes(problems, l2_values=L2_VALUES, max_epochs=1000, lr=0.01, patience=20, val_fraction=0.2, seed=0, max_batch_bytes=None):
+    """
+    Train a logistic-regression probe for each problem, in batched optimizations.
+    problems: a list of (X, y) (X - (n, d) with the same d for all the problems, y - 0/1 labels)
+    max_batch_bytes: the memory budget of the zero-padded (float32) features of each batch of problems (see
+                     get_problem_batches). Every problem is optimized on its own, so the batching doesn't change the probes.
+                     None - all the problems in a single batch.
+    returns: a list (in the order of the problems) of dicts with the probe (a LogisticRegression on the raw features), its
+             l2 (penalty strength), validation accuracy and number of epochs
+    """
+    import torch
+    torch.manual_seed(seed)
+    probes = [None] * len(problems)
+    for batch in get_problem_batches([len(X) for X, _ in problems], problems[0][0].shape[1], max_batch_bytes):
+        batch_probes = _train_probe_batch([problems[i] for i in batch], l2_values, max_epochs, lr, patience, val_fraction, seed)
+        for i, probe in zip(batch, batch_probes):
+            probes[i] = probe
+    return probes
+
+def _train_probe_batch(problems, l2_values, max_epochs, lr, patience, val_fraction, seed):
+    """Train the probes of a batch of problems (see train_batched_probes) in a single batched optimization."""
+    import torch
+    splits = [train_test_split(X, y, test_size=val_fraction, random_state=seed, stratify=y) for X, y in problems]
+    standardizations = [get_standardization(X_train) for X_train, _, _, _ in splits]
+    X_train, train_mask = _stack([X for X, _, _, _ in splits], max(len(split[0]) for split in splits), torch.float32, standardizations)
+    y_train, _ = _stack([y for _, _, y, _ in splits], X_train.shape[1], torch.float32)
+    X_val, val_mask = _stack([X for _, X, _, _ in splits], max(len(split[1]) for split in splits), torch.float32, standardizations)
+    y_val, _ = _stack([y for _, _, _, y in splits], X_val.shape[1], torch.float32)
+    del splits
+    n_train, n_val = train_mask.sum(dim=1), val_mask.sum(dim=1)
+    l2 = torch.tensor(l2_values, dtype=torch.float32)
+
+    # a column of weights per (problem, penalty)
+    n_problems, d, n_l2 = len(problems), X_train.shape[2], len(l2_values)
+    W, b = torch.zeros((n_problems, d, n_l2)), torch.zeros((n_problems, n_l2))
+    W_m, W_v, b_m, b_v = torch.zeros_like(W), torch.zeros_like(W), torch.zeros_like(b), torch.zeros_like(b)
+    best_W, best_b = W.clone(), b.clone()
+    best_loss, best_epoch = torch.full((n_problems, n_l2), float("inf")), torch.zeros((n_problems, n_l2), dtype=torch.long)
+    val_accuracy = torch.zeros((n_problems, n_l2))
+    active = torch.arange(n_problems) # the problems with a (problem, penalty) that didn't stop yet
+    # the features of the active problems: the stacked tensors themselves (not copies), compacted when some problems stop
+    X_a, y_a, weights_a = X_train, y_train, (train_mask / n_train.unsqueeze(1)).unsqueeze(2)
+    X_val_a, y_val_a, val_mask_a, n_val_a = X_val, y_val, val_mask, n_val
+    del X_train, y_train, train_mask, X_val, y_val, val_mask
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+    for epoch in range(1, max_epochs+1):
+        # the gradients of the mean logistic loss + l2*||w||^2/2 (computed directly, without autograd)
+        W_a, b_a = W[active], b[active]
+        residuals = (torch.sigmoid(torch.bmm(X_a, W_a) + b_a.unsqueeze(1)) - y_a.unsqueeze(2)) * weights_a
+        grad_W = torch.bmm(X_a.transpose(1, 2), residuals) + l2 * W_a
+        grad_b = residuals.sum(dim=1)
+        # Adam
+        W_m[active] = beta1 * W_m[active] + (1 - beta1) * grad_W
+        W_v[active] = beta2 * W_v[active] + (1 - beta2) * grad_W ** 2
+        b_m[active] = beta1 * b_m[active] + (1 - beta1) * grad_b
+        b_v[active] = beta2 * b_v[active] + (1 - beta2) * grad_b ** 2
+        W_a = W_a - lr * (W_m[active] / (1 - beta1 ** epoch)) / ((W_v[active] / (1 - beta2 ** epoch)).sqrt() + eps)
+        b_a = b_a - lr * (b_m[active] / (1 - beta1 ** epoch)) / ((b_v[active] / (1 - beta2 ** epoch)).sqrt() + eps)
+        W[active], b[active] = W_a, b_a
+
+        # early stopping of each (problem, penalty) on its validation loss
+        val_loss = _masked_bce(torch.bmm(X_val_a, W_a) + b_a.unsqueeze(1), y_val_a, val_mask_a, n_val_a)
+        improved = val_loss < best_loss[active]
+        best_loss[active] = torch.where(improved, val_loss, best_loss[active])
+        best_epoch[active] = torch.where(improved, torch.full_like(best_epoch[active], epoch), best_epoch[active])
+        best_W[active] = torch.where(improved.unsqueeze(1), W_a, best_W[active])
+        best_b[active] = torch.where(improved, b_a, best_b[active])
+        stopped = (epoch - best_epoch[active] >= patience).all(dim=1)
+        if epoch == max_epochs:
+            stopped[:] = True
+        if not stopped.any():
+            continue
+        # the validation accuracy of the stopped problems (their best weights won't change), before their rows are dropped
+        done, kept = stopped.nonzero().squeeze(1), (~stopped).nonzero().squeeze(1)
+        val_accuracy[active[done]] = _masked_accuracy(torch.bmm(X_val_a[done], best_W[active[done]]) + best_b[active[done]].unsqueeze(1), y_val_a[done], val_mask_a[done], n_val_a[done])
+        active = active[kept]
+        if len(active) == 0:
+            break
+        # compact the features to the active problems (the previous tensors are released, so they are never held twice)
+        X_a, y_a, weights_a = X_a.index_select(0, kept), y_a.index_select(0, kept), weights_a.index_select(0, kept)
+        X_val_a, y_val_a, val_mask_a, n_val_a = X_val_a.index_select(0, kept), y_val_a.index_select(0, kept), val_mask_a.index_select(0, kept), n_val_a.index_select(0, kept)
+
+    probes = []
+    for i, (mean, scale) in enumerate(standardizations):
+        j = int(torch.argmax(val_accuracy[i])) # the first (i.e., the weakest) penalty on ties
+        probes.append({"probe": to_sklearn_classifier(best_W[i, :, j].numpy(), float(best_b[i, j]), mean, scale, l2_values[j], int(n_train[i]), int(best_epoch[i, j])),
+                       "l2": l2_values[j],
+                       "val_accuracy": float(val_accuracy[i, j]),
+                       "epochs": int(best_epoch[i, j])})
+    return probes
+
+class StreamingProbes:
+    """Logistic-regression probes (one per penalty strength) trained by SGD on mini-batches, with the state of the streaming standardization and of the early stopping."""
+    def __init__(self, l2_values=L2_VALUES, patience=2, seed=0, eps=1e-12):
+        self.l2_values = list(l2_values)
+        self.patience = patience
+        self.eps = eps
+        self.classes = np.array([0.0, 1.0])
+        self.models = [SGDClassifier(loss="log_loss", penalty="l2", alpha=l2, learning_rate="optimal", random_state=seed) for l2 in self.l2_values]
+        # the standardization (the float64 sums of the first pass over the train rows)
+        self.n_stats_rows, self.sums, self.squared_sums = 0, None, None
+        self.mean, self.scale = None, None
+        # the current epoch (the losses of the held-out rows, and the number of train rows)
+        self.epoch = 0
+        self.n_train_rows = 0
+        self._reset_epoch()
+        # the best epoch of each penalty
+        self.best_loss = np.full(len(self.l2_values), np.inf)
+        self.best_accuracy = np.zeros(len(self.l2_values))
+        self.best_epoch = np.zeros(len(self.l2_values), dtype=np.int64)
+        self.best_coef = [None] * len(self.l2_values)
+        self.best_intercept = [None] * len(self.l2_values)
+
+    def _reset_epoch(self):
+        self.epoch_train_rows = 0
+        self.val_loss = np.zeros(len(self.l2_values))
+        self.val_correct = np.zeros(len(self.l2_values))
+        self.n_val_rows = 0
+
+    @property
+    def is_standardized(self):
+        return self.mean is not None
+
+    @property
+    def active(self):
+        """The penalties that didn't stop yet."""
+        return [j for j in range(len(self.l2_values)) if self.epoch - self.best_epoch[j] < self.patience or self.best_coef[j] is None]
+
+    def update_standardization(self, X):
+        if self.sums is None:
+            self.sums, self.squared_sums = np.zeros(X.shape[1]), np.zeros(X.shape[1])
+        self.sums += X.sum(axis=0, dtype=np.float64)
+        self.squared_sums += np.square(X, dtype=np.float64).sum(axis=0)
+        self.n_stats_rows += len(X)
+
+    def finalize_standardization(self):
+        self.mean = self.sums / self.n_stats_rows
+        self.scale = np.sqrt(np.maximum(self.squared_sums / self.n_stats_rows - self.mean ** 2, 0.0))
+        self.scale[self.scale < self.eps] = 1.0
+
+    def _standardize(self, X):
+        return ((X - self.mean) / self.scale).astype(np.float32, copy=False)
+
+    def partial_fit(self, X, y):
+        X = self._standardize(X)
+        for j in self.active:
+            self.models[j].partial_fit(X, y, classes=self.classes)
+        self.epoch_train_rows += len(X)
+
+    def validate(self, X, y):
+        """
+        Accumulate the loss and the accuracy of every penalty on held-out rows, with the current weights - a streaming
+        estimate, as the weights keep changing during the epoch (train_streaming_probe.py scores the saved probe exactly,
+        in a last pass over the held-out rows).
+        """
+        X = self._standardize(X)
+        for j in self.active:
+            if not hasattr(self.models[j], "coef_"):
+                continue
+            logits = X @ self.models[j].coef_[0] + self.models[j].intercept_[0]
+            self.val_loss[j] += float((np.logaddexp(0, logits) - y * logits).sum())
+            self.val_correct[j] += float(((logits > 0) == (y > 0)).sum())
+        self.n_val_rows += len(X)
+
+    def end_epoch(self):
+        """Keep the weights of the penalties whose held-out loss improved. returns: whether all the penalties stopped."""
+        trained = self.active # the penalties that were trained (and validated) in this epoch
+        self.epoch += 1
+        self.n_train_rows = self.epoch_train_rows
+        for j in trained:
+            val_loss = self.val_loss[j] / max(self.n_val_rows, 1)
+            if val_loss < self.best_loss[j]:
+                self.best_loss[j], self.best_accuracy[j], self.best_epoch[j] = val_loss, self.val_correct[j] / max(self.n_val_rows, 1), self.epoch
+                self.best_coef[j], self.best_intercept[j] = self.models[j].coef_[0].copy(), float(self.models[j].intercept_[0])
+        self._reset_epoch()
+        return len(self.active) == 0
+
+    def get_epoch_results(self):
+        return [{"l2": l2, "best_epoch": int(self.best_epoch[j]), "val_loss": float(self.best_loss[j]), "val_accuracy": float(self.best_accuracy[j]), "active": j in self.active} for j, l2 in enumerate(self.l2_values)]
+
+    def get_best_probe(self):
+        """The probe of the penalty with the best held-out accuracy (a LogisticRegression on the raw features), and its results."""
+        j = int(np.argmax(self.best_accuracy))
+        return to_sklearn_classifier(self.best_coef[j], self.best_intercept[j], self.mean, self.scale, self.l2_values[j], self.n_train_rows, int(self.best_epoch[j])), self.get_epoch_results()[j]
+
+    def save(self, path):
+        # write to a temporary file first, so a crash while saving never leaves a partial checkpoint behind
+        with open(f"{path}.tmp", 'wb') as file:
+            pickle.dump(self, file)
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as file:
+            return pickle.load(file)
@@ -0,0 +1,114 @@
+"""
+Projection of the hidden states to k dimensions at capture time, to store (and later load) k-dim vectors instead of the
+full 4096/7168-dim ones.
+
+A projection is learned once - by a randomized PCA of a calibration subset of the hidden states of an existing artifact,
+or as a seeded Gaussian random projection (which only needs the dimension) - and saved to an npz file:
+    method      - "pca" or "random"
+    mean        - (d,) subtracted before the projection (zeros for "random")
+    components  - (d, k) the projection matrix
+The generation scripts apply it on the model's device (--projection), to last_hidden_embedding, and save a copy of it next
+to every artifact (<artifact stem>.projection.npz), so the k-dim features can always be traced back to their projection.
+"""
+import os
+import shutil
+import argparse
+import numpy as np
+import torch
+from artifact_utils import get_artifact_stem
+
+PROJECTION_METHODS = ["pca", "random"]
+PROJECTION_SUFFIX = ".projection.npz"
+
+
+def fit_pca_projection(X, k, seed=0, n_oversamples=10, n_iter=4):
+    """The top-k principal components of X (by a randomized SVD)."""
+    mean = X.mean(axis=0)
+    rng = np.random.default_rng(seed)
+    X_centered = (X - mean).astype(np.float32, copy=False)
+    # randomized range finder (with power iterations), then an exact SVD of the small projected matrix
+    Q = X_centered.T @ rng.standard_normal((X_centered.shape[0], k + n_oversamples)).astype(np.float32)
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(X_centered.T @ (X_centered @ Q))
+    Q, _ = np.linalg.qr(Q)
+    _, _, Vt = np.linalg.svd(X_centered @ Q, full_matrices=False)
+    components = Q @ Vt[:k].T
+    return {"method": "pca", "mean": mean.astype(np.float32), "components": components.astype(np.float32)}
+
+def get_random_projection(d, k, seed=0):
+    """A Gaussian random projection (scaled by 1/sqrt(k), so the norms are preserved in expectation)."""
+    rng = np.random.default_rng(seed)
+    return {"method": "random", "mean": np.zeros(d, dtype=np.float32), "components": (rng.standard_normal((d, k)) / np.sqrt(k)).astype(np.float32)}
+
+def save_projection(projection, path):
+    np.savez(path, method=np.array(projection["method"]), mean=projection["mean"], components=projection["components"])
+    return path
+
+def load_projection(path):
+    with np.load(path) as data:
+        return {"method": str(data["method"]), "mean": data["mean"], "components": data["components"]}
+
+def get_projection_path(artifact_path):
+    """The copy of the projection that is saved next to an artifact."""
+    return f"{get_artifact_stem(artifact_path)}{PROJECTION_SUFFIX}"
+
+def copy_projection(projection_path, artifact_path):
+    return shutil.copyfile(projection_path, get_projection_path(artifact_path))
+
+def project(X, projection):
+    """Project (n, d) features (e.g., full-width features of an older artifact) with the projection."""
+    return (X - projection["mean"]) @ projection["components"]
+
+class Projector:
+    """Applies a projection to hidden states on their device (and in their dtype)."""
+    def __init__(self, projection):
+        self.projection = projection
+        self._tensors = dict()
+
+    @property
+    def k(self):
+        return self.projection["components"].shape[1]
+
+    def _get_tensors(self, device, dtype):
+        if not (device, dtype) in self._tensors.keys():
+            self._tensors[(device, dtype)] = (torch.from_numpy(self.projection["mean"]).to(device=device, dtype=dtype),
+                                              torch.from_numpy(self.projection["components"]).to(device=device, dtype=dtype))
+        return self._tensors[(device, dtype)]
+
+    def __call__(self, hidden_states):
+        mean, components = self._get_tensors(hidden_states.device, hidden_states.dtype)
+        return (hidden_states - mean) @ components
+
+def main(args):
+    if args.method == "random":
+        if args.dim is None:
+            raise Exception("--dim is required for a random projection")
+        projection = get_random_projection(args.dim, args.k, args.seed)
+    else:
+        from feature_cache import load_cached_features
+        features = [load_cached_features(path, prompt_type=args.prompt_type, embedding_type=args.embedding_type, aggregation_type=args.aggregation_type, cache_dir=args.feature_cache_dir)[0] for path in args.calibration_artifacts]
+        X = np.concatenate(features)
+        if args.n_calibration_rows is not None and args.n_calibration_rows < len(X):
+            X = X[np.random.default_rng(args.seed).choice(len(X), args.n_calibration_rows, replace=False)]
+        projection = fit_pca_projection(X, args.k, args.seed)
+        print(f"fitted a PCA projection on {len(X)} rows")
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    save_projection(projection, args.out)
+    print(f"saved a {projection['method']} projection ({projection['components'].shape[0]} -> {projection['components'].shape[1]}) to {args.out}")
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="learn a projection of the hidden states to k dimensions (to apply at capture time with --projection).")
+    argparser.add_argument("--method", type=str, default="pca", choices=PROJECTION_METHODS, help="pca - a randomized PCA of a calibration subset, random - a seeded Gaussian random projection.")
+    argparser.add_argument("--k", type=int, required=True, help="the dimension to project to.")
+    argparser.add_argument("--out", type=str, required=True, help="path to save the projection to (an npz file).")
+    argparser.add_argument("--calibration-artifacts", nargs='+', type=str, default=[], help="(pca) the artifacts (pt files or columnar) with the full-width hidden states to fit on.")
+    argparser.add_argument("--n-calibration-rows", type=int, default=50000, help="(pca) the size of the (random) calibration subset of the rows.")
+    argparser.add_argument("--prompt-type", type=str, default="Regular-Prompt", help="(pca) the prompt type to fit on.")
+    argparser.add_argument("--embedding-type", type=str, default="last_hidden_embedding", help="(pca) the hidden states to fit on.")
+    argparser.add_argument("--aggregation-type", type=str, default="union", help="(pca) the rows to fit on (\"union\" - every generated token).")
+    argparser.add_argument("--feature-cache-dir", type=str, default=None, help="(pca) dir of the feature cache. If None - no caching.")
+    argparser.add_argument("--dim", type=int, default=None, help="(random) the dimension of the hidden states.")
+    argparser.add_argument("--seed", type=int, default=0, help="the seed of the random projection (or of the randomized PCA).")
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,187 @@
+"""
+The manifest of a generation run (run_manifest.json, at the root of the run's outdir), written by the generation scripts:
+the arguments of every invocation, and the full configuration of every artifact (model, shot, k_beams, prompt variant,
+icl variant, dataset, data type, split and output format).
+
+The downstream scripts list the artifacts of a run from the manifest instead of walking its tree, and look up the
+configuration of an artifact - or of any file derived from it under its subdir (e.g., the csvs under regular_decoding/) -
+with a few dict lookups, instead of inferring it from substrings of the path (so any k and model name are supported).
+Runs without a manifest fall back to walking the tree and inferring from the path; to write the manifest of such a run
+once, run this script on its outdir.
+"""
+import os
+import re
+import json
+import time
+import logging
+import argparse
+from functools import lru_cache
+from artifact_utils import OUTPUT_FORMATS, walk_artifacts, get_artifact_stem, get_artifact_path
+
+# Set the logging level to INFO
+logging.basicConfig(level=logging.INFO)
+
+RUN_MANIFEST_FILE = "run_manifest.json"
+RUN_MANIFEST_VERSION = 1
+SUBDIR_KEYS = ["model", "shot", "k_beams", "variant", "icl_variant"] # the configuration shared by the artifacts of a subdir
+
+
+def _to_json_value(value):
+    return value if value is None or isinstance(value, (str, int, float, bool, list, dict)) else str(value)
+
+class RunManifest:
+    def __init__(self, path):
+        """path: the manifest file (created on the first record)"""
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.runs, self.artifacts = [], dict()
+        if os.path.exists(path):
+            with open(path, 'r') as f1:
+                manifest = json.loads(f1.read())
+            self.runs, self.artifacts = manifest["runs"], manifest["artifacts"]
+        self._index()
+
+    def _index(self):
+        """subdir -> its configuration, and (subdir, artifact stem) -> the artifact's configuration (for the lookups of derived files)."""
+        self._subdirs, self._stems = dict(), dict()
+        for key, config in self.artifacts.items():
+            subdir, name = os.path.split(key)
+            self._subdirs[subdir] = {k: config.get(k) for k in SUBDIR_KEYS}
+            self._stems[(subdir, get_artifact_stem(name))] = config
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root)
+
+    def record_run(self, args):
+        """Record the arguments of an invocation of a generation script."""
+        self.runs.append({"started_at": time.strftime("%d-%m-%Y_%H:%M:%S"), "args": {key: _to_json_value(value) for key, value in vars(args).items()}})
+        self.save()
+
+    def record_artifact(self, artifact_path, **config):
+        """
+        Record the configuration of an artifact (model, shot, k_beams, variant, icl_variant, dataset, data_type, split, output_format,
+        and optionally captured_layers). Keys that were recorded before and aren't passed (e.g., of a skipped artifact) are kept.
+        """
+        key = self._key(artifact_path)
+        self.artifacts[key] = {**self.artifacts.get(key, dict()), **{name: _to_json_value(value) for name, value in config.items()}}
+        self._index()
+        self.save()
+
+    def save(self):
+        # merge with the records of other generation processes that write to the same outdir
+        if os.path.exists(self.path):
+            saved = RunManifest(self.path)
+            self.runs = saved.runs + [run for run in self.runs if not run in saved.runs]
+            self.artifacts = {**saved.artifacts, **self.artifacts}
+            self._index()
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{self.path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'w') as f1:
+            f1.write(json.dumps({"version": RUN_MANIFEST_VERSION, "runs": self.runs, "artifacts": self.artifacts}, indent=2))
+        os.replace(tmp_path, self.path)
+
+    def _is_under(self, key, indir_key):
+        return indir_key == "." or key == indir_key or key.startswith(f"{indir_key}{os.sep}")
+
+    def get_artifacts(self, indir=None):
+        """(subdir, artifact name, configuration) of every recorded artifact (under indir) that exists."""
+        indir_key = "." if indir is None else self._key(indir)
+        artifacts = []
+        for key, config in sorted(self.artifacts.items()):
+            if not self._is_under(key, indir_key):
+                continue
+            # the artifact may have been converted to the other format since (see post_processing/pt_to_columnar.py)
+            path = os.path.join(self.root, key)
+            paths = [path] + [get_artifact_path(f"{get_artifact_stem(path)}.pt", output_format) for output_format in OUTPUT_FORMATS]
+            path = next((path for path in paths if os.path.exists(path)), None)
+            if path is not None:
+                artifacts.append((os.path.dirname(path), os.path.basename(path), config))
+        return artifacts
+
+    def lookup(self, path):
+        """
+        The configuration of an artifact, or of a file/dir derived from it under its subdir (None if not recorded).
+        For a dir above the subdirs (e.g., a model's dir), the configuration values shared by all of its artifacts.
+        """
+        key = self._key(path)
+        if key in self.artifacts.keys():
+            return self.artifacts[key]
+        stem = get_artifact_stem(os.path.splitext(os.path.basename(key))[0])
+        ancestor = key
+        while ancestor and ancestor != ".":
+            if ancestor in self._subdirs.keys():
+                return self._stems.get((ancestor, stem), self._subdirs[ancestor])
+            ancestor = os.path.dirname(ancestor)
+        configs = [config for artifact_key, config in self.artifacts.items() if self._is_under(artifact_key, key)]
+        if not configs:
+            return None
+        return {k: v for k, v in configs[0].items() if all(config.get(k) == v for config in configs)}
+
+@lru_cache(maxsize=None)
+def _find_run_manifest(dir_path):
+    if os.path.exists(os.path.join(dir_path, RUN_MANIFEST_FILE)):
+        return RunManifest(os.path.join(dir_path, RUN_MANIFEST_FILE))
+    parent = os.path.dirname(dir_path)
+    return None if parent == dir_path else _find_run_manifest(parent)
+
+def find_run_manifest(path):
+    """The manifest of the run that path is in (searched for in path and in its parents), or None."""
+    path = os.path.abspath(path)
+    return _find_run_manifest(path if os.path.isdir(path) else os.path.dirname(path))
+
+def get_run_config(path):
+    """The recorded configuration of path (see RunManifest.lookup), or None if its run has no manifest."""
+    manifest = find_run_manifest(path)
+    return manifest.lookup(path) if manifest is not None else None
+
+def iter_artifacts(indir):
+    """(subdir, artifact name) of every artifact under indir - from the run manifest, or by walking indir if there is none."""
+    manifest = find_run_manifest(indir)
+    if manifest is not None and manifest.artifacts:
+        for subdir, name, _ in manifest.get_artifacts(indir):
+            yield subdir, name
+    else:
+        yield from walk_artifacts(indir)
+
+def get_run_subdirs(indir):
+    """The subdirs with the artifacts under indir (in the order of the artifacts)."""
+    return list(dict.fromkeys(subdir for subdir, _ in iter_artifacts(indir)))
+
+def infer_artifact_config(root, subdir, name):
+    """The configuration of an artifact of a run without a manifest, from its path (outdir/model/shot/k_beams_<k>/variant[/icl_examples_v<n>])."""
+    parts = os.path.relpath(subdir, root).split(os.sep)
+    k_beams = re.fullmatch(r"k_beams_(\d+)", parts[2]) if len(parts) >= 4 else None
+    if k_beams is None or not parts[1] in ["zero_shot", "few_shot"]:
+        return None
+    data_type = "un-answerable" if name.startswith("un-answerable") else "answerable"
+    dataset_and_split = get_artifact_stem(name)[len(data_type)+1:].split("_")
+    return {"model": parts[0],
+            "shot": parts[1],
+            "k_beams": int(k_beams.group(1)),
+            "variant": parts[3],
+            "icl_variant": parts[4] if len(parts) > 4 else None,
+            "dataset": dataset_and_split[0],
+            "data_type": data_type,
+            "split": dataset_and_split[1] if len(dataset_and_split) > 1 else None,
+            "output_format": "pt" if name.endswith(".pt") else "columnar"}
+
+def main(indirs):
+    for indir in indirs:
+        manifest = RunManifest(os.path.join(indir, RUN_MANIFEST_FILE))
+        n_artifacts = 0
+        for subdir, name in walk_artifacts(indir):
+            config = infer_artifact_config(indir, subdir, name)
+            if config is None:
+                logging.info(f"skipping {os.path.join(subdir, name)} (not in the layout of the generation scripts)")
+                continue
+            manifest.artifacts[manifest._key(os.path.join(subdir, name))] = config
+            n_artifacts += 1
+        manifest.save()
+        print(f"recorded {n_artifacts} artifacts in {manifest.path}")
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="write the run manifest of generation outdirs that were generated without one.")
+    argparser.add_argument("--indirs", nargs='+', type=str, required=True, help="the outdirs of the generation runs.")
+    args = argparser.parse_args()
+    main(args.indirs)
@@ -0,0 +1,98 @@
+"""
+Manifest of the content hashes of the inputs and outputs of each unit of work of the post-processing and evaluation stages
+(e.g., the csvs converted from an artifact, or the QA-task results of a subdir), so re-runs only recompute what is stale.
+
+A unit is up to date if it was recorded with the same input files (with the same contents), and all of its recorded outputs
+still exist with the same contents. Since the outputs of a stage are the inputs of the next one, a changed file only causes
+the units downstream of it to be recomputed.
+The content hashes are memoized by the files' (size, mtime), so unchanged files are not re-read.
+"""
+import os
+import json
+import logging
+from feature_cache import compute_content_hash
+
+# Set the logging level to INFO
+logging.basicConfig(level=logging.INFO)
+
+MANIFEST_FILE = "stage_manifest.json"
+
+
+def _get_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+class StageManifest:
+    def __init__(self, path, dry_run=False, force=False):
+        """
+        path: the manifest file (created on the first save)
+        dry_run: only log the units that would be recomputed (nothing is recorded)
+        force: treat all the units as stale
+        """
+        self.path = path
+        self.dry_run = dry_run
+        self.force = force
+        self.stages = dict()
+        if os.path.exists(path):
+            with open(path, 'r') as f1:
+                self.stages = json.loads(f1.read())
+        self.stale_units = []
+        self._hashes = dict() # hashes computed in this run (so every file is hashed at most once)
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.dirname(os.path.abspath(self.path)))
+
+    def _get_hash(self, path, recorded=None):
+        """The content hash of the file (reusing the recorded hash if the file's size and mtime didn't change)."""
+        signature = _get_signature(path)
+        if recorded is not None and recorded["signature"] == signature:
+            return recorded["hash"]
+        abs_path = os.path.abspath(path)
+        if not abs_path in self._hashes.keys() or self._hashes[abs_path][0] != signature:
+            self._hashes[abs_path] = (signature, compute_content_hash(path))
+        return self._hashes[abs_path][1]
+
+    def _get_state(self, paths, recorded_files=dict()):
+        return {self._key(path): {"signature": _get_signature(path), "hash": self._get_hash(path, recorded_files.get(self._key(path)))} for path in sorted(set(paths))}
+
+    def _is_unchanged(self, recorded_files, paths=None):
+        if paths is not None and sorted(recorded_files.keys()) != sorted(self._key(path) for path in set(paths)):
+            return False
+        base_dir = os.path.dirname(os.path.abspath(self.path))
+        for key, recorded in recorded_files.items():
+            path = os.path.join(base_dir, key)
+            if not os.path.exists(path) or self._get_hash(path, recorded) != recorded["hash"]:
+                return False
+        return True
+
+    def is_up_to_date(self, stage, unit, inputs):
+        """Whether the unit of the stage was already computed from the current inputs (and its outputs weren't changed since). In a dry run, stale units are logged."""
+        entry = self.stages.get(stage, dict()).get(self._key(unit))
+        up_to_date = not self.force and entry is not None and self._is_unchanged(entry["inputs"], inputs) and self._is_unchanged(entry["outputs"])
+        if not up_to_date:
+            self.mark_stale(stage, unit)
+        return up_to_date
+
+    def mark_stale(self, stage, unit):
+        """Mark the unit of the stage as stale (e.g., when its inputs are about to be recomputed). In a dry run, it is logged."""
+        self.stale_units.append((stage, unit))
+        if self.dry_run:
+            logging.info(f"[dry run] would recompute {stage}: {unit}")
+
+    def record(self, stage, unit, inputs, outputs):
+        """Record the inputs and the (existing) outputs of a computed unit."""
+        if self.dry_run:
+            return
+        entry = self.stages.get(stage, dict()).get(self._key(unit), {"inputs": dict()})
+        self.stages.setdefault(stage, dict())[self._key(unit)] = {"inputs": self._get_state(inputs, entry["inputs"]),
+                                                                  "outputs": self._get_state([path for path in outputs if os.path.exists(path)])}
+
+    def save(self):
+        if self.dry_run:
+            logging.info(f"[dry run] {len(self.stale_units)} units would be recomputed")
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f1:
+            f1.write(json.dumps(self.stages, indent=2))
+        os.replace(tmp_path, self.path)
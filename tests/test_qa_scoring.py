@@ -0,0 +1,77 @@
+"""
+Parity of the in-process QA-task scoring (evaluation/qa_scoring.py) with the official evaluation scripts, on a small fixed
+fixture: every metric of the official scripts (run as before, in a subprocess) - including best_* with a no-answer
+probability file - and the average precisions (pr_*) of their make_precision_recall_eval (which they only compute with
+--out-image-dir, i.e., with the plots).
+"""
+import json
+import os
+import sys
+import pytest
+
+pytest.importorskip("numpy")
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'evaluation')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qa_scoring import get_official_script, load_gold_dataset, run_official_script, score_prediction_files
+
+# qid -> gold answers ([] - un-answerable)
+GOLD_ANSWERS = {"q1": ["The Eiffel Tower", "Eiffel Tower"],
+                "q2": ["1889"],
+                "q3": ["Gustave Eiffel's company"],
+                "q4": [],
+                "q5": ["a wrought-iron lattice tower", "lattice tower"],
+                "q6": [],
+                "q7": ["Paris, France", "Paris"],
+                "q8": ["the Champ de Mars in Paris"],
+                "q9": [],
+                "q10": ["three hundred and thirty metres"]}
+# the same answer strings in several files (the interned answers), articles, punctuation and case, partial token overlaps
+# (non-trivial float F1s), and abstentions ("") on answerable and un-answerable questions
+PREDICTIONS = [{"q1": "the eiffel tower.", "q2": "in 1889", "q3": "Eiffel's company", "q4": "", "q5": "a lattice tower made of iron",
+                "q6": "Paris", "q7": "Paris", "q8": "Champ de Mars", "q9": "", "q10": "three hundred metres"},
+               {"q1": "Eiffel", "q2": "", "q3": "Gustave Eiffel's company", "q4": "the tower", "q5": "lattice tower",
+                "q6": "", "q7": "France", "q8": "the Champ de Mars in Paris, France", "q9": "1889", "q10": "330 metres"},
+               {"q1": "", "q2": "", "q3": "", "q4": "", "q5": "", "q6": "", "q7": "", "q8": "", "q9": "", "q10": ""}]
+# with ties (the thresholds can only be put between distinct probabilities)
+NA_PROBS = [{"q1": 0.1, "q2": 0.7, "q3": 0.3, "q4": 0.9, "q5": 0.3, "q6": 0.2, "q7": 0.05, "q8": 0.3, "q9": 0.8, "q10": 0.6},
+            {"q1": 0.5, "q2": 0.5, "q3": 0.1, "q4": 0.4, "q5": 0.2, "q6": 0.9, "q7": 0.6, "q8": 0.15, "q9": 0.35, "q10": 0.7},
+            {qid: 1.0 for qid in GOLD_ANSWERS}]
+
+
+def write_json(path, value):
+    with open(path, 'w') as f1:
+        f1.write(json.dumps(value))
+    return str(path)
+
+@pytest.fixture(params=["squad", "NQ"])
+def gold(request, tmp_path):
+    """The gold file of the dataset's official script (the SQuAD structure, or the NQ/MuSiQue qid -> answers dict)."""
+    if request.param == "squad":
+        gold_json = {"data": [{"paragraphs": [{"qas": [{"id": qid, "answers": [{"text": text} for text in answers]} for qid, answers in GOLD_ANSWERS.items()]}]}]}
+    else:
+        gold_json = {qid: answers if answers else "" for qid, answers in GOLD_ANSWERS.items()}
+    return write_json(tmp_path / f"{request.param}_test_data.json", gold_json), request.param
+
+def get_official_pr_evals(gold_path, dataset, preds, na_probs):
+    """The official run_precision_recall_analysis, without the plots."""
+    script = get_official_script(dataset)
+    qid_to_has_ans = script.make_qid_to_has_ans(load_gold_dataset(gold_path))
+    exact_raw, f1_raw = script.get_raw_scores(load_gold_dataset(gold_path), preds)
+    num_true_pos = sum(1 for v in qid_to_has_ans.values() if v)
+    oracle_scores = {k: float(v) for k, v in qid_to_has_ans.items()}
+    return {f"pr_{name}_ap": script.make_precision_recall_eval(scores, na_probs, num_true_pos, qid_to_has_ans)["ap"] for name, scores in [("exact", exact_raw), ("f1", f1_raw), ("oracle", oracle_scores)]}
+
+@pytest.mark.parametrize("with_na_probs", [False, True])
+def test_parity_with_official_scripts(gold, tmp_path, with_na_probs):
+    gold_path, dataset = gold
+    pred_paths = [write_json(tmp_path / f"preds_{i}.json", preds) for i, preds in enumerate(PREDICTIONS)]
+    na_prob_paths = [write_json(tmp_path / f"na_probs_{i}.json", na_probs) if with_na_probs else None for i, na_probs in enumerate(NA_PROBS)]
+    # all the files of the gold file are scored in a single call (as evaluate-QA-task.py does)
+    out_evals = score_prediction_files([(gold_path, dataset, pred_path, na_prob_path) for pred_path, na_prob_path in zip(pred_paths, na_prob_paths)], num_workers=1)
+    for preds, na_probs, pred_path, na_prob_path, out_eval in zip(PREDICTIONS, NA_PROBS, pred_paths, na_prob_paths, out_evals):
+        official_eval = run_official_script(gold_path, dataset, pred_path, na_prob_path)
+        if with_na_probs:
+            official_eval.update(get_official_pr_evals(gold_path, dataset, preds, na_probs))
+            assert {"best_exact", "best_f1", "best_exact_thresh", "best_f1_thresh", "pr_exact_ap", "pr_f1_ap", "pr_oracle_ap"} <= set(official_eval.keys())
+        # the in-process values are compared as they are written (json), with exact equality
+        assert json.loads(json.dumps(out_eval)) == official_eval
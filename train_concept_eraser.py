@@ -1,52 +1,49 @@
 import numpy as np
 import os
+import time
 import argparse
-import torch
-import pickle
-from concept_erasure import ConceptEraser
 from pathlib import Path
+from artifact_utils import list_artifacts
+from feature_cache import DEFAULT_CACHE_MAX_GB, load_cached_features
+from feature_extraction import iter_features
+from leace import ERASER_FILE, LAST_LAYER, LeaceStatistics, fit_leace, get_statistics_path, load_statistics
 
 SEED = 42
 
-def adapt_hidden_embeddings(instance):
-    # Compare all elements to 1
-    matches = instance['all_outputs_ids'][0,:].eq(1)
-
-    # Find the first non-zero element in matches
-    indices = matches.nonzero(as_tuple=True)
-
-    # Get the first index where value is 1 (if no 1 then no "padding" and so can take all embeddings)
-    filter_index = indices[0][0].item() if indices[0].numel() != 0 else len(instance['last_hidden_embedding'])
-
-    filtered_hidden_embedding = instance['last_hidden_embedding'][:filter_index]
-    return filtered_hidden_embedding
-
-def get_data(indir, prompt_type, dataset, num_instances, aggregation_type):
-    data = dict()
-    for file_name in os.listdir(indir):
-        if not dataset in file_name or not file_name.endswith(".pt"):
+def iter_data(indir, prompt_type, dataset, num_instances, aggregation_type, chunk_instances, feature_cache_dir=None, feature_cache_max_gb=DEFAULT_CACHE_MAX_GB):
+    """Yield mini-batches of the last hidden states of the dataset's artifacts with their labels (0 - un-answerable, 1 - answerable)."""
+    for file_name in list_artifacts(indir):
+        if not dataset in file_name:
             continue
-        curr_data = torch.load(os.path.join(indir, file_name))
-
-        if num_instances != None:
-            curr_data = {key:value[:num_instances] for key,value in curr_data.items()}
-
-        data_type = "un-answerable" if "un-answerable" in file_name else "answerable"
-        data[data_type] = curr_data
-
-    if aggregation_type == "average":
-        unanswerable_instances = [torch.stack(adapt_hidden_embeddings(elem)).mean(dim=0).cpu().numpy() for elem in data["un-answerable"][prompt_type]]
-        answerable_instances = [torch.stack(adapt_hidden_embeddings(elem)).mean(dim=0).cpu().numpy() for elem in data["answerable"][prompt_type]]
-    elif aggregation_type == "union":
-        unanswerable_instances = [emb.cpu().numpy() for elem in data["un-answerable"][prompt_type] for emb in adapt_hidden_embeddings(elem)]
-        answerable_instances = [emb.cpu().numpy() for elem in data["answerable"][prompt_type] for emb in adapt_hidden_embeddings(elem)]
-    elif aggregation_type == "only_first":
-        unanswerable_instances = [adapt_hidden_embeddings(elem)[0].cpu().numpy() for elem in data["un-answerable"][prompt_type]]
-        answerable_instances = [adapt_hidden_embeddings(elem)[0].cpu().numpy() for elem in data["answerable"][prompt_type]]
-    else:
-        raise Exception("--aggregation-type did not receive a valid option. Only one of 'average', 'union' or 'only_first'")
-
-    return unanswerable_instances, answerable_instances
+        label = 0.0 if "un-answerable" in file_name else 1.0
+        if feature_cache_dir is not None: # the cached features of an artifact are loaded whole (but only one artifact at a time)
+            features, _, _, _ = load_cached_features(os.path.join(indir, file_name), 
+                                                     prompt_type=prompt_type, 
+                                                     embedding_type="last_hidden_embedding", 
+                                                     aggregation_type=aggregation_type, 
+                                                     num_instances=num_instances, 
+                                                     cache_dir=feature_cache_dir, 
+                                                     max_size_gb=feature_cache_max_gb)
+            chunks = (features[start:start+chunk_instances] for start in range(0, len(features), chunk_instances))
+        else:
+            chunks = (features for features, _ in iter_features(os.path.join(indir, file_name), prompt_type, "last_hidden_embedding", aggregation_type, chunk_instances=chunk_instances, num_instances=num_instances))
+        for features in chunks:
+            yield features, np.full(len(features), label)
+
+def get_saved_statistics(indir, prompt_type, dataset, layer=LAST_LAYER):
+    """The statistics of the dataset's artifacts that were accumulated during generation (--accumulate-statistics), merged."""
+    stats = LeaceStatistics()
+    for file_name in list_artifacts(indir):
+        if not dataset in file_name:
+            continue
+        statistics_path = get_statistics_path(os.path.join(indir, file_name))
+        if not os.path.exists(statistics_path):
+            raise Exception(f"{statistics_path} doesn't exist (generate {file_name} with --accumulate-statistics)")
+        all_stats = load_statistics(statistics_path)
+        if not (prompt_type, layer) in all_stats.keys():
+            raise Exception(f"{statistics_path} has no statistics of {prompt_type} at layer {layer} (has: {sorted(all_stats.keys(), key=str)})")
+        stats.merge(all_stats[(prompt_type, layer)])
+    return stats
 
 def main(args):
     outdir = os.path.join(args.outdir, args.dataset, args.prompt_type)
@@ -56,25 +53,28 @@ def main(args):
     folder_path.mkdir(parents=True, exist_ok=True)
     print(f"classifier saved to {outdir}")
 
-    unanswerable_instances, answerable_instances = get_data(indir=args.indir, 
-                                                            prompt_type=args.prompt_type, 
-                                                            dataset=args.dataset, 
-                                                            num_instances=args.num_instances, 
-                                                            aggregation_type=args.aggregation_type)
-
-    # Combine the instances and create corresponding labels
-    unanswerable_labels = np.zeros(len(unanswerable_instances))
-    answerable_labels = np.ones(len(answerable_instances))
-
-    X = torch.from_numpy(np.concatenate((unanswerable_instances, answerable_instances))).float()
-    y = torch.from_numpy(np.concatenate((unanswerable_labels, answerable_labels))).float()
-
-    eraser = ConceptEraser.fit(X, y).to("cuda")
-
-    # save model
-    model_filename = os.path.join(outdir, "eraser.pkl")
-    with open(model_filename, 'wb') as file:
-        pickle.dump(eraser, file)
+    # accumulate the eraser's statistics (in float64, on the CPU) over mini-batches, without materializing all the features
+    start_time = time.time()
+    if args.from_statistics:
+        stats = get_saved_statistics(args.indir, args.prompt_type, args.dataset, LAST_LAYER if args.statistics_layer == LAST_LAYER else int(args.statistics_layer))
+    else:
+        stats = LeaceStatistics()
+        for X, y in iter_data(indir=args.indir, 
+                              prompt_type=args.prompt_type, 
+                              dataset=args.dataset, 
+                              num_instances=args.num_instances, 
+                              aggregation_type=args.aggregation_type, 
+                              chunk_instances=args.chunk_instances, 
+                              feature_cache_dir=args.feature_cache_dir, 
+                              feature_cache_max_gb=args.feature_cache_max_gb):
+            stats.update(X, y)
+    print(f"accumulated the statistics of {stats.n} rows ({stats.n_positive} answerable) of dimension {stats.dim} in {time.time() - start_time:.1f}s")
+
+    eraser = fit_leace(stats)
+
+    # save model (as plain tensors - see leace.py)
+    model_filename = os.path.join(outdir, ERASER_FILE)
+    eraser.save(model_filename)
     print(f"eraser saved to {model_filename}")
 
 if __name__ == '__main__':
@@ -85,6 +85,11 @@ if __name__ == '__main__':
     argparser.add_argument('--prompt-type', type=str, default="Regular-Prompt", help='prompt type to classify ("Regular-Prompt", "Hint-Prompt", "CoT-Prompt", "Answerability")')
     argparser.add_argument('--num-instances', type=int, default=None, help='number of instances to use for training (will take the same amount from the answerable and the un-answerable). If None - will take all.')
     argparser.add_argument('--aggregation-type', type=str, default="only_first", help='how to aggregate all the hidden layers of all the generated tokens of a single instance (choose from "average" to average them, "union" to treat each of them as an instance, and "only_first" to only take the first token\'s hidden layers).')
+    argparser.add_argument('--chunk-instances', type=int, default=256, help='number of instances of each artifact to read at a time (bounds the memory).')
+    argparser.add_argument('--feature-cache-dir', type=str, default=None, help='dir of the feature cache (keyed by the artifacts\' content hash), shared with the other probing, erasure and plotting scripts. If None - no caching.')
+    argparser.add_argument('--feature-cache-max-gb', type=float, default=DEFAULT_CACHE_MAX_GB, help='size cap of the feature cache (least recently used entries are evicted).')
+    argparser.add_argument('--from-statistics', action='store_true', default=False, help='fit from the statistics saved next to the artifacts by the generation scripts (--accumulate-statistics), without reading the hidden states (these are of the first generated token, as with --aggregation-type only_first, and of all the instances).')
+    argparser.add_argument('--statistics-layer', type=str, default=LAST_LAYER, help=f'(--from-statistics) the layer to fit on: "{LAST_LAYER}" (the last hidden state), or one of the --capture-layers indices of the generation.')
     args = argparser.parse_args()
     main(args)
 
@@ -1,34 +1,22 @@
 import os
 import argparse
+import time
 import numpy as np
-from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import train_test_split, GridSearchCV
-import torch
+from sklearn.model_selection import train_test_split
 import pickle
 from pathlib import Path
+from artifact_utils import list_artifacts
+from feature_cache import DEFAULT_CACHE_MAX_GB, load_cached_features
+from run_manifest import get_run_config
+from probe_training import C_VALUES, PENALTIES, MAX_ITER, train_probe
+from probe_gate import NUMPY_PROBE_FILE, export_numpy_probe
 
 SEED = 42
 
-def adapt_hidden_embeddings(instance, embedding_type):
-
-    # if the embeddings of all the generation steps were saved in a single matrix, rather than in a list, separate them
-    if len(instance[embedding_type][-1].shape) == 2:
-        instance[embedding_type] = [instance[embedding_type][0][i,:] for i in range(instance[embedding_type][0].shape[0])]
-
-    # removing the paddings
-    # Compare all elements to 1
-    matches = instance['all_outputs_ids'][0,:].eq(1)
-
-    # Find the first non-zero element in matches
-    indices = matches.nonzero(as_tuple=True)
-
-    # Get the first index where value is 1 (if no 1 then no "padding" and so can take all embeddings)
-    filter_index = indices[0][0].item() if indices[0].numel() != 0 else len(instance[embedding_type])
-
-    filtered_hidden_embedding = instance[embedding_type][:filter_index]
-    return filtered_hidden_embedding
-
 def get_model_name(indir):
+    run_config = get_run_config(indir) # recorded by the generation scripts (None for runs without a run manifest)
+    if run_config is not None and run_config.get("model") is not None:
+        return run_config["model"]
     if "Flan-UL2" in indir:
         curr_model = "Flan-UL2"
     elif "Flan-T5-xxl" in indir:
@@ -39,35 +27,20 @@ def get_model_name(indir):
         raise Exception(f"curr model not found in indir: {indir}")
     return curr_model
 
-def get_data(indir, prompt_type, embedding_type, dataset, num_instances, aggregation_type):
+def get_data(indir, prompt_type, embedding_type, dataset, num_instances, aggregation_type, feature_cache_dir=None, feature_cache_max_gb=DEFAULT_CACHE_MAX_GB):
     data = dict()
-    for file_name in os.listdir(indir):
-        if not dataset in file_name or not file_name.endswith(".pt"):
+    for file_name in list_artifacts(indir):
+        if not dataset in file_name:
             continue
-        curr_data = torch.load(os.path.join(indir, file_name))
-
-        if num_instances != None:
-            curr_data = {key:value[:num_instances] for key,value in curr_data.items()}
-
         data_type = "un-answerable" if "un-answerable" in file_name else "answerable"
-        data[data_type] = curr_data
-
-    if embedding_type == "first_hidden_embedding":
-        unanswerable_instances = [elem[embedding_type].mean(dim=0).cpu().numpy() for elem in data["un-answerable"][prompt_type]]
-        answerable_instances = [elem[embedding_type].mean(dim=0).cpu().numpy() for elem in data["answerable"][prompt_type]]
-    elif aggregation_type == "average":
-        unanswerable_instances = [torch.stack(adapt_hidden_embeddings(elem, embedding_type)).mean(dim=0).cpu().numpy() for elem in data["un-answerable"][prompt_type]]
-        answerable_instances = [torch.stack(adapt_hidden_embeddings(elem, embedding_type)).mean(dim=0).cpu().numpy() for elem in data["answerable"][prompt_type]]
-    elif aggregation_type == "union":
-        unanswerable_instances = [emb.cpu().numpy() for elem in data["un-answerable"][prompt_type] for emb in adapt_hidden_embeddings(elem, embedding_type)]
-        answerable_instances = [emb.cpu().numpy() for elem in data["answerable"][prompt_type] for emb in adapt_hidden_embeddings(elem, embedding_type)]
-    elif aggregation_type == "only_first_tkn":
-        unanswerable_instances = [adapt_hidden_embeddings(elem, embedding_type)[0].cpu().numpy() for elem in data["un-answerable"][prompt_type]]
-        answerable_instances = [adapt_hidden_embeddings(elem, embedding_type)[0].cpu().numpy() for elem in data["answerable"][prompt_type]]
-    else:
-        raise Exception("--aggregation-type did not receive a valid option. Only one of 'average', 'union' or 'only_first_tkn'")
-
-    return unanswerable_instances, answerable_instances
+        data[data_type], _, _, _ = load_cached_features(os.path.join(indir, file_name), 
+                                                        prompt_type=prompt_type, 
+                                                        embedding_type=embedding_type, 
+                                                        aggregation_type=aggregation_type, 
+                                                        num_instances=num_instances, 
+                                                        cache_dir=feature_cache_dir, 
+                                                        max_size_gb=feature_cache_max_gb)
+    return data["un-answerable"], data["answerable"]
 
 def main(args):
     model_name = get_model_name(args.indir)
@@ -84,7 +57,9 @@ def main(args):
                                                             embedding_type=args.embedding_type, 
                                                             dataset=args.dataset, 
                                                             num_instances=args.num_instances, 
-                                                            aggregation_type=args.aggregation_type)
+                                                            aggregation_type=args.aggregation_type, 
+                                                            feature_cache_dir=args.feature_cache_dir, 
+                                                            feature_cache_max_gb=args.feature_cache_max_gb)
 
     # Combine the instances and create corresponding labels
     unanswerable_labels = np.zeros(len(unanswerable_instances))
@@ -96,28 +71,33 @@ def main(args):
     # Split data into train, validation, and test sets (60% train, 20% validation, 20% test)
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=SEED)
 
-    # Train a linear classifier using logistic regression
-    clf = LogisticRegression(random_state=SEED)
-
-    param_grid = {
-            'C': [0.0001, 0.001, 0.01, 0.1, 1, 10, 100, 1000],
-            'penalty': ['l1', 'l2'],
-            'solver': ['liblinear'],
-            'max_iter': [1000, 5000]
-        }
-
-    grid_search = GridSearchCV(clf, param_grid, cv=5, scoring='accuracy', refit=True)
-    grid_search.fit(X_train, y_train)
-
-    # Log the accuracy of different hyperparameters in the GridSearch
-    print("GridSearchCV results:")
-    for mean_score, std_score, params in zip(grid_search.cv_results_['mean_test_score'], grid_search.cv_results_['std_test_score'], grid_search.cv_results_['params']):
-        print(f"Mean accuracy: {mean_score:.4f}, Std: {std_score:.4f}, Parameters: {params}")
+    # Train a linear classifier using logistic regression (the C path of each penalty is cross-validated with warm starts - see probe_training.py)
+    start_time = time.time()
+    best_model, cv_results = train_probe(X_train, y_train, 
+                                         C_values=C_VALUES, 
+                                         penalties=PENALTIES, 
+                                         cv=5, 
+                                         n_jobs=args.n_jobs, 
+                                         seed=SEED, 
+                                         max_iter=args.max_iter, 
+                                         prune_margin=args.prune_margin)
+
+    # Log the accuracy (and the fitting time) of the different hyperparameters
+    print(f"cross-validation results ({time.time() - start_time:.1f}s in total):")
+    for result in cv_results:
+        params = {"C": result["C"], "penalty": result["penalty"]}
+        if result["mean_accuracy"] is None:
+            print(f"Pruned after {result['n_folds']} folds, Parameters: {params}")
+            continue
+        print(f"Mean accuracy: {result['mean_accuracy']:.4f}, Std: {result['std_accuracy']:.4f}, Mean fit time: {result['mean_fit_time']:.2f}s, Mean iterations: {result['mean_n_iter']:.0f}, Parameters: {params}")
+    print(f"Best parameters: {{'C': {best_model.C}, 'penalty': '{best_model.penalty}'}}, test accuracy: {(best_model.predict(X_test) == y_test).mean():.4f}")
 
     # save model
     model_filename = os.path.join(outdir, "best_model.pkl")
     with open(model_filename, 'wb') as file:
-        pickle.dump(grid_search.best_estimator_, file)
+        pickle.dump(best_model, file)
+    # and its weights as a numpy probe (for --probe-gate of zero_shot_prompting.py)
+    export_numpy_probe(best_model, os.path.join(outdir, NUMPY_PROBE_FILE), prompt_type=args.prompt_type, embedding_type=args.embedding_type, aggregation_type=args.aggregation_type)
 
     print(f"Best model saved to {model_filename}")
 
@@ -130,6 +110,11 @@ if __name__ == '__main__':
     argparser.add_argument('--num-instances', type=int, default=None, help='number of instances to use for training (will take the same amount from the answerable and the un-answerable). If None - will take all.')
     argparser.add_argument('--aggregation-type', type=str, default="only_first_tkn", help='how to aggregate all the hidden layers of all the generated tokens of a single instance (choose from "average" to average them, "union" to treat each of them as an instance, and "only_first_tkn" to only take the first token\'s hidden layers).')
     argparser.add_argument('--embedding-type', type=str, default="last_hidden_embedding", help='which layer to take: any one of "last_hidden_embedding" and "first_hidden_embedding"')
+    argparser.add_argument('--feature-cache-dir', type=str, default=None, help='dir of the feature cache (keyed by the artifacts\' content hash), shared with the other probing, erasure and plotting scripts. If None - no caching.')
+    argparser.add_argument('--feature-cache-max-gb', type=float, default=DEFAULT_CACHE_MAX_GB, help='size cap of the feature cache (least recently used entries are evicted).')
+    argparser.add_argument('--n-jobs', type=int, default=-1, help='number of processes to cross-validate the folds in parallel (-1 - all the CPUs).')
+    argparser.add_argument('--max-iter', type=int, default=MAX_ITER, help='maximal number of epochs of each fit (the fits of a C path are warm-started, so most of them converge much earlier).')
+    argparser.add_argument('--prune-margin', type=float, default=0.02, help='stop a C path once its validation accuracy is this much below its best for two consecutive C values (those C values are dominated).')
     args = argparser.parse_args()
     main(args)
 
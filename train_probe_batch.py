@@ -0,0 +1,138 @@
+import os
+import time
+import argparse
+import numpy as np
+import pickle
+import logging
+from pathlib import Path
+from sklearn.model_selection import train_test_split
+from artifact_utils import list_artifacts, get_artifact_fields
+from feature_cache import DEFAULT_CACHE_MAX_GB
+from run_manifest import get_run_config, get_run_subdirs
+from probe_training import L2_VALUES, train_batched_probes
+from probe_gate import NUMPY_PROBE_FILE, export_numpy_probe
+from train_linear_classifiers import SEED, get_model_name, get_data
+
+DATASETS = ["squad", "NQ", "musique"]
+EMBEDDING_TYPES = ["first_hidden_embedding", "last_hidden_embedding"]
+
+
+def get_missing_artifacts(artifacts_fields, prompt_type, embedding_type):
+    """The artifacts (out of {file_name: {prompt_type: [fields]}}) in which the prompt type wasn't generated, or its embedding type wasn't saved."""
+    return [file_name for file_name, fields in artifacts_fields.items() if not embedding_type in fields.get(prompt_type, [])]
+
+def get_problems(indirs, datasets, prompt_types, embedding_types, num_instances, aggregation_type, feature_cache_dir=None, feature_cache_max_gb=DEFAULT_CACHE_MAX_GB):
+    """The (outdir suffix, X, y) of every (model, dataset, embedding type, prompt type) with both answerable and un-answerable train instances."""
+    problems = []
+    for indir in indirs:
+        for subdir in get_run_subdirs(indir):
+            model_name = get_model_name(subdir)
+            file_names = list_artifacts(subdir)
+            for dataset in datasets:
+                if not any(dataset in file_name and "un-answerable" in file_name for file_name in file_names) or not any(dataset in file_name and not "un-answerable" in file_name for file_name in file_names):
+                    continue
+                artifacts_fields = {file_name: get_artifact_fields(os.path.join(subdir, file_name)) for file_name in file_names if dataset in file_name}
+                for embedding_type in embedding_types:
+                    for prompt_type in prompt_types:
+                        missing_artifacts = get_missing_artifacts(artifacts_fields, prompt_type, embedding_type)
+                        if missing_artifacts:
+                            logging.info(f"skipping {dataset} {prompt_type} {embedding_type} of {subdir} (not saved in {', '.join(missing_artifacts)})")
+                            continue
+                        unanswerable_instances, answerable_instances = get_data(indir=subdir,
+                                                                                prompt_type=prompt_type,
+                                                                                embedding_type=embedding_type,
+                                                                                dataset=dataset,
+                                                                                num_instances=num_instances,
+                                                                                aggregation_type=aggregation_type,
+                                                                                feature_cache_dir=feature_cache_dir,
+                                                                                feature_cache_max_gb=feature_cache_max_gb)
+                        X = np.concatenate((unanswerable_instances, answerable_instances))
+                        y = np.concatenate((np.zeros(len(unanswerable_instances)), np.ones(len(answerable_instances))))
+                        problems.append((os.path.join(dataset, embedding_type, prompt_type, aggregation_type, f"{model_name}_{num_instances}N"), X, y, subdir))
+    return disambiguate_outdirs(problems)
+
+def get_subdir_prefix(subdir):
+    """The generation configuration of a subdir (<shot>/k_beams_<k>/<variant>[/<icl_variant>], as in its run's layout), or None if its run has no manifest."""
+    config = get_run_config(subdir)
+    if config is None or config.get("shot") is None:
+        return None
+    parts = [config["shot"], f"k_beams_{config['k_beams']}", config["variant"]] + ([config["icl_variant"]] if config.get("icl_variant") else [])
+    return os.path.join(*(str(part) for part in parts))
+
+def disambiguate_outdirs(problems):
+    """
+    The problems of subdirs that only differ in their generation configuration (k_beams, variant, shot or icl variant) have
+    the same outdir suffix - these are saved under <shot>/k_beams_<k>/<variant>[/<icl_variant>]/<outdir suffix> instead
+    (the layout of train_linear_classifiers.py below it), so they don't overwrite each other.
+    """
+    suffix_subdirs = dict()
+    for suffix, _, _, subdir in problems:
+        suffix_subdirs.setdefault(suffix, []).append(subdir)
+    disambiguated = []
+    for suffix, X, y, subdir in problems:
+        if len(suffix_subdirs[suffix]) > 1:
+            prefix = get_subdir_prefix(subdir)
+            if prefix is None:
+                raise Exception(f"{suffix_subdirs[suffix]} would all be saved to {suffix}, and {subdir} has no run manifest to tell them apart (run run_manifest.py on its run's outdir)")
+            suffix = os.path.join(prefix, suffix)
+        disambiguated.append((suffix, X, y))
+    duplicates = [suffix for suffix in dict.fromkeys(suffix for suffix, _, _ in disambiguated) if [curr_suffix for curr_suffix, _, _ in disambiguated].count(suffix) > 1]
+    if duplicates:
+        raise Exception(f"several subdirs of the same generation configuration (e.g., of different indirs) would be saved to {duplicates}")
+    return disambiguated
+
+def main(args):
+    problems = get_problems(args.indirs, args.datasets, args.prompt_types, args.embedding_types, args.num_instances, args.aggregation_type, args.feature_cache_dir, args.feature_cache_max_gb)
+    print(f"training {len(problems)} probes")
+
+    # the same train/test split as train_linear_classifiers.py (the validation set for the early stopping is taken from the train set)
+    splits = [train_test_split(X, y, test_size=0.2, random_state=SEED) for _, X, y in problems]
+
+    # the probes with the same feature dimension are trained together (in chunks of at most --max-batch-size probes, each
+    # trained in batches of at most --max-batch-gb of zero-padded features)
+    dims = dict()
+    for i, (X_train, _, _, _) in enumerate(splits):
+        dims.setdefault(X_train.shape[1], []).append(i)
+    for d, indices in dims.items():
+        for chunk_start in range(0, len(indices), args.max_batch_size):
+            chunk = indices[chunk_start:chunk_start+args.max_batch_size]
+            start_time = time.time()
+            results = train_batched_probes([(splits[i][0], splits[i][2]) for i in chunk],
+                                           l2_values=args.l2_values,
+                                           max_epochs=args.max_epochs,
+                                           lr=args.lr,
+                                           patience=args.patience,
+                                           seed=SEED,
+                                           max_batch_bytes=int(args.max_batch_gb * 2**30))
+            print(f"trained {len(chunk)} probes of dimension {d} in {time.time() - start_time:.1f}s")
+            for i, result in zip(chunk, results):
+                outdir = os.path.join(args.outdir, problems[i][0])
+                Path(outdir).mkdir(parents=True, exist_ok=True)
+                _, X_test, _, y_test = splits[i]
+                test_accuracy = (result["probe"].predict(X_test) == y_test).mean()
+                print(f"{problems[i][0]}: l2: {result['l2']}, epochs: {result['epochs']}, validation accuracy: {result['val_accuracy']:.4f}, test accuracy: {test_accuracy:.4f}")
+                with open(os.path.join(outdir, "best_model.pkl"), 'wb') as file:
+                    pickle.dump(result["probe"], file)
+                embedding_type, prompt_type, aggregation_type, _ = problems[i][0].split(os.sep)[-4:]
+                export_numpy_probe(result["probe"], os.path.join(outdir, NUMPY_PROBE_FILE), prompt_type=prompt_type, embedding_type=embedding_type, aggregation_type=aggregation_type)
+    print(f"classifiers saved under {args.outdir}")
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="train the answerability probes of all the datasets, prompt types and layers in a single batched optimization.")
+    argparser.add_argument('-i', '--indirs', nargs='+', type=str, required=True, help='paths to the train set data (run outdirs or their subdirs)')
+    argparser.add_argument('-o', '--outdir', type=str, required=True, help='path to outdir (the classifiers are saved in the layout of train_linear_classifiers.py)')
+    argparser.add_argument('--datasets', nargs='+', type=str, default=DATASETS, help='the datasets to train probes on ("squad", "NQ", "musique").')
+    argparser.add_argument('--prompt-types', nargs='+', type=str, default=["Regular-Prompt", "Hint-Prompt"], help='the prompt types to train probes on.')
+    argparser.add_argument('--embedding-types', nargs='+', type=str, default=EMBEDDING_TYPES, help='the layers to train probes on ("first_hidden_embedding", "last_hidden_embedding").')
+    argparser.add_argument('--num-instances', type=int, default=None, help='number of instances to use for training (will take the same amount from the answerable and the un-answerable). If None - will take all.')
+    argparser.add_argument('--aggregation-type', type=str, default="only_first_tkn", help='how to aggregate all the hidden layers of all the generated tokens of a single instance (choose from "average" to average them, "union" to treat each of them as an instance, and "only_first_tkn" to only take the first token\'s hidden layers).')
+    argparser.add_argument('--l2-values', nargs='+', type=float, default=L2_VALUES, help='the L2 penalty strengths to train each probe with (the best one on the validation set is saved).')
+    argparser.add_argument('--max-epochs', type=int, default=1000, help='maximal number of (full-batch) epochs.')
+    argparser.add_argument('--lr', type=float, default=0.01, help='learning rate (Adam).')
+    argparser.add_argument('--patience', type=int, default=20, help='stop a probe once its validation loss didn\'t improve for this many epochs.')
+    argparser.add_argument('--max-batch-size', type=int, default=64, help='maximal number of probes that are trained together.')
+    argparser.add_argument('--max-batch-gb', type=float, default=4.0, help='memory budget (in GB) of the zero-padded features of the probes that are trained together (the probes of similar sizes are batched together).')
+    argparser.add_argument('--feature-cache-dir', type=str, default=None, help='dir of the feature cache (keyed by the artifacts\' content hash), shared with the other probing, erasure and plotting scripts. If None - no caching.')
+    argparser.add_argument('--feature-cache-max-gb', type=float, default=DEFAULT_CACHE_MAX_GB, help='size cap of the feature cache (least recently used entries are evicted).')
+    args = argparser.parse_args()
+    main(args)
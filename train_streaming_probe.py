@@ -0,0 +1,149 @@
+import os
+import time
+import zlib
+import argparse
+import numpy as np
+import pickle
+from pathlib import Path
+from artifact_utils import list_artifacts, _get_peak_rss_mb
+from feature_extraction import iter_features
+from probe_training import L2_VALUES, StreamingProbes
+from probe_gate import NUMPY_PROBE_FILE, export_numpy_probe
+from train_linear_classifiers import SEED, get_model_name
+
+CHECKPOINT_FILE = "checkpoint.pkl"
+
+
+def get_artifacts(indir, dataset):
+    """The (path, label) of the dataset's artifacts (0 - un-answerable, 1 - answerable)."""
+    artifacts = [(os.path.join(indir, file_name), 0.0 if "un-answerable" in file_name else 1.0) for file_name in list_artifacts(indir) if dataset in file_name]
+    if sorted(label for _, label in artifacts) != [0.0, 1.0]:
+        raise Exception(f"expected a single un-answerable and a single answerable artifact of {dataset} in {indir} (got {[path for path, _ in artifacts]})")
+    return artifacts
+
+def is_validation_instance(path, instance_indices, val_fraction, seed):
+    """The held-out split is by instance (all the rows of an instance are on the same side), by a fixed hash of the artifact and the instance, so it is the same in every pass and after a resume."""
+    key = np.uint64(zlib.crc32(f"{os.path.basename(path)}_{seed}".encode()))
+    with np.errstate(over="ignore"):
+        hashed = (instance_indices.astype(np.uint64) + key) * np.uint64(0x9E3779B97F4A7C15)
+        hashed ^= hashed >> np.uint64(31)
+    return (hashed % np.uint64(10000)) < np.uint64(int(val_fraction * 10000))
+
+def iter_chunks(artifacts, args, rng=None):
+    """
+    Yield the features (with their labels and held-out mask) of a chunk of instances of every artifact in turn, so the
+    classes are interleaved and at most one chunk per artifact is in memory. The rows of each such round are shuffled if rng is given.
+    """
+    iterators = [(path, label, iter_features(path, args.prompt_type, args.embedding_type, args.aggregation_type, chunk_instances=args.chunk_instances, num_instances=args.num_instances)) for path, label in artifacts]
+    while iterators:
+        chunks, exhausted = [], []
+        for path, label, iterator in iterators:
+            chunk = next(iterator, None)
+            if chunk is None:
+                exhausted.append(path)
+                continue
+            features, row_to_instance = chunk
+            chunks.append((features, np.full(len(features), label), is_validation_instance(path, row_to_instance, args.val_fraction, SEED)))
+        iterators = [iterator for iterator in iterators if not iterator[0] in exhausted]
+        chunks = [chunk for chunk in chunks if len(chunk[0]) > 0]
+        if not chunks:
+            continue
+        X, y, is_val = (np.concatenate(parts) for parts in zip(*chunks))
+        if rng is not None:
+            order = rng.permutation(len(X))
+            X, y, is_val = X[order], y[order], is_val[order]
+        yield X, y, is_val
+
+class ThroughputCounter:
+    """The rows and bytes per second of a pass (and the peak RSS), logged every log_every mini-batches."""
+    def __init__(self, description, log_every):
+        self.description = description
+        self.log_every = log_every
+        self.start_time = time.time()
+        self.n_rows, self.n_bytes, self.n_batches = 0, 0, 0
+
+    def update(self, X):
+        self.n_rows += len(X)
+        self.n_bytes += X.nbytes
+        self.n_batches += 1
+        if self.log_every and self.n_batches % self.log_every == 0:
+            self.log()
+
+    def log(self):
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        print(f"{self.description}: {self.n_rows} rows in {elapsed:.1f}s ({self.n_rows / elapsed:.0f} rows/s, {self.n_bytes / elapsed / 2**20:.1f} MiB/s, peak RSS: {_get_peak_rss_mb():.0f}MiB)")
+
+def main(args):
+    model_name = get_model_name(args.indir)
+    outdir = os.path.join(args.outdir, args.dataset, args.embedding_type, args.prompt_type, args.aggregation_type, f"{model_name}_{args.num_instances}N")
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    checkpoint_path = args.checkpoint if args.checkpoint else os.path.join(outdir, CHECKPOINT_FILE)
+    artifacts = get_artifacts(args.indir, args.dataset)
+
+    if args.resume and os.path.exists(checkpoint_path):
+        probes = StreamingProbes.load(checkpoint_path)
+        print(f"resumed from {checkpoint_path} (after {probes.epoch} epochs)")
+    else:
+        probes = StreamingProbes(l2_values=args.l2_values, patience=args.patience, seed=SEED)
+
+    # a first pass for the standardization of the train rows
+    if not probes.is_standardized:
+        counter = ThroughputCounter("standardization pass", args.log_every)
+        for X, _, is_val in iter_chunks(artifacts, args):
+            probes.update_standardization(X[~is_val])
+            counter.update(X)
+        counter.log()
+        probes.finalize_standardization()
+        probes.save(checkpoint_path)
+
+    # the SGD epochs (in mini-batches of the shuffled rounds of chunks), with the held-out rows scored as they stream by
+    while probes.epoch < args.max_epochs:
+        counter = ThroughputCounter(f"epoch {probes.epoch + 1}", args.log_every)
+        rng = np.random.default_rng(SEED + probes.epoch)
+        for X, y, is_val in iter_chunks(artifacts, args, rng):
+            X_train, y_train = X[~is_val], y[~is_val]
+            for batch_start in range(0, len(X_train), args.batch_size):
+                probes.partial_fit(X_train[batch_start:batch_start+args.batch_size], y_train[batch_start:batch_start+args.batch_size])
+                counter.update(X_train[batch_start:batch_start+args.batch_size])
+            probes.validate(X[is_val], y[is_val])
+        counter.log()
+        stopped = probes.end_epoch()
+        for result in probes.get_epoch_results():
+            print(f"l2: {result['l2']}, best epoch: {result['best_epoch']}, held-out loss (streaming estimate): {result['val_loss']:.4f}, held-out accuracy (streaming estimate): {result['val_accuracy']:.4f}{'' if result['active'] else ' (stopped)'}")
+        probes.save(checkpoint_path)
+        if stopped:
+            break
+
+    best_model, result = probes.get_best_probe()
+    # the held-out accuracy of the saved weights (the streaming estimates were accumulated while the weights were changing)
+    n_correct, n_val_rows = 0, 0
+    for X, y, is_val in iter_chunks(artifacts, args):
+        n_correct += int((best_model.predict(X[is_val]) == y[is_val]).sum()) if is_val.any() else 0
+        n_val_rows += int(is_val.sum())
+    print(f"Best l2: {result['l2']} (epoch {result['best_epoch']}), held-out accuracy: {n_correct / max(n_val_rows, 1):.4f} (streaming estimate: {result['val_accuracy']:.4f})")
+    model_filename = os.path.join(outdir, "best_model.pkl")
+    with open(model_filename, 'wb') as file:
+        pickle.dump(best_model, file)
+    export_numpy_probe(best_model, os.path.join(outdir, NUMPY_PROBE_FILE), prompt_type=args.prompt_type, embedding_type=args.embedding_type, aggregation_type=args.aggregation_type)
+    print(f"Best model saved to {model_filename} (checkpoint: {checkpoint_path})")
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="train an answerability probe by streaming the features in mini-batches (for train sets whose features don't fit in memory, e.g., with --aggregation-type union).")
+    argparser.add_argument('-i', '--indir', type=str, required=True, help='path to data')
+    argparser.add_argument('-o', '--outdir', type=str, required=True, help='path to outdir (the classifier is saved in the layout of train_linear_classifiers.py)')
+    argparser.add_argument('--dataset', type=str, default="squad", help='dataset to classify ("squad", "NQ", "musique")')
+    argparser.add_argument('--prompt-type', type=str, default="Regular-Prompt", help='prompt type to classify ("Regular-Prompt", "Hint-Prompt", "CoT-Prompt", "Answerability")')
+    argparser.add_argument('--num-instances', type=int, default=None, help='number of instances to use for training (will take the same amount from the answerable and the un-answerable). If None - will take all.')
+    argparser.add_argument('--aggregation-type', type=str, default="union", help='how to aggregate all the hidden layers of all the generated tokens of a single instance ("union" to treat each of them as an instance, "average" or "only_first_tkn").')
+    argparser.add_argument('--embedding-type', type=str, default="last_hidden_embedding", help='which layer to take: any one of "last_hidden_embedding" and "first_hidden_embedding"')
+    argparser.add_argument('--chunk-instances', type=int, default=64, help='number of instances of each artifact to read at a time (bounds the memory).')
+    argparser.add_argument('--batch-size', type=int, default=1024, help='number of rows of each SGD step.')
+    argparser.add_argument('--val-fraction', type=float, default=0.2, help='the fraction of the instances that are held out (for the early stopping and the choice of l2).')
+    argparser.add_argument('--l2-values', nargs='+', type=float, default=L2_VALUES, help='the L2 penalty strengths to train a probe with (the best one on the held-out rows is saved).')
+    argparser.add_argument('--max-epochs', type=int, default=20, help='maximal number of passes over the train rows.')
+    argparser.add_argument('--patience', type=int, default=2, help='stop a penalty once its held-out loss didn\'t improve for this many epochs.')
+    argparser.add_argument('--checkpoint', type=str, default=None, help='path of the checkpoint of the probes\' state, saved after every epoch (default: checkpoint.pkl in the classifier\'s outdir).')
+    argparser.add_argument('--resume', action='store_true', default=False, help='continue from the checkpoint (if it exists).')
+    argparser.add_argument('--log-every', type=int, default=100, help='log the throughput every this many mini-batches.')
+    args = argparser.parse_args()
+    main(args)
@@ -171,4 +171,26 @@ def get_max_memory():
     gpu_max_memory_used_str = "\n".join([f"card {str(visible_devices[gpu_i])}: {max_memory_dict[gpu_i]}" for gpu_i in range(len(max_memory_dict)-1)])
     max_memory_used_str = f"GPU:\n{gpu_max_memory_used_str}\nCPU:\n{max_memory_dict['cpu']}"
     logging.info(f'max memory used:\n{max_memory_used_str}')
-    return max_memory_dict
\ No newline at end of file
+    return max_memory_dict
+
+
+def get_capture_layers(model, capture_layers):
+    """
+    The indices (in the model's hidden states, where 0 is the embedding layer's output) of the layers whose first generated token's state is captured.
+    capture_layers: None (no capture), ["all"], or a list of layer indices in [-n_layers, n_layers) (negative indices count from the last layer)
+    """
+    if capture_layers is None:
+        return None
+    n_layers = (getattr(model.config, "num_decoder_layers", None) or model.config.num_hidden_layers) + 1 # the embedding layer and every (decoder) layer
+    if list(capture_layers) == ["all"]:
+        return list(range(n_layers))
+    out_of_range = [layer for layer in capture_layers if not -n_layers <= int(layer) < n_layers]
+    if out_of_range:
+        raise Exception(f"--capture-layers {out_of_range} out of range - the model has {n_layers} hidden states (the embedding layer's output and {n_layers-1} layers), so only indices in [{-n_layers}, {n_layers}) are valid")
+    return sorted(set(int(layer) + n_layers if int(layer) < 0 else int(layer) for layer in capture_layers))
+
+
+def get_first_token_layers(outputs, capture_layers):
+    """The state of the first generated token (i.e., at the first decoding step) at each of the captured layers - (batch*beams, layers, d)."""
+    first_step = outputs.decoder_hidden_states[0] if "decoder_hidden_states" in outputs.keys() else outputs.hidden_states[0]
+    return torch.stack([first_step[layer][:,-1,:] for layer in capture_layers], dim=1).to("cpu")
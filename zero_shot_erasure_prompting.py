@@ -7,16 +7,20 @@ from datetime import datetime
 import gc
 import json
 import os
-import pickle
 import argparse
 from pathlib import Path
 import logging
 from utils import *
+from artifact_utils import OUTPUT_FORMATS, STORAGE_DTYPES, COMPRESSIONS, get_artifact_path, get_fields_storage_dtype, save_responses
+from run_manifest import RUN_MANIFEST_FILE, RunManifest
+from leace import load_eraser
 from post_processing.pt_to_benchmarks_evaluate_format import main as pt_to_evaluate_format_converter
 
 # Set the logging level to INFO
 logging.basicConfig(level=logging.INFO)
 
+NO_ERASER = "no_eraser"
+
 def get_responses_unanswerable_questions_squad(p_variant, data_type, args, **kwargs):
 
     def squad_Passage(full_prompt):
@@ -188,7 +192,20 @@ def get_responses_unanswerable_questions_musique(p_variant, data_type, args, **k
         responses["Question"].extend([musique_Question(sample['Regular-Prompt']) for sample in curr_data])
     return responses
 
-def HF_request(prompts, k_beams, tokenizer, model, lm_head, eraser, only_first_decoding):
+def get_return_dict(tokenizer, output_ids, logits_history, last_hidden_embedding, sequences_probs):
+    output_text = [tokenizer.decode(elem, skip_special_tokens=True) for elem in output_ids]
+    all_outputs_ids = pad_sequence([torch.tensor(l) for l in output_ids], batch_first=True, padding_value=0)
+    output_logits = [torch.cat(elem, dim=0) for elem in logits_history]   
+    output_last_hidden_embedding = [torch.cat(elem, dim=0) for elem in last_hidden_embedding]   
+    return {"outputs":output_text,
+            "all_outputs_ids": all_outputs_ids,
+            "full_logits": output_logits,
+            "last_hidden_embedding": output_last_hidden_embedding,
+            "sequences_scores": [float(np.log(prob)) if prob > 0 else float("-inf") for prob in sequences_probs]}
+
+def HF_request(prompts, k_beams, tokenizer, model, lm_head, eraser, only_first_decoding, erasers=None):
+    if erasers is not None:
+        return multi_eraser_request(prompts, k_beams, tokenizer, model, lm_head, erasers, only_first_decoding)
     input_ids = tokenizer.batch_encode_plus(prompts, 
                                             padding=True,
                                             truncation=True,
@@ -242,16 +259,74 @@ def HF_request(prompts, k_beams, tokenizer, model, lm_head, eraser, only_first_d
             output_ids = [cand[0] for cand in filtered_candidates]
             logits_history = [cand[1] for cand in filtered_candidates]
             last_hidden_embedding = [cand[2] for cand in filtered_candidates]
-    output_text = [tokenizer.decode(elem, skip_special_tokens=True) for elem in output_ids]
-    all_outputs_ids = pad_sequence([torch.tensor(l) for l in output_ids], batch_first=True, padding_value=0)
-    output_logits = [torch.cat(elem, dim=0) for elem in logits_history]   
-    output_last_hidden_embedding = [torch.cat(elem, dim=0) for elem in last_hidden_embedding]   
-    return_dicts =  [{"outputs":output_text,
-                      "all_outputs_ids": all_outputs_ids,
-                      "full_logits": output_logits,
-                      "last_hidden_embedding": output_last_hidden_embedding}]
+            sequences_probs = [cand[4] for cand in filtered_candidates]
+    return_dicts =  [get_return_dict(tokenizer, output_ids, logits_history, last_hidden_embedding, sequences_probs)]
     return return_dicts
 
+class ErasersReplies(dict):
+    """The replies to a single prompt with every eraser (eraser name -> the return dict of HF_request)."""
+
+def multi_eraser_request(prompts, k_beams, tokenizer, model, lm_head, erasers, only_first_decoding):
+    """
+    Decode every prompt with every eraser (name -> eraser, or None for no erasure), as in HF_request, with the erasers as an
+    extra batch dimension: a single encoder pass per prompt, and a single decoder pass per decoding step for the beams of all
+    the erasers. The beams with the same prefix (e.g., all of them at the first step, or after the erasure stopped with
+    --only-first-decoding) are only run through the decoder once, and then each is erased with its own eraser.
+    """
+    model.eval()
+    lm_head = lm_head.to('cuda')
+    replies = []
+    for prompt in prompts:
+        input_ids = tokenizer.batch_encode_plus([prompt], 
+                                                padding=True,
+                                                truncation=True,
+                                                return_tensors="pt")["input_ids"].to(model.device)
+        # the beams of every eraser: (output ids, logits history, last hidden embeddings, probability)
+        beams = {name: [([tokenizer.pad_token_id], [], [], 1.0)] for name in erasers.keys()}
+        with torch.no_grad():
+            encoder_hidden_states = model.encoder(input_ids=input_ids, attention_mask=torch.ones_like(input_ids)).last_hidden_state
+            for i in range(20):
+                # the beams that didn't reach the eos (they all have the same length), and their distinct prefixes
+                live = [(name, beam) for name, curr_beams in beams.items() for beam in curr_beams if i == 0 or beam[0][-1] != tokenizer.eos_token_id]
+                if not live:
+                    break
+                prefixes = list(dict.fromkeys(tuple(beam[0]) for _, beam in live))
+                prefix_index = {prefix: ind for ind, prefix in enumerate(prefixes)}
+                embeddings = model(encoder_outputs=(encoder_hidden_states.expand(len(prefixes), -1, -1),), 
+                                   attention_mask=torch.ones_like(input_ids).expand(len(prefixes), -1), 
+                                   decoder_input_ids=torch.tensor(prefixes, device=input_ids.device)).last_hidden_state
+                embeddings = embeddings[:,-1,:].to("cuda")
+                embeddings = embeddings[[prefix_index[tuple(beam[0])] for _, beam in live]]
+
+                # erase the rows of every eraser (at once), then a single lm_head pass for all of them
+                for name, eraser in erasers.items():
+                    rows = [row for row, (curr_name, _) in enumerate(live) if curr_name == name]
+                    if rows and eraser != None and (not only_first_decoding or i == 0):
+                        embeddings[rows] = eraser(embeddings[rows])
+                logits = lm_head(embeddings)
+                probabilities = torch.softmax(logits, dim=-1)
+                next_token_ids = torch.multinomial(probabilities, num_samples=k_beams).to("cpu")
+                probabilities, logits, embeddings = probabilities.to("cpu"), logits.to("cpu"), embeddings.to("cpu")
+
+                # the candidates of every eraser (the finished beams are kept as they are), of which its k best are kept
+                all_candidates = {name: [beam for beam in curr_beams if i > 0 and beam[0][-1] == tokenizer.eos_token_id] for name, curr_beams in beams.items()}
+                for row, (name, (curr_output_ids, curr_logits_history, curr_last_hidden_embedding, prob)) in enumerate(live):
+                    all_candidates[name].extend([(curr_output_ids + [next_token_id.item()], 
+                                                  curr_logits_history + [logits[row:row+1]], 
+                                                  curr_last_hidden_embedding + [embeddings[row:row+1]], 
+                                                  prob*probabilities[row,next_token_id].item()) for next_token_id in next_token_ids[row]])
+                beams = {name: sorted(candidates, key=lambda tup:tup[-1], reverse=True)[:k_beams] for name, candidates in all_candidates.items()}
+        replies.append(ErasersReplies({name: get_return_dict(tokenizer, *(list(field) for field in zip(*curr_beams))) for name, curr_beams in beams.items()}))
+    return replies
+
+def split_erasers_responses(responses, eraser_names):
+    """The responses of every eraser (of a multi_eraser_request run), in the format of a single eraser's responses."""
+    return {name: {key: [value[name] if isinstance(value, ErasersReplies) else value for value in values] for key, values in responses.items()} for name in eraser_names}
+
+def get_eraser_name(eraser_path):
+    """The name (and outdir) of an eraser trained by train_concept_eraser.py (<outdir>/<dataset>/<prompt_type>/eraser.pt) - <dataset>_<prompt_type>."""
+    return "_".join(os.path.normpath(os.path.abspath(eraser_path)).split(os.sep)[-3:-1])
+
 def get_model(args, model_name):
     model_map = {"Flan-UL2" : "google/flan-ul2",
                  "Flan-T5-xxl" : "google/flan-t5-xxl"}
@@ -294,18 +369,34 @@ def get_all_relevant_datasets(args):
         data_list += [{"type": "answerable", "data_name":dataset, "get_data_function":data_function_map[dataset]} for dataset in args.datasets]
     return data_list
 
+def get_erasers(args):
+    """The erasers of the multi-eraser mode (--eraser-paths): name -> eraser (None for the no-erasure baseline)."""
+    erasers = {get_eraser_name(eraser_path): load_eraser(eraser_path, device="cuda") for eraser_path in args.eraser_paths}
+    if len(erasers) < len(args.eraser_paths):
+        raise Exception(f"the erasers' names (<dataset>_<prompt_type> of their paths) must be unique (got {args.eraser_paths})")
+    if args.with_no_eraser:
+        erasers[NO_ERASER] = None
+    return erasers
+
 def main(args):
-    # Load the eraser from the file
-    if args.no_eraser:
+    # Load the eraser from the file (or all the erasers of the multi-eraser mode, each saved to its own outdir)
+    erasers = get_erasers(args) if args.eraser_paths else None
+    if erasers is not None or args.no_eraser:
         eraser = None
+    elif args.eraser_dir is None:
+        raise Exception("pass the eraser (--eraser-dir), a list of erasers (--eraser-paths) or --no-eraser")
     else:
-        with open(args.eraser_dir, "rb") as file:
-            eraser = pickle.load(file).to("cuda")
+        eraser = load_eraser(args.eraser_dir, device="cuda")
 
     now = datetime.now()
     now_str = now.strftime("%d-%m-%Y_%H:%M:%S")
     outdir_path = args.outdir if args.outdir else os.path.join("generated_outputs", now_str)
     logging.info(f'saving to: {outdir_path}')
+    eraser_outdirs = {None: outdir_path} if erasers is None else {name: os.path.join(outdir_path, name) for name in erasers.keys()}
+    # the configuration of every artifact is recorded in the run manifest (read by the evaluation, probes and plots)
+    run_manifests = {name: RunManifest(os.path.join(eraser_outdir, RUN_MANIFEST_FILE)) for name, eraser_outdir in eraser_outdirs.items()}
+    for run_manifest in run_manifests.values():
+        run_manifest.record_run(args)
     datasets_list = get_all_relevant_datasets(args)
     if args.k_beams_grid_search is None:
         k_beams_list = [args.k_beams]
@@ -323,14 +414,21 @@ def main(args):
             for k_beams in k_beams_list:
                 for dataset in datasets_list:
                     print(f"model: {model['output_subdir']} data: {dataset['data_name']} type: {dataset['type']} variant: {p_variant} beam: {k_beams}")
-                    # create directory
-                    curr_outdir = os.path.join(outdir_path, model['output_subdir'], "zero_shot", f"k_beams_{k_beams}", p_variant)
-                    path = Path(curr_outdir)
-                    path.mkdir(parents=True, exist_ok=True)
-                    curr_outdir = os.path.join(curr_outdir, f"{dataset['type']}_{dataset['data_name']}_test.pt")
-
-                    if os.path.exists(curr_outdir):
-                        print(f"{curr_outdir} exists! skipping...")
+                    artifact_config = dict(model=model['output_subdir'], shot="zero_shot", k_beams=k_beams, variant=p_variant, icl_variant=None, dataset=dataset['data_name'], data_type=dataset['type'], split="test", output_format=args.output_format)
+                    curr_outdirs = dict()
+                    for name, eraser_outdir in eraser_outdirs.items():
+                        # create directory
+                        curr_outdir = os.path.join(eraser_outdir, model['output_subdir'], "zero_shot", f"k_beams_{k_beams}", p_variant)
+                        path = Path(curr_outdir)
+                        path.mkdir(parents=True, exist_ok=True)
+                        curr_outdir = os.path.join(curr_outdir, f"{dataset['type']}_{dataset['data_name']}_test.pt")
+
+                        if os.path.exists(get_artifact_path(curr_outdir, args.output_format)):
+                            print(f"{get_artifact_path(curr_outdir, args.output_format)} exists! skipping...")
+                            run_manifests[name].record_artifact(get_artifact_path(curr_outdir, args.output_format), **artifact_config)
+                            continue
+                        curr_outdirs[name] = curr_outdir
+                    if not curr_outdirs:
                         continue
                     
                     responses = dataset['get_data_function'](p_variant=p_variant,
@@ -341,16 +439,20 @@ def main(args):
                                                              model=model['kwargs']['model'], 
                                                              lm_head=model['kwargs']['lm_head'], 
                                                              eraser=eraser, 
+                                                             erasers=None if erasers is None else {name: erasers[name] for name in curr_outdirs.keys()}, 
                                                              only_first_decoding=args.only_first_decoding)
-                    torch.save(responses, curr_outdir)
+                    all_responses = {None: responses} if erasers is None else split_erasers_responses(responses, curr_outdirs.keys())
+                    for name, curr_outdir in curr_outdirs.items():
+                        outpath = save_responses(all_responses[name], curr_outdir, args.output_format, 
+                                       storage_dtype=get_fields_storage_dtype(args.storage_dtype, args.logits_storage_dtype), 
+                                       compression=args.compression)
+                        run_manifests[name].record_artifact(outpath, **artifact_config, **({} if name is None else {"eraser": name}))
 
     # if not only_answerable_instances and not only_unanswerable_instances - namely we have both answerable and answerable prompts - then convert the pt files to the formats adhering to the evaluation scripts
     if not args.only_answerable_instances and not args.only_unanswerable_instances:
-        pt_to_evaluate_format_converter(indirs=[outdir_path], is_beam_experiment=False)
-
-        # if in beams larger than 1 - also run the conversion to the beam relaxation
-        if [k for k in k_beams_list if k>1]:
-            pt_to_evaluate_format_converter(indirs=[outdir_path], is_beam_experiment=True)
+        # if in beams larger than 1 - also run the conversion to the beam relaxation (in the same pass)
+        decoding_types = ["regular_decoding", "beam_relaxation"] if [k for k in k_beams_list if k>1] else ["regular_decoding"]
+        pt_to_evaluate_format_converter(indirs=list(eraser_outdirs.values()), decoding_types=decoding_types)
 
 
 
@@ -365,13 +467,19 @@ if __name__ == '__main__':
     argparser.add_argument("--prompt-variant", nargs='+', type=str, default=["variant1"], help="prompt variant list (any of variant1, variant2, variant3).")
     argparser.add_argument("--batch-size", type=int, default=1, help="size of batch.")
     argparser.add_argument("--model-max-length", type=int, default=2048, help="max input length of model (for datasets like NQ where inputs are very long).")
-    argparser.add_argument("--eraser-dir", type=str, required=True, help="path to eraser.")
+    argparser.add_argument("--eraser-dir", type=str, default=None, help="path to eraser (eraser.pt, or the eraser.pkl of former versions of train_concept_eraser.py).")
+    argparser.add_argument("--eraser-paths", nargs='+', type=str, default=None, help="decode with all these erasers at once (instead of --eraser-dir), as an extra batch dimension: a single encoder pass per prompt and a single decoder pass per decoding step for all of them. The responses of each are saved to outdir/<dataset>_<prompt_type> (of the eraser's path).")
+    argparser.add_argument("--with-no-eraser", action='store_true', default=False, help=f"(--eraser-paths) also decode without erasure (the baseline), saved to outdir/{NO_ERASER}.")
     argparser.add_argument("--no-eraser", action='store_true', default=False, help="do not load eraser (for debugging)")
     argparser.add_argument("--only-first-decoding", action='store_true', default=False, help="perform erasure only on first decoding step.")
     argparser.add_argument("--only-answerable-instances", action='store_true', default=False, help="send only the answerable prompts.")
     argparser.add_argument("--only-unanswerable-instances", action='store_true', default=False, help="send only the un-answerable prompts.")
     argparser.add_argument("--CoT-prompt", action='store_true', default=False, help="whether to also send CoT prompt")
     argparser.add_argument("--binary-answerability-prompt", action='store_true', default=False, help="whether to also send the binary answerability prompt ('Is the question answerable by the passage?').")
+    argparser.add_argument("--output-format", type=str, default="columnar", choices=OUTPUT_FORMATS, help="how to save the responses: a columnar artifact (text sidecar + memory-mapped float16 tensors), or a single pt file.")
+    argparser.add_argument("--storage-dtype", type=str, default="float16", choices=STORAGE_DTYPES, help="dtype to store the hidden states in (columnar output format only). int8 is quantized with a per-row scale.")
+    argparser.add_argument("--logits-storage-dtype", type=str, default="float16", choices=STORAGE_DTYPES, help="dtype to store the full logits in (columnar output format only).")
+    argparser.add_argument("--compression", type=str, default=None, choices=COMPRESSIONS, help="compress the stored tensors in blocks of rows (columnar output format only).")
     args = argparser.parse_args()
     main(args)
 
@@ -10,6 +10,11 @@ import argparse
 from pathlib import Path
 import logging
 from utils import *
+from artifact_utils import OUTPUT_FORMATS, STORAGE_DTYPES, COMPRESSIONS, get_artifact_path, get_fields_storage_dtype, save_responses
+from run_manifest import RUN_MANIFEST_FILE, RunManifest
+from projection import Projector, load_projection, copy_projection
+from probe_gate import GATED_REPLY, ProbeGate, load_numpy_probe, time_sync
+from leace import OnlineStatistics, get_statistics_path
 from post_processing.pt_to_benchmarks_evaluate_format import main as pt_to_evaluate_format_converter
 
 # Set the logging level to INFO
@@ -57,18 +62,18 @@ def get_responses_unanswerable_questions_squad(p_variant, data_type, args, **kwa
         if "Unanswerablity-Reason" in data[0].keys():
             responses["Unanswerablity-Reason"].extend([sample["Unanswerablity-Reason"] for sample in curr_data])
 
-        responses["Regular-Prompt"].extend(HF_request([sample['Regular-Prompt'] for sample in curr_data], **kwargs))
-        responses["Hint-Prompt"].extend(HF_request([sample['Hint-Prompt'] for sample in curr_data], **kwargs))
+        responses["Regular-Prompt"].extend(HF_request([sample['Regular-Prompt'] for sample in curr_data], prompt_type='Regular-Prompt', **kwargs))
+        responses["Hint-Prompt"].extend(HF_request([sample['Hint-Prompt'] for sample in curr_data], prompt_type='Hint-Prompt', **kwargs))
         
         # CoT-like prompt
         if args.CoT_prompt:
-            responses["CoT-Prompt"].extend(HF_request([sample['CoT-Prompt'] for sample in curr_data], **kwargs))
+            responses["CoT-Prompt"].extend(HF_request([sample['CoT-Prompt'] for sample in curr_data], prompt_type='CoT-Prompt', **kwargs))
         else:
             responses["CoT-Prompt"].extend([""]*args.batch_size)
         
         # Binary Answerability prompts ("Is it answerable?")
         if args.binary_answerability_prompt:
-            responses["Answerability"].extend(HF_request([sample['Answerability'] for sample in curr_data], **kwargs))
+            responses["Answerability"].extend(HF_request([sample['Answerability'] for sample in curr_data], prompt_type='Answerability', **kwargs))
         else:
             responses["Answerability"].extend([""]*args.batch_size)
 
@@ -115,18 +120,18 @@ def get_responses_unanswerable_questions_NQ(p_variant, data_type, args, **kwargs
         responses["ids"].extend([sample["id"] for sample in curr_data])
         responses["annotation_ids"].extend([sample["annotation_id"] for sample in curr_data])
 
-        responses["Regular-Prompt"].extend(HF_request([sample['Regular-Prompt'] for sample in curr_data], **kwargs))
-        responses["Hint-Prompt"].extend(HF_request([sample['Hint-Prompt'] for sample in curr_data], **kwargs))
+        responses["Regular-Prompt"].extend(HF_request([sample['Regular-Prompt'] for sample in curr_data], prompt_type='Regular-Prompt', **kwargs))
+        responses["Hint-Prompt"].extend(HF_request([sample['Hint-Prompt'] for sample in curr_data], prompt_type='Hint-Prompt', **kwargs))
 
         # CoT-like prompt
         if args.CoT_prompt:
-            responses["CoT-Prompt"].extend(HF_request([sample['CoT-Prompt'] for sample in curr_data], **kwargs))   
+            responses["CoT-Prompt"].extend(HF_request([sample['CoT-Prompt'] for sample in curr_data], prompt_type='CoT-Prompt', **kwargs))   
         else:
             responses["CoT-Prompt"].extend([""]*args.batch_size)
         
         # Binary Answerability prompts ("Is it answerable?")
         if args.binary_answerability_prompt:
-            responses["Answerability"].extend(HF_request([sample['Answerability'] for sample in curr_data], **kwargs))           
+            responses["Answerability"].extend(HF_request([sample['Answerability'] for sample in curr_data], prompt_type='Answerability', **kwargs))           
         else:
             responses["Answerability"].extend([""]*args.batch_size)
 
@@ -170,18 +175,18 @@ def get_responses_unanswerable_questions_musique(p_variant, data_type, args, **k
         curr_data = data[batch_i*args.batch_size:(batch_i+1)*args.batch_size]
         responses["ids"].extend([sample["id"] for sample in curr_data])
 
-        responses["Regular-Prompt"].extend(HF_request([sample['Regular-Prompt'] for sample in curr_data], **kwargs))
-        responses["Hint-Prompt"].extend(HF_request([sample['Hint-Prompt'] for sample in curr_data], **kwargs))
+        responses["Regular-Prompt"].extend(HF_request([sample['Regular-Prompt'] for sample in curr_data], prompt_type='Regular-Prompt', **kwargs))
+        responses["Hint-Prompt"].extend(HF_request([sample['Hint-Prompt'] for sample in curr_data], prompt_type='Hint-Prompt', **kwargs))
 
         # CoT-like prompt
         if args.CoT_prompt:
-            responses["CoT-Prompt"].extend(HF_request([sample['CoT-Prompt'] for sample in curr_data], **kwargs))
+            responses["CoT-Prompt"].extend(HF_request([sample['CoT-Prompt'] for sample in curr_data], prompt_type='CoT-Prompt', **kwargs))
         else:       
             responses["CoT-Prompt"].extend([""]*args.batch_size)
 
         # Binary Answerability prompts ("Is it answerable?")
         if args.binary_answerability_prompt:
-            responses["Answerability"].extend(HF_request([sample['Answerability'] for sample in curr_data], **kwargs))        
+            responses["Answerability"].extend(HF_request([sample['Answerability'] for sample in curr_data], prompt_type='Answerability', **kwargs))        
         else:
             responses["Answerability"].extend([""]*args.batch_size)
 
@@ -189,33 +194,19 @@ def get_responses_unanswerable_questions_musique(p_variant, data_type, args, **k
         responses["Question"].extend([musique_Question(sample['Regular-Prompt']) for sample in curr_data])
     return responses
 
-def HF_request(prompts, k_beams, tokenizer, model, output_max_length, prompt_suffix, return_only_generated_text, return_first_layer):
-    prompts = [f"{p}{prompt_suffix}" if not p.strip().endswith(prompt_suffix) else p for p in prompts]
-
-    input_ids = tokenizer.batch_encode_plus(
-        prompts, 
-        padding=True,
-        truncation=True,
-        return_tensors="pt")["input_ids"].to(model.device)
-    
-    outputs = model.generate(input_ids, 
-                             num_return_sequences=k_beams, 
-                             max_new_tokens=output_max_length, 
-                             output_scores=True, 
-                             return_dict_in_generate=True, 
-                             output_hidden_states=True, 
-                             num_beams=k_beams, 
-                             early_stopping=True)
-    
+def get_return_dicts(outputs, input_ids, k_beams, tokenizer, model, return_only_generated_text, return_first_layer, capture_layers=None, projector=None):
     outputs_logits = [s.to("cpu") for s in outputs.scores]
 
     if "decoder_hidden_states" in outputs.keys(): # in the case of encoder-decoder models (Flan-T5-xxl and Flun-UL2)
-        outputs_last_hidden_embeddings = [s[-1][:,-1,:].to("cpu") for s in outputs.decoder_hidden_states]
+        outputs_last_hidden_embeddings = [(s[-1][:,-1,:] if projector is None else projector(s[-1][:,-1,:])).to("cpu") for s in outputs.decoder_hidden_states]
         outputs_first_hidden_embeddings = outputs.encoder_hidden_states[0]
     else: # in the case of decoder-only models (OPT-IML)
-        outputs_last_hidden_embeddings = [s[-1][:,-1,:].to("cpu") for s in outputs.hidden_states]
+        outputs_last_hidden_embeddings = [(s[-1][:,-1,:] if projector is None else projector(s[-1][:,-1,:])).to("cpu") for s in outputs.hidden_states]
         outputs_first_hidden_embeddings = [outputs.hidden_states[0][0][batch_i, :,:] for batch_i in range(len(outputs.hidden_states[0][0]))]
 
+    if capture_layers is not None and not return_only_generated_text:
+        outputs_layers_first_tkn_embeddings = get_first_token_layers(outputs, capture_layers)
+
     if model.config.model_type in ["t5", "bart", "led"]:
         outputs_sequences = outputs.sequences.to("cpu")
     else:
@@ -227,6 +218,8 @@ def HF_request(prompts, k_beams, tokenizer, model, output_max_length, prompt_suf
     return_dicts = []
     for batch_i in range(batch_size):
         curr_return_dict = {"outputs":decoded_outputs[batch_i*k_beams:(batch_i+1)*k_beams]}
+        if "sequences_scores" in outputs.keys(): # in beam search - the (length-normalized) log-probability of each of the returned beams
+            curr_return_dict["sequences_scores"] = outputs.sequences_scores[batch_i*k_beams:(batch_i+1)*k_beams].tolist()
         if not return_only_generated_text:
             curr_return_dict["all_outputs_ids"] = outputs_sequences[batch_i*k_beams:(batch_i+1)*k_beams]
             curr_return_dict["full_logits"] = [torch.stack([curr_logits[batch_i+beam_i] for curr_logits in outputs_logits]) for beam_i in range(k_beams)]
@@ -234,9 +227,98 @@ def HF_request(prompts, k_beams, tokenizer, model, output_max_length, prompt_suf
                 curr_return_dict["first_hidden_embedding"] = outputs_first_hidden_embeddings[batch_i].mean(dim=0) # currently not supported for beam search
             else:
                 curr_return_dict["last_hidden_embedding"] = [torch.stack([curr_last_hidden_embedding[batch_i+beam_i] for curr_last_hidden_embedding in outputs_last_hidden_embeddings]) for beam_i in range(k_beams)]
+            if capture_layers is not None:
+                curr_return_dict["layers_first_tkn_embedding"] = outputs_layers_first_tkn_embeddings[batch_i*k_beams] # of the first beam
         return_dicts.append(curr_return_dict)
     return return_dicts
 
+def get_gated_return_dict(first_step_dict, k_beams):
+    """The reply of a gated instance: "unanswerable" for every beam, with the first decoding step's ids, logits and hidden states (the step the probe was scored on)."""
+    gated_return_dict = {"outputs": [GATED_REPLY] * k_beams}
+    if k_beams > 1: # there is no sequence score without the beam search
+        gated_return_dict["sequences_scores"] = [float("nan")] * k_beams
+    for key, value in first_step_dict.items():
+        if key == "all_outputs_ids":
+            gated_return_dict[key] = value.repeat(k_beams, 1)
+        elif key in ["full_logits", "last_hidden_embedding"]:
+            gated_return_dict[key] = value * k_beams
+        elif key != "outputs":
+            gated_return_dict[key] = value
+    return gated_return_dict
+
+def HF_request(prompts, k_beams, tokenizer, model, output_max_length, prompt_suffix, return_only_generated_text, return_first_layer, capture_layers=None, projector=None, probe_gate=None, statistics=None, prompt_type=None):
+    prompts = [f"{p}{prompt_suffix}" if not p.strip().endswith(prompt_suffix) else p for p in prompts]
+    return_dicts_kwargs = dict(tokenizer=tokenizer, model=model, return_only_generated_text=return_only_generated_text, return_first_layer=return_first_layer, capture_layers=capture_layers, projector=projector)
+
+    gated = [False] * len(prompts)
+    encoder_kwargs = dict()
+    if probe_gate is not None and probe_gate.applies_to(prompt_type):
+        # a single (greedy) decoding step - the first step's state is the same for all the beams - and the probe is scored on the device
+        start_time = time_sync(model)
+        inputs = tokenizer.batch_encode_plus(
+            prompts, 
+            padding=True,
+            truncation=True,
+            return_tensors="pt").to(model.device)
+        input_ids = inputs["input_ids"]
+        if model.config.is_encoder_decoder: # the encoder runs once, and its outputs of the kept instances are reused by their decoding
+            encoder_kwargs = dict(attention_mask=inputs["attention_mask"], 
+                                  encoder_outputs=model.get_encoder()(input_ids=input_ids, attention_mask=inputs["attention_mask"], output_hidden_states=True, return_dict=True))
+        first_step_outputs = model.generate(input_ids, 
+                                            **encoder_kwargs, 
+                                            max_new_tokens=1, 
+                                            output_scores=True, 
+                                            return_dict_in_generate=True, 
+                                            output_hidden_states=True, 
+                                            num_beams=1)
+        first_step_states = first_step_outputs.decoder_hidden_states[0][-1][:,-1,:] if "decoder_hidden_states" in first_step_outputs.keys() else first_step_outputs.hidden_states[0][-1][:,-1,:]
+        answerable_probs = probe_gate.answerable_probs(first_step_states if projector is None else projector(first_step_states)).to("cpu")
+        gated = (answerable_probs < probe_gate.threshold).tolist()
+        first_step_dicts = get_return_dicts(first_step_outputs, input_ids, 1, **return_dicts_kwargs) if any(gated) else []
+        if statistics is not None: # of all the instances (including the gated ones)
+            statistics.update_first_step(prompt_type, first_step_outputs, 1)
+        gate_time = time_sync(model) - start_time
+    
+    # decode only the instances that weren't gated (from the encoder outputs of the gating pass, for the encoder-decoder models)
+    kept_prompts = [prompt for prompt, is_gated in zip(prompts, gated) if not is_gated]
+    kept_return_dicts, decoding_steps, prefill_passes = [], 0, 0
+    start_time = time_sync(model)
+    if kept_prompts:
+        if encoder_kwargs:
+            kept = torch.tensor([not is_gated for is_gated in gated], device=input_ids.device)
+            kept_length = int(encoder_kwargs["attention_mask"][kept].sum(dim=1).max()) # the (right) padding of the kept prompts only, as if they were encoded on their own
+            encoder_outputs = encoder_kwargs["encoder_outputs"]
+            input_ids = input_ids[kept, :kept_length]
+            encoder_kwargs = dict(attention_mask=encoder_kwargs["attention_mask"][kept, :kept_length], 
+                                  encoder_outputs=type(encoder_outputs)(last_hidden_state=encoder_outputs.last_hidden_state[kept, :kept_length], 
+                                                                        hidden_states=tuple(hidden_states[kept, :kept_length] for hidden_states in encoder_outputs.hidden_states)))
+        else:
+            input_ids = tokenizer.batch_encode_plus(
+                kept_prompts, 
+                padding=True,
+                truncation=True,
+                return_tensors="pt")["input_ids"].to(model.device)
+            prefill_passes = len(kept_prompts)
+        
+        outputs = model.generate(input_ids, 
+                                 **encoder_kwargs, 
+                                 num_return_sequences=k_beams, 
+                                 max_new_tokens=output_max_length, 
+                                 output_scores=True, 
+                                 return_dict_in_generate=True, 
+                                 output_hidden_states=True, 
+                                 num_beams=k_beams, 
+                                 early_stopping=True)
+        kept_return_dicts, decoding_steps = get_return_dicts(outputs, input_ids, k_beams, **return_dicts_kwargs), len(outputs.scores)
+        if statistics is not None and (probe_gate is None or not probe_gate.applies_to(prompt_type)):
+            statistics.update_first_step(prompt_type, outputs, k_beams)
+    
+    if probe_gate is None or not probe_gate.applies_to(prompt_type):
+        return kept_return_dicts
+    probe_gate.record(prompt_type, answerable_probs.tolist(), gated, gate_time, time_sync(model) - start_time, decoding_steps, prefill_passes=len(prompts) + prefill_passes)
+    kept_return_dicts = iter(kept_return_dicts)
+    return [get_gated_return_dict(first_step_dicts[i], k_beams) if is_gated else next(kept_return_dicts) for i, is_gated in enumerate(gated)]
+
 def get_model(args, model_name):
     model_map = {"Flan-UL2" : "google/flan-ul2",
                  "Flan-T5-xxl" : "google/flan-t5-xxl",
@@ -286,9 +368,14 @@ def main(args):
     now_str = now.strftime("%d-%m-%Y_%H:%M:%S")
     outdir_path = args.outdir if args.outdir else os.path.join("generated_outputs", now_str)
     logging.info(f'saving to: {outdir_path}')
+    # the configuration of every artifact is recorded in the run manifest (read by the evaluation, probes and plots)
+    run_manifest = RunManifest(os.path.join(outdir_path, RUN_MANIFEST_FILE))
+    run_manifest.record_run(args)
     datasets_list = get_all_relevant_datasets(args)
     k_beams_list = [args.k_beams] if args.k_beams_grid_search is None else json.loads(args.k_beams_grid_search)
 
+    projector = None if args.projection is None else Projector(load_projection(args.projection))
+    probe_gate = None if args.probe_gate is None else ProbeGate(load_numpy_probe(args.probe_gate), args.probe_gate_threshold)
     model = None
     for model_name in args.models:
         if model: # free up memory to enable loading the next model
@@ -296,6 +383,8 @@ def main(args):
             gc.collect()
             torch.cuda.empty_cache()        
         model = get_model(args, model_name)
+        capture_layers = None if args.return_only_generated_text else get_capture_layers(model['kwargs']['model'], args.capture_layers)
+        statistics_layers = get_capture_layers(model['kwargs']['model'], args.capture_layers) # also without the hidden states
         for dataset in datasets_list:
             for p_variant in args.prompt_variant:
                 for k_beams in k_beams_list:
@@ -306,29 +395,41 @@ def main(args):
                     path.mkdir(parents=True, exist_ok=True)
                     curr_outdir = os.path.join(curr_outdir, f"{dataset['type']}_{dataset['data_name']}_{args.split}.pt")
                     
-                    if os.path.exists(curr_outdir):
-                        print(f"{curr_outdir} exists! skipping...")
+                    artifact_config = dict(model=model['output_subdir'], shot="zero_shot", k_beams=k_beams, variant=p_variant, icl_variant=None, dataset=dataset['data_name'], data_type=dataset['type'], split=args.split, output_format=args.output_format)
+                    if os.path.exists(get_artifact_path(curr_outdir, args.output_format)):
+                        print(f"{get_artifact_path(curr_outdir, args.output_format)} exists! skipping...")
+                        run_manifest.record_artifact(get_artifact_path(curr_outdir, args.output_format), **artifact_config)
                         continue
                     
+                    statistics = OnlineStatistics(label=0 if dataset['type'] == "un-answerable" else 1, layers=statistics_layers) if args.accumulate_statistics else None
+                    start_time = time_sync(model['kwargs']['model'])
                     responses = dataset['get_data_function'](p_variant=p_variant,
                                                              data_type=dataset['type'],
                                                              args=args, 
                                                              output_max_length=args.output_max_length, 
                                                              k_beams = k_beams, 
                                                              return_first_layer=args.return_first_layer, 
+                                                             capture_layers=capture_layers, 
+                                                             projector=projector, 
+                                                             probe_gate=probe_gate, 
+                                                             statistics=statistics, 
                                                              tokenizer=model['kwargs']['tokenizer'], 
                                                              model=model['kwargs']['model'], 
                                                              prompt_suffix=model['kwargs']['prompt_suffix'], 
                                                              return_only_generated_text=args.return_only_generated_text)
-                    torch.save(responses, curr_outdir)
+                    generation_time = round(time_sync(model['kwargs']['model']) - start_time, 1) # recorded for every artifact, so a gated run can be compared with its reference
+                    outpath = save_responses(responses, curr_outdir, args.output_format, 
+                                   storage_dtype=get_fields_storage_dtype(args.storage_dtype, args.logits_storage_dtype), 
+                                   compression=args.compression)
+                    if probe_gate is not None:
+                        probe_gate.save_summary(outpath)
+                    run_manifest.record_artifact(outpath, **artifact_config, generation_time=generation_time, **({} if capture_layers is None else {"captured_layers": capture_layers}), **({} if projector is None else {"projection": os.path.basename(copy_projection(args.projection, outpath))}), **({} if probe_gate is None else {"probe_gate": args.probe_gate, "probe_gate_threshold": args.probe_gate_threshold}), **({} if statistics is None else {"statistics": os.path.basename(statistics.save(get_statistics_path(outpath)))}))
 
     # if not only_answerable_instances and not only_unanswerable_instances - namely we have both answerable and answerable prompts - then convert the pt files to the formats adhering to the evaluation scripts
     if not args.only_answerable_instances and not args.only_unanswerable_instances:
-        pt_to_evaluate_format_converter(indirs=[outdir_path], is_beam_experiment=False)
-
-        # if in beams larger than 1 - also run the conversion to the beam relaxation
-        if [k for k in k_beams_list if k>1]:
-            pt_to_evaluate_format_converter(indirs=[outdir_path], is_beam_experiment=True)
+        # if in beams larger than 1 - also run the conversion to the beam relaxation (in the same pass)
+        decoding_types = ["regular_decoding", "beam_relaxation"] if [k for k in k_beams_list if k>1] else ["regular_decoding"]
+        pt_to_evaluate_format_converter(indirs=[outdir_path], decoding_types=decoding_types)
 
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser(description="")
@@ -341,6 +442,11 @@ if __name__ == '__main__':
     argparser.add_argument("--prompt-variant", nargs='+', type=str, default=["variant1"], help="prompt variant list (any of variant1, variant2, variant3).")
     argparser.add_argument("--return-only-generated-text", action='store_true', default=False, help="whether to return only the generated text, without the logits (in cases of OOM)")
     argparser.add_argument("--return-first-layer", action='store_true', default=False, help="whether to also return the first layer's (uncontextualized) embedding.")
+    argparser.add_argument("--projection", type=str, default=None, help="project the hidden states (last_hidden_embedding) with this projection (saved by projection.py) on the device, and store the projected vectors. A copy of the projection is saved next to every artifact.")
+    argparser.add_argument("--probe-gate", type=str, default=None, help="path to a numpy probe (best_model.npz, exported by train_linear_classifiers.py). The probe is scored on the first decoding step's last hidden state of its prompt type, and the instances whose answerable probability is below --probe-gate-threshold are answered \"unanswerable\" without decoding the rest.")
+    argparser.add_argument("--probe-gate-threshold", type=float, default=0.1, help="the answerable probability below which the probe gate answers \"unanswerable\".")
+    argparser.add_argument("--accumulate-statistics", action='store_true', default=False, help="accumulate the running statistics (count, sum and sum of outer products, in float64 on the device) of the first generated token's last hidden state (and of the --capture-layers) of every prompt type, and save them next to every artifact (<artifact>.stats.npz) - enough for train_concept_eraser.py --from-statistics, also with --return-only-generated-text.")
+    argparser.add_argument("--capture-layers", nargs='+', type=str, default=None, help="also save the first generated token's state at every layer (\"all\") or at the given layer indices (0 is the embedding layer, negative indices count from the last layer), as a single (layers, d) block per instance.")
     argparser.add_argument("--batch-size", type=int, default=1, help="size of batch.")
     argparser.add_argument("--model-max-length", type=int, default=2048, help="max input length of model (for datasets like NQ where inputs are very long).")
     argparser.add_argument("--output-max-length", type=int, default=100, help="max output length.")
@@ -349,6 +455,10 @@ if __name__ == '__main__':
     argparser.add_argument("--only-unanswerable-instances", action='store_true', default=False, help="send only the un-answerable prompts.")
     argparser.add_argument("--CoT-prompt", action='store_true', default=False, help="whether to also send CoT prompt")
     argparser.add_argument("--binary-answerability-prompt", action='store_true', default=False, help="whether to also send the binary answerability prompt ('Is the question answerable by the passage?').")
+    argparser.add_argument("--output-format", type=str, default="columnar", choices=OUTPUT_FORMATS, help="how to save the responses: a columnar artifact (text sidecar + memory-mapped float16 tensors), or a single pt file.")
+    argparser.add_argument("--storage-dtype", type=str, default="float16", choices=STORAGE_DTYPES, help="dtype to store the hidden states in (columnar output format only). int8 is quantized with a per-row scale.")
+    argparser.add_argument("--logits-storage-dtype", type=str, default="float16", choices=STORAGE_DTYPES, help="dtype to store the full logits in (columnar output format only).")
+    argparser.add_argument("--compression", type=str, default=None, choices=COMPRESSIONS, help="compress the stored tensors in blocks of rows (columnar output format only).")
     args = argparser.parse_args()
     main(args)
 